@@ -1,18 +1,25 @@
-import concurrent.futures
+import asyncio
+import json
+import os
 import socket
 import logging
 import ntplib
 import random
 import time
 import threading
-from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 # local imports
 from .misc import xdescr
 
 TIMESHIFT_SECONDS_WARNING = 1;    """Time shift in seconds for the warning message to be logged"""
-TIMEOUT_SOCKET_DEFAULT = 2;       """Timeout in seconds for network socket operations"""
+TIMEOUT_SOCKET_DEFAULT = 2;       """Timeout in seconds for a single NTP query, including the hostname lookup"""
+TIMEOUT_DEADLINE_DEFAULT = 10;    """Timeout in seconds for the whole measurement"""
 NUM_MEASUREMENTS_REQUIRED = 5;    """Number of successful measurements required to assess time accuracy"""
+NUM_QUERIES_CONCURRENT = 10;      """Maximum number of NTP queries in flight"""
+CACHE_TTL_DEFAULT = 300;          """Time in seconds the cached result of a successful check is trusted"""
+NTP_PORT = 123
+NTP_VERSION = 3
 
 _ntp_hostname_suffix = 'pool.ntp.org'
 _ntp_hostname_country_parts = [
@@ -29,7 +36,10 @@ class IncorrectSystemTimeError(RuntimeError):
     """The system time is incorrect compared to what was received via NTP"""
 
 
-def verify_time_is_correct(wait=True, log_result=True, log_unresponsive=False, diff_fatal=10.0) -> float | None:
+def verify_time_is_correct(
+        wait=True, log_result=True, log_unresponsive=False, diff_fatal=10.0,
+        cache_path: str | Path = None, cache_ttl: float = CACHE_TTL_DEFAULT
+) -> float | None:
     """
     Verifies that the system date/time matches that received via NTP.
     Raises IncorrectSystemTimeError if there is a mismatch.
@@ -37,71 +47,181 @@ def verify_time_is_correct(wait=True, log_result=True, log_unresponsive=False, d
     @param log_result: log the result to the standard Python logging system.
     @param log_unresponsive: log every time the NTP server does not respond.
     @param diff_fatal: time shift in seconds for the exception to be raised.
+    @param cache_path: file keeping the result of the latest successful check, shared by the processes started
+        close to each other; None to always query NTP servers.
+    @param cache_ttl: time in seconds the cached result is trusted.
     @return: time offset in seconds, the second-smallest result obtained using NTP servers, None if failed to measure.
     """
+    return asyncio.run(verify_time_is_correct_async(
+        wait=wait, log_result=log_result, log_unresponsive=log_unresponsive, diff_fatal=diff_fatal,
+        cache_path=cache_path, cache_ttl=cache_ttl
+    ))
+
+
+async def verify_time_is_correct_async(
+        wait=True, log_result=True, log_unresponsive=False, diff_fatal=10.0,
+        cache_path: str | Path = None, cache_ttl: float = CACHE_TTL_DEFAULT,
+        servers: list[str] = None, port: int = NTP_PORT, timeout: float = TIMEOUT_DEADLINE_DEFAULT
+) -> float | None:
+    """
+    Same as verify_time_is_correct, to be called from a running event loop.
+    @param servers: NTP server hostnames or IP addresses, None for the public NTP pool servers.
+    @param port: NTP server UDP port.
+    @param timeout: time in seconds a single measurement round may take.
+    """
+    offset = _load_cached_offset(Path(cache_path), cache_ttl) if cache_path else None
+    if offset is not None and offset <= diff_fatal:
+        if log_result:
+            log.info(f'the system time is correct, offset is {offset * 1000:.2f} ms as checked recently')
+        return offset
+
     while True:
-        offset = _verify_time_is_correct_internal(log_unresponsive, diff_fatal)
+        offset = await _verify_time_is_correct_internal(log_unresponsive, diff_fatal, servers, port, timeout)
         if offset is not None or not wait:
             break
 
     if offset is not None and log_result:
         log.info(f'the system time is correct, current offset is {offset * 1000:.2f} ms')
+    if offset is not None and cache_path:
+        _save_cached_offset(Path(cache_path), offset)
 
     return offset
 
 
-def _verify_time_is_correct_internal(log_unresponsive: bool, diff_fatal: float) -> float | None:
+def _load_cached_offset(filepath: Path, ttl: float) -> float | None:
+    """The offset saved by a successful check not older than ttl seconds, None if there is none"""
+    try:
+        with filepath.open(mode='r', encoding='utf-8') as f:
+            cached = json.load(f)
+        age = time.time() - cached['checked']
+        return float(cached['offset']) if 0 <= age < ttl else None  # a negative age: the clock has been set back
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        log.warning(f'ignoring invalid time check cache {filepath}: {xdescr(ex)}')
+        return None
+
+
+def _save_cached_offset(filepath: Path, offset: float):
+    filepath_tmp = filepath.with_name(f'{filepath.name}.{os.getpid()}.tmp')
+    try:
+        with filepath_tmp.open(mode='w', encoding='utf-8') as f:
+            json.dump({'checked': time.time(), 'offset': offset}, f)
+        filepath_tmp.replace(filepath)
+    except OSError as ex:
+        log.warning(f'cannot save time check cache {filepath}: {xdescr(ex)}')
+
+    finally:
+        filepath_tmp.unlink(missing_ok=True)
+
+
+class _NtpQuery(asyncio.DatagramProtocol):
+    """A single NTP client request, the future receives the statistics of the response"""
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.tx_timestamp = 0.0
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.tx_timestamp = ntplib.system_to_ntp_time(time.time())
+        transport.sendto(ntplib.NTPPacket(version=NTP_VERSION, mode=3, tx_timestamp=self.tx_timestamp).to_data())
+
+    def datagram_received(self, data: bytes, addr):
+        dest_timestamp = ntplib.system_to_ntp_time(time.time())
+        if self.future.done():
+            return
+        try:
+            stats = ntplib.NTPStats()
+            stats.from_data(data)
+            stats.dest_timestamp = dest_timestamp
+        except Exception as ex:
+            self.future.set_exception(ex)
+            return
+        if abs(stats.orig_timestamp - self.tx_timestamp) > 1e-6:
+            return  # not a response to our request
+        self.future.set_result(stats)
+
+    def error_received(self, exc: Exception):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+    def connection_lost(self, exc: Exception | None):
+        if not self.future.done():
+            self.future.set_exception(exc or ConnectionError('the socket is closed'))
+
+
+async def _verify_time_is_correct_internal(
+        log_unresponsive: bool, diff_fatal: float, servers: list[str] | None, port: int, timeout: float
+) -> float | None:
     """
     Verifies that the system date/time matches that received via NTP.
     Raises IncorrectSystemTimeError if there is a mismatch.
+    Queries the servers concurrently, the outstanding queries are cancelled as soon as the required number
+    of measurements is completed or the timeout expires.
     @param log_unresponsive: log every time the NTP server does not respond.
     @return: time offset in seconds, the second-smallest result obtained using NTP servers, None if failed to measure.
     """
-    num_servers = len(_ntp_servers)
-    mid_idx = num_servers // 2
-    indexes_priority = list(range(mid_idx));              """indexes of the first half of the list of NTP servers"""
-    indexes_reserve = list(range(mid_idx, num_servers));  """indexes of the second half of the list of NTP servers"""
-
-    random.shuffle(indexes_priority)
-    random.shuffle(indexes_reserve)
-    indexes_all = indexes_priority + indexes_reserve
+    if servers is None:
+        num_servers = len(_ntp_servers)
+        mid_idx = num_servers // 2
+        indexes_priority = list(range(mid_idx));              """indexes of the first half of the NTP servers"""
+        indexes_reserve = list(range(mid_idx, num_servers));  """indexes of the second half of the NTP servers"""
+
+        random.shuffle(indexes_priority)
+        random.shuffle(indexes_reserve)
+        with _ntp_servers_lock:
+            hostnames = [_ntp_servers[x] for x in indexes_priority + indexes_reserve]
+    else:
+        hostnames = list(servers)
 
+    loop = asyncio.get_running_loop()
     results: dict[str, float] = {};   """results of NTP requests, ipaddr => offset dictionary"""
     unresponsive_servers = set();     """hostnames of HTP servers that did not respond"""
-    lock = threading.Lock();          """locker for updating measurement results and unresponsive servers"""
-
-    def measure_time_offset(hostname: str):
-        if len(results) >= NUM_MEASUREMENTS_REQUIRED:
-            return  # we already have required number of measurement results
-
-        try:
-            ipaddr = socket.gethostbyname(hostname)
-            if ipaddr in results:
-                return  # we already have a measurement result for this IP
+    completed = asyncio.Event();      """the required number of measurements is completed"""
+    semaphore = asyncio.Semaphore(NUM_QUERIES_CONCURRENT)
 
-            client = ntplib.NTPClient()
-            resp = client.request(ipaddr, timeout=TIMEOUT_SOCKET_DEFAULT)
-
-        except Exception as e:
-            if log_unresponsive:
-                log.info(f'host: {hostname}, exception: {xdescr(e)}')
-            with lock:
+    async def measure_time_offset(hostname: str):
+        async with semaphore:
+            if len(results) >= NUM_MEASUREMENTS_REQUIRED:
+                return  # we already have required number of measurement results
+
+            transport = None
+            try:
+                async with asyncio.timeout(TIMEOUT_SOCKET_DEFAULT):
+                    infos = await loop.getaddrinfo(hostname, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+                    ipaddr = infos[0][4][0]
+                    if ipaddr in results:
+                        return  # we already have a measurement result for this IP
+
+                    future = loop.create_future()
+                    transport, _protocol = await loop.create_datagram_endpoint(
+                        lambda: _NtpQuery(future), remote_addr=(ipaddr, port)
+                    )
+                    stats: ntplib.NTPStats = await future
+
+            except Exception as e:
+                if log_unresponsive:
+                    log.info(f'host: {hostname}, exception: {xdescr(e)}')
                 unresponsive_servers.add(hostname)
-            return  # silently return on any exception
-
-        with lock:
-            results[ipaddr] = abs(resp.offset)
+                return  # silently return on any exception
 
-    with ThreadPoolExecutor(max_workers=NUM_MEASUREMENTS_REQUIRED+2) as wp:
-        with _ntp_servers_lock:
-            futures: list[concurrent.futures.Future]
-            futures = [wp.submit(measure_time_offset, _ntp_servers[x]) for x in indexes_all]
+            finally:
+                if transport is not None:
+                    transport.close()
 
-        while not all(x.done() for x in futures):
+            results[ipaddr] = abs(stats.offset)
             if len(results) >= NUM_MEASUREMENTS_REQUIRED:
-                wp.shutdown(wait=True, cancel_futures=True)
-                break
-            time.sleep(0.1)
+                completed.set()
+
+    async def measure_all():
+        async with asyncio.TaskGroup() as tg:
+            for h in hostnames:
+                tg.create_task(measure_time_offset(h))
+
+    tasks = [asyncio.create_task(measure_all()), asyncio.create_task(completed.wait())]
+    await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
     if len(results) < NUM_MEASUREMENTS_REQUIRED:
         log.warning(f'measurements required: {NUM_MEASUREMENTS_REQUIRED}, completed: {len(results)}')
@@ -115,12 +235,11 @@ def _verify_time_is_correct_internal(log_unresponsive: bool, diff_fatal: float)
     if offset > TIMESHIFT_SECONDS_WARNING:
         log.warning(f'the system time differs from NTP by {offset:.2f} seconds')
 
-    if unresponsive_servers:
+    if unresponsive_servers and servers is None:
         # non-responsive servers where found, move their hostnames to the end of the list of NTP servers
         with _ntp_servers_lock:
             for h in unresponsive_servers:
                 _ntp_servers.remove(h)
             _ntp_servers.extend(unresponsive_servers)
-        assert len(_ntp_servers) == len(indexes_all)
 
     return offset
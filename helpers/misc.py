@@ -9,14 +9,10 @@ import random
 import logging
 import typing
 import functools
-import csv
-import jsonpickle
-import requests
-import asyncio
-import aiohttp
 from collections.abc import Iterable, Callable
-from requests.exceptions import ConnectionError
-from urllib3.exceptions import ProtocolError, MaxRetryError, NewConnectionError
+
+# requests, aiohttp, jsonpickle and csv are imported by the functions using them: this module is imported
+# by every console script, the light ones (like checktime) should not pay for the heavy imports
 
 log = logging.getLogger(__name__)
 
@@ -28,7 +24,11 @@ def _json_serial(obj):
     raise TypeError(f'type {type(obj)} not serializable')
 
 
-def json_dumps(obj) -> str:
+def json_dumps(obj, indent: bool = True) -> str:
+    if not indent:
+        return simplejson.dumps(
+            obj, ensure_ascii=False, use_decimal=True, default=_json_serial, separators=(',', ':')
+        )
     return simplejson.dumps(obj, indent=True, ensure_ascii=False, use_decimal=True, default=_json_serial)
 
 
@@ -37,6 +37,7 @@ def json_loads(data: str):
 
 
 def jsonpickle_dumps(self) -> str:
+    import jsonpickle
     jsonpickle.set_encoder_options('simplejson', use_decimal=True, sort_keys=True, ensure_ascii=False, indent=4)
     jsonpickle.set_preferred_backend('simplejson')
     json_str = jsonpickle.dumps(self, use_decimal=True)
@@ -44,6 +45,9 @@ def jsonpickle_dumps(self) -> str:
 
 
 def http_request_json(method: str, url: str, retries: int = 5, random_retry_pause: float = 0, **kwargs) -> (int, dict):
+    import requests
+    from requests.exceptions import ConnectionError
+    from urllib3.exceptions import ProtocolError, MaxRetryError, NewConnectionError
     while True:
         try:
             resp = requests.request(method, url, **kwargs)
@@ -63,6 +67,9 @@ def http_request_json(method: str, url: str, retries: int = 5, random_retry_paus
 
 
 async def aiohttp_request_json(method: str, url: str, tries: int = 5, retry_pause: float = 0, **kwargs) -> (int, dict):
+    import asyncio
+    import aiohttp
+    from urllib3.exceptions import ProtocolError
     while True:
         try:
             async with aiohttp.ClientSession(json_serialize=json_dumps) as session:
@@ -224,6 +231,7 @@ def in_memory_csv(objects: Iterable, headers: Iterable[str], values: Callable[[o
     @param headers: headers
     @param values: callable to get values from a single object
     """
+    import csv
     mem_csv = io.StringIO()
     writer = csv.writer(mem_csv)
     writer.writerow(headers)
@@ -11,6 +11,7 @@ from zmodels import tcm
 
 # local imports
 from vpnsutils import main
+from vpnsutils.settings import settings
 
 
 def pytest_addoption(parser):
@@ -47,6 +48,22 @@ def tm():
         tm.abort()
 
 
+@pytest.fixture
+def override_settings(app):
+    """
+    Override settings parameters with raw ini-file values for the duration of the test:
+    override_settings(parameter='value', ...)
+    """
+    _unused = app
+    settings_dict = settings._settings_dict
+
+    def override(**values: str):
+        settings.load({**settings._settings_dict, **values})
+
+    yield override
+    settings.load(settings_dict)
+
+
 @pytest.fixture
 def testapp(app, tm):
     testapp = webtest.TestApp(app, extra_environ={
@@ -0,0 +1,49 @@
+"""
+Reference implementation of the traffic amounts distribution: the original hour by hour loop of a single user,
+for the tests and the benchmarks to compare save_amounts_batch with.
+"""
+
+from datetime import timedelta
+
+# module imports
+from zmodels.misc import epoch_hour
+from zmodels.tlog import TrafficLog
+from zmodels.usage import UsageWindows
+
+
+def save_amounts_per_user(tlog: dict, usage: UsageWindows, hostname: str, user_id: str, dt_prev, dt, am_down, am_up):
+    """
+    The original distribution of a single user's amounts, hour by hour.
+    @param tlog: (hour, hostname, user_id) => (bytes downloaded, bytes uploaded), updated.
+    @param usage: usage windows, updated.
+    """
+    hour_dt = dt.replace(minute=0, second=0, microsecond=0)
+    hour = dt_prev.replace(minute=0, second=0, microsecond=0)
+    while hour <= hour_dt:
+        dt_left = max(hour, dt_prev)
+        dt_right = min(dt, hour + timedelta(hours=1))
+        am_down_sec = am_down / (dt - dt_left).total_seconds()
+        am_up_sec = am_up / (dt - dt_left).total_seconds()
+        am_down_part = round(am_down_sec * (dt_right - dt_left).total_seconds())
+        am_up_part = round(am_up_sec * (dt_right - dt_left).total_seconds())
+        am_down -= am_down_part
+        am_up -= am_up_part
+        key = hour, hostname, user_id
+        down, up = tlog.get(key, (0, 0))
+        tlog[key] = down + am_down_part, up + am_up_part
+        usage.add(epoch_hour(hour), user_id.split('-')[0], am_down_part + am_up_part)
+        hour += timedelta(hours=1)
+
+
+def verify_matches_reference(tlog: TrafficLog, tlog_expected: dict) -> int:
+    """
+    Assert that the traffic log has the same amounts as the reference one. The only difference allowed:
+    the reference stores (0, 0) records for the hours the amounts of a user round to zero in, the traffic log
+    does not store records without traffic.
+    @return: number of the (0, 0) records of the reference.
+    """
+    records = dict(tlog.items())
+    assert (0, 0) not in records.values()
+    assert records.keys() <= tlog_expected.keys()
+    assert {k: records.get(k, (0, 0)) for k in tlog_expected} == tlog_expected
+    return sum(1 for x in tlog_expected.values() if x == (0, 0))
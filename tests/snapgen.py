@@ -0,0 +1,67 @@
+"""
+Generator of synthetic traffic snapshots for the benchmarks: a snapshots directory of a VPN server
+as saved by snapstat, with idle users, traffic counter resets and missing snapshots.
+"""
+
+import random
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# module imports
+from helpers.misc import json_dumps
+
+# local imports
+from vpnsutils.snapshots import update_manifest
+
+DEVICES = ('phone', 'laptop', 'tablet', 'tv')
+FILENAME_PREFIX = 'umbrella-'
+DATETIME_KEY = '__datetime'
+
+
+def generate_snapshots(
+        dir_snapshots: Path, num_users: int, num_hours: int, dt_end: datetime = None,
+        idle_ratio: float = 0.7, reset_ratio: float = 0.001, gap_ratio: float = 0.02, seed: int = 0
+) -> dict[datetime, dict]:
+    """
+    Save hourly snapshots of a VPN server along with the manifest.
+    @param dir_snapshots: the snapshots directory to create.
+    @param num_users: number of VPN clients; a user has one to four clients, named like user12-phone.
+    @param num_hours: number of hours to generate the snapshots for.
+    @param dt_end: date/time of the latest snapshot, now by default.
+    @param idle_ratio: probability that a client has no traffic within an hour.
+    @param reset_ratio: probability that the traffic counters of a client are reset within an hour.
+    @param gap_ratio: probability that the snapshot of an hour is missing.
+    @param seed: random seed, the same arguments give the same snapshots.
+    @return: date/time => snapshot, of the snapshots saved.
+    """
+    rnd = random.Random(seed)
+    dt_end = dt_end or datetime.now(tz=timezone.utc)
+    client_ids = []
+    while len(client_ids) < num_users:
+        user = f'user{len(client_ids)}'
+        client_ids.extend(f'{user}-{x}' for x in DEVICES[:rnd.randint(1, len(DEVICES))])
+    counters = {x: [0, 0] for x in client_ids[:num_users]}
+
+    snaps = {}
+    for i in range(num_hours):
+        for v in counters.values():
+            if rnd.random() < reset_ratio:
+                v[0] = v[1] = 0
+            if rnd.random() >= idle_ratio:
+                am_down = int(rnd.lognormvariate(17, 2))
+                v[0] += am_down
+                v[1] += am_down // rnd.randint(5, 50)
+
+        if i and rnd.random() < gap_ratio:
+            continue
+
+        # snapstat is run by cron, the snapshots are taken a few seconds off the hour
+        dt = dt_end - timedelta(hours=num_hours - 1 - i, seconds=rnd.uniform(0, 30))
+        snap = {k: list(v) for k, v in counters.items()} | {DATETIME_KEY: dt.isoformat()}
+        filepath = dir_snapshots.joinpath(f'{dt:%Y/%m/%d}/{FILENAME_PREFIX}{dt:%Y%m%d-%H%M%S}.json')
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        filepath.write_text(json_dumps(snap, indent=False), encoding='utf-8')
+        snaps[dt] = snap
+
+    update_manifest(dir_snapshots, [], filename_prefix=FILENAME_PREFIX, datetime_key=DATETIME_KEY)
+    return snaps
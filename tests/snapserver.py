@@ -0,0 +1,85 @@
+"""
+Local HTTP server serving a snapshots directory, a stand-in for the VPN servers in tests.
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import threading
+from collections.abc import Iterator
+from pathlib import Path
+from aiohttp import web
+
+
+@contextlib.asynccontextmanager
+async def serve_snapshots(dir_snapshots: Path, requests_seen: list = None, host: str = '127.0.0.1'):
+    """
+    Serve the snapshots directory over HTTP on a random local port.
+    Directories are listed in json, like nginx does with "autoindex_format json", with ETag validation.
+    @param dir_snapshots: the directory to serve.
+    @param requests_seen: if given, (path, Range header) of every request received are appended to it.
+    @param host: local address to listen on, servers on 127.0.0.2, 127.0.0.3, ... stand for different hosts.
+    @return: URL of the served directory.
+    """
+    @web.middleware
+    async def log_requests(request: web.Request, handler):
+        if requests_seen is not None:
+            requests_seen.append((request.path, request.headers.get('Range')))
+        return await handler(request)
+
+    async def handle(request: web.Request) -> web.StreamResponse:
+        filepath = dir_snapshots.joinpath(request.match_info.get('path', ''))
+        if dir_snapshots.resolve() not in (filepath.resolve(), *filepath.resolve().parents):
+            raise web.HTTPForbidden()
+
+        if filepath.is_file():
+            return web.FileResponse(filepath)
+        if not filepath.is_dir():
+            raise web.HTTPNotFound()
+
+        listing = [
+            {'name': x.name, 'type': 'directory'} if x.is_dir() else {'name': x.name, 'type': 'file'}
+            for x in sorted(filepath.iterdir())
+        ]
+        body = json.dumps(listing).encode('utf-8')
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
+
+    webapp = web.Application(middlewares=[log_requests])
+    webapp.router.add_get('/snapshots', handle)
+    webapp.router.add_get('/snapshots/{path:.*}', handle)
+    runner = web.AppRunner(webapp)
+    await runner.setup()
+    site = web.TCPSite(runner, host, 0)
+    await site.start()
+    try:
+        yield f'http://{host}:{runner.addresses[0][1]}/snapshots'
+    finally:
+        await runner.cleanup()
+
+
+@contextlib.contextmanager
+def serve_snapshots_in_thread(dir_snapshots: Path, host: str = '127.0.0.1') -> Iterator[str]:
+    """
+    Serve the snapshots directory from an event loop running in a thread of its own,
+    for clients that start and stop event loops of their own, e.g. with asyncio.run().
+    @return: URL of the served directory.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name=f'snapserver-{host}', daemon=True)
+    thread.start()
+    server = serve_snapshots(dir_snapshots, host=host)
+    try:
+        url = asyncio.run_coroutine_threadsafe(server.__aenter__(), loop).result()
+        try:
+            yield url
+        finally:
+            asyncio.run_coroutine_threadsafe(server.__aexit__(None, None, None), loop).result()
+
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
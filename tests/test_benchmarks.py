@@ -0,0 +1,200 @@
+"""
+End-to-end benchmarks: fetching the snapshots from local stand-ins of the VPN servers, parsing them,
+and making the report on a FileStorage database, with the records compressed and not; the Data.fs size is
+saved to the extra info of the results. The benchmarks run once, untimed, with the test suite;
+see README.rst for running them timed and comparing the results with the saved ones.
+"""
+
+import asyncio
+import contextlib
+import random
+import transaction
+import pytest
+import ZODB
+from datetime import datetime, timedelta, timezone
+from ZODB.FileStorage import FileStorage
+from zc.zlibstorage import ZlibStorage
+
+# module imports
+from zmodels import AppRoot, tcm, get_app_root
+from zmodels.usage import UsageWindows
+
+# local imports
+from tests.reference import save_amounts_per_user, verify_matches_reference
+from tests.snapgen import generate_snapshots
+from tests.snapserver import serve_snapshots_in_thread
+from vpnsutils.makerep import TrafficStatsCollector, make_report, parse_snaps, save_amounts_batch, write_report
+from vpnsutils.settings import settings
+
+NUM_SERVERS = 3
+NUM_USERS = 300
+NUM_HOURS = 48
+
+
+@pytest.fixture(scope='module')
+def snapshots_tree(tmp_path_factory):
+    """
+    Snapshots directories of the servers, one per hostname 127.0.0.1, 127.0.0.2, ...
+    @return: tuple of: the root directory, hostname => date/time => snapshot.
+    """
+    dir_root = tmp_path_factory.mktemp('servers')
+    snaps = {}
+    for idx in range(NUM_SERVERS):
+        hostname = f'127.0.0.{idx + 1}'
+        snaps[hostname] = generate_snapshots(dir_root.joinpath(hostname), NUM_USERS, NUM_HOURS, seed=idx)
+    return dir_root, snaps
+
+
+@pytest.fixture(scope='module')
+def server_urls(snapshots_tree) -> list[str]:
+    dir_root, snaps = snapshots_tree
+    with contextlib.ExitStack() as stack:
+        yield [stack.enter_context(serve_snapshots_in_thread(dir_root.joinpath(x), host=x)) for x in snaps]
+
+
+@pytest.fixture
+def open_file_db(tmp_path):
+    """Factory of connections to new FileStorage databases, compressed or not, closed after the test"""
+    conns = []
+
+    def open_db(compress: bool = False):
+        storage = FileStorage(str(tmp_path.joinpath(f'Data{len(conns)}.fs')))
+        db = ZODB.DB(ZlibStorage(storage) if compress else storage)
+        conns.append(db.open(transaction_manager=transaction.TransactionManager(explicit=True)))
+        return conns[-1]
+
+    yield open_db
+    for conn in conns:
+        db = conn.db()
+        conn.close()
+        db.close()
+
+
+def test_collector(benchmark, override_settings, snapshots_tree, server_urls):
+    _dir_root, snaps = snapshots_tree
+    override_settings(urls_traffic_snapshots='\n'.join(server_urls))
+
+    async def collect() -> TrafficStatsCollector:
+        async with TrafficStatsCollector(urls=server_urls, last_datetimes={}) as collector:
+            await collector.execute()
+        return collector
+
+    result = benchmark(lambda: asyncio.run(collect()))
+    assert not result.hosts_failed
+    assert {k: len(v) for k, v in result.snapshots.items()} == {k: len(v) for k, v in snaps.items()}
+
+
+def test_parse_snaps(benchmark, app, snapshots_tree):
+    _unused = app
+    _dir_root, snaps = snapshots_tree
+    hostname, host_snaps = next(iter(snaps.items()))
+    roots = []
+
+    def setup():
+        roots.append(AppRoot())
+        return (roots[-1], hostname, host_snaps), {}
+
+    benchmark.pedantic(parse_snaps, setup=setup, rounds=5)
+    assert roots[-1].num_snapshots() == len(host_snaps)
+
+
+def test_settings_read(benchmark, app):
+    """A parameter is read in the parse loop for every user of every snapshot"""
+    _unused = app
+    key = benchmark(lambda: settings.snapshot_dict_datetime_key)
+    assert key and isinstance(key, str)
+
+
+def test_parse_loop(benchmark, app):
+    """Parsing full snapshots of many users, with no idle ones"""
+    _unused = app
+    dt0 = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    num_users, num_snaps = 2000, 24
+    snaps = {
+        dt0 + timedelta(hours=i): {f'user{x}': [x * i, i] for x in range(num_users)} | {
+            settings.snapshot_dict_datetime_key: (dt0 + timedelta(hours=i)).isoformat()
+        }
+        for i in range(num_snaps)
+    }
+    roots = []
+
+    def setup():
+        roots.append(AppRoot())
+        return (roots[-1], 'h1', snaps), {}
+
+    benchmark.pedantic(parse_snaps, setup=setup, rounds=3)
+    assert roots[-1].num_snapshots() == num_snaps
+    assert len(roots[-1].tlog.totals()) == num_users
+
+
+@pytest.mark.parametrize('batch', [True, False], ids=['batch', 'per_user'])
+def test_save_amounts(benchmark, app, batch):
+    """Traffic amounts of all users between two snapshots saved at once or user by user"""
+    _unused = app
+    rnd = random.Random(0)
+    dt_end = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    periods = []
+    for _ in range(20):
+        dt_prev, dt_end = dt_end, dt_end + timedelta(seconds=rnd.choice([3600, 7207]) + rnd.random())
+        deltas = [(f'user{x}-phone', rnd.randrange(10 ** 9), rnd.randrange(10 ** 6)) for x in range(NUM_USERS)]
+        periods.append((dt_prev, dt_end, deltas))
+
+    def save(appr: AppRoot) -> AppRoot:
+        for dt_prev, dt, deltas in periods:
+            if batch:
+                save_amounts_batch(appr, '127.0.0.1', dt_prev, dt, deltas)
+            else:
+                for delta in deltas:
+                    save_amounts_batch(appr, '127.0.0.1', dt_prev, dt, [delta])
+        return appr
+
+    appr = benchmark.pedantic(save, setup=lambda: ((AppRoot(),), {}), rounds=5)
+    tlog_expected, usage_expected = {}, UsageWindows(appr.host('127.0.0.1').usage.num_hours)
+    for dt_prev, dt, deltas in periods:
+        for user_id, am_down, am_up in deltas:
+            save_amounts_per_user(tlog_expected, usage_expected, '127.0.0.1', user_id, dt_prev, dt, am_down, am_up)
+    verify_matches_reference(appr.tlog, tlog_expected)
+
+
+@pytest.mark.parametrize('compress', [False, True], ids=['plain', 'compressed'])
+def test_make_report(benchmark, override_settings, tmp_path, server_urls, open_file_db, compress):
+    override_settings(dir_report=str(tmp_path), urls_traffic_snapshots='\n'.join(server_urls))
+    conns = []
+
+    def setup():
+        conns.append(open_file_db(compress))
+        return (conns[-1],), {}
+
+    benchmark.pedantic(lambda conn: asyncio.run(make_report(conn)), setup=setup, rounds=3)
+    benchmark.extra_info['data_fs_bytes'] = conns[-1].db().getSize()
+    assert tmp_path.joinpath('report.json').exists()
+
+
+@pytest.fixture(params=[False, True], ids=['plain', 'compressed'])
+def ingested_conn(request, snapshots_tree, open_file_db, app):
+    """Connection to a FileStorage database with all snapshots of the servers parsed"""
+    _unused = app
+    _dir_root, snaps = snapshots_tree
+    conn = open_file_db(compress=request.param)
+    with tcm.in_transaction(conn):
+        appr = get_app_root(conn)
+        for hostname, host_snaps in snaps.items():
+            parse_snaps(appr, hostname, host_snaps)
+    return conn
+
+
+def test_write_report(benchmark, override_settings, tmp_path, ingested_conn):
+    override_settings(dir_report=str(tmp_path))
+    # the objects are loaded from the storage every round
+    benchmark.pedantic(write_report, args=(ingested_conn,), setup=ingested_conn.cacheMinimize, rounds=20)
+    benchmark.extra_info['data_fs_bytes'] = ingested_conn.db().getSize()
+    assert tmp_path.joinpath('report.json').exists()
+
+
+def test_scan_tlog(benchmark, ingested_conn):
+    def scan() -> dict:
+        with tcm.in_transaction(ingested_conn):
+            return get_app_root(ingested_conn).tlog.totals()
+
+    totals = benchmark.pedantic(scan, setup=ingested_conn.cacheMinimize, rounds=20)
+    assert totals
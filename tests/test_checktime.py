@@ -0,0 +1,104 @@
+import asyncio
+import contextlib
+import time
+import ntplib
+import pytest
+
+# module imports
+from helpers import checktime
+from helpers.checktime import IncorrectSystemTimeError, verify_time_is_correct_async
+
+
+class FakeNtpServer(asyncio.DatagramProtocol):
+    """Answers NTP client requests with the local time shifted by the given offset, or never answers if silent"""
+    def __init__(self, offset: float, silent: bool = False):
+        self.offset = offset
+        self.silent = silent
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if self.silent:
+            return
+        request = ntplib.NTPPacket()
+        request.from_data(data)
+        now = ntplib.system_to_ntp_time(time.time() + self.offset)
+        response = ntplib.NTPPacket(version=request.version, mode=4, tx_timestamp=now)
+        response.stratum = 2
+        response.recv_timestamp = response.ref_timestamp = now
+        response.orig_timestamp = request.tx_timestamp
+        self.transport.sendto(response.to_data(), addr)
+
+
+@contextlib.asynccontextmanager
+async def serve_ntp(num: int, offset: float, num_silent: int = 0):
+    """
+    Run fake NTP servers on 127.0.0.1, 127.0.0.2, ... sharing a port.
+    @return: context manager yielding a tuple of: server addresses, port.
+    """
+    loop = asyncio.get_running_loop()
+    transports = []
+    port = 0
+    try:
+        for idx in range(num + num_silent):
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda: FakeNtpServer(offset, silent=idx >= num), local_addr=(f'127.0.0.{idx + 1}', port)
+            )
+            transports.append(transport)
+            port = transport.get_extra_info('sockname')[1]
+        yield [f'127.0.0.{x + 1}' for x in range(num + num_silent)], port
+
+    finally:
+        for transport in transports:
+            transport.close()
+
+
+def test_offset_measured_without_waiting_for_silent_servers():
+    async def run():
+        async with serve_ntp(5, offset=0.25, num_silent=3) as (servers, port):
+            time_start = time.monotonic()
+            offset = await verify_time_is_correct_async(servers=servers[::-1], port=port, timeout=5)
+            return offset, time.monotonic() - time_start
+
+    offset, elapsed = asyncio.run(run())
+    assert offset == pytest.approx(0.25, abs=0.05)
+    assert elapsed < checktime.TIMEOUT_SOCKET_DEFAULT
+
+
+def test_incorrect_time_raises():
+    async def run():
+        async with serve_ntp(5, offset=30.0) as (servers, port):
+            await verify_time_is_correct_async(diff_fatal=10.0, servers=servers, port=port)
+
+    with pytest.raises(IncorrectSystemTimeError):
+        asyncio.run(run())
+
+
+def test_too_few_answers_within_deadline():
+    async def run():
+        async with serve_ntp(3, offset=0.0, num_silent=2) as (servers, port):
+            return await verify_time_is_correct_async(wait=False, servers=servers, port=port, timeout=0.5)
+
+    assert asyncio.run(run()) is None
+
+
+def test_cached_result_skips_network(tmp_path):
+    filepath = tmp_path.joinpath('time-check.json')
+
+    async def run():
+        async with serve_ntp(5, offset=0.1) as (servers, port):
+            offset = await verify_time_is_correct_async(servers=servers, port=port, cache_path=filepath)
+        # the servers are gone, the result comes from the cache
+        offset_cached = await verify_time_is_correct_async(
+            wait=False, servers=servers, port=port, cache_path=filepath, timeout=0.5
+        )
+        offset_expired = await verify_time_is_correct_async(
+            wait=False, servers=servers, port=port, cache_path=filepath, cache_ttl=0, timeout=0.5
+        )
+        return offset, offset_cached, offset_expired
+
+    offset, offset_cached, offset_expired = asyncio.run(run())
+    assert offset_cached == offset
+    assert offset_expired is None
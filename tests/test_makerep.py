@@ -0,0 +1,464 @@
+import asyncio
+import json
+import random
+import pytest
+import transaction
+import ZODB
+from ZODB.FileStorage import FileStorage
+from datetime import datetime, timedelta, timezone
+from ZODB.POSException import ConflictError
+# noinspection PyUnresolvedReferences
+from BTrees.OOBTree import OOBTree
+
+# module imports
+from helpers.misc import json_dumps
+from zmodels import AppRoot, tcm, get_app_root
+
+# local imports
+from tests.reference import save_amounts_per_user, verify_matches_reference
+from tests.snapserver import serve_snapshots
+from zmodels.misc import epoch_hour
+from zmodels.usage import UsageWindows
+from vpnsutils.makerep import SnapshotFeed, SnapshotParser, HostIngest, ensure_host_states, make_report, parse_snaps
+from vpnsutils.makerep import ReportDaemon, save_amounts_batch, load_last_snapshot
+from vpnsutils import makerep
+from vpnsutils.snapshots import make_delta, manifest_record, update_manifest
+
+DT0 = datetime(2024, 5, 1, 10, 0, 12, 345678, tzinfo=timezone.utc)
+
+
+def make_counters(num: int) -> list[dict[str, list[int]]]:
+    """Counters of several users, most of them idle most of the time"""
+    result = []
+    counters = {f'user{x}@example.com': [0, 0] for x in range(10)}
+    for i in range(num):
+        counters = {k: list(v) for k, v in counters.items()}
+        for j, (k, v) in enumerate(counters.items()):
+            if (i + j) % 4 == 0:
+                v[0] += 1000 * (i + 1) + j
+                v[1] += 100 * (i + 1) + j
+        result.append(counters)
+
+    return result
+
+
+def test_delta_snapshots_parsed_as_full(app):
+    _unused = app
+    dts = [(DT0 + timedelta(minutes=61 * x)).isoformat() for x in range(12)]
+    full = {datetime.fromisoformat(dt): c | {'__datetime': dt} for dt, c in zip(dts, make_counters(12))}
+
+    deltas = {}
+    counters_prev = None
+    for i, (dt, snap) in enumerate(sorted(full.items())):
+        counters = {k: v for k, v in snap.items() if not k.startswith('__')}
+        if i % 5 == 0:
+            deltas[dt] = dict(snap)
+        else:
+            deltas[dt] = make_delta(counters, counters_prev) | {'__datetime': snap['__datetime'], '__base': dts[i - 1]}
+        counters_prev = counters
+
+    appr_full, appr_delta = AppRoot(), AppRoot()
+    parse_snaps(appr_full, 'h1', full)
+    parse_snaps(appr_delta, 'h1', deltas)
+
+    assert list(appr_full.tlog.items()) == list(appr_delta.tlog.items())
+    assert load_last_snapshot(appr_full, 'h1') == load_last_snapshot(appr_delta, 'h1')
+    assert sum(len(x) for x in deltas.values()) < sum(len(x) for x in full.values()) * 0.6
+
+
+def test_delta_without_base_skipped_until_keyframe(app):
+    _unused = app
+    dts = [(DT0 + timedelta(hours=x)).isoformat() for x in range(3)]
+    counters = make_counters(3)
+    snaps = {
+        datetime.fromisoformat(dts[0]): counters[0] | {'__datetime': dts[0], '__base': '2024-05-01T09:00:00+00:00'},
+        datetime.fromisoformat(dts[1]): counters[1] | {'__datetime': dts[1]},
+        datetime.fromisoformat(dts[2]): make_delta(counters[2], counters[1]) | {'__datetime': dts[2], '__base': dts[1]},
+    }
+
+    appr = AppRoot()
+    parse_snaps(appr, 'h1', snaps)
+    assert len(appr.hosts['h1'].issues) == 1
+    assert load_last_snapshot(appr, 'h1') == counters[2] | {'__datetime': dts[2]}
+    assert appr.tlog
+
+
+def test_legacy_ingest_state_moved_to_host_partitions(app):
+    _unused = app
+    snap = make_counters(1)[0] | {'__datetime': DT0.isoformat()}
+    appr = AppRoot()
+    appr.hosts, appr.num_snapshots = None, None
+    appr.last_snapshots = {'h1': snap}
+    hour = datetime.now(tz=timezone.utc).replace(minute=0, second=0, microsecond=0)
+    appr.tlog.add(hour, 'h1', 'user1-phone', 10, 5)
+
+    ensure_host_states(appr, ['h2'])
+    assert sorted(appr.hosts) == ['h1', 'h2']
+    assert load_last_snapshot(appr, 'h1') == snap
+    assert appr.hosts['h1'].usage.totals(epoch_hour(hour)) == {'user1': 15}
+    assert appr.last_snapshots is None
+    assert sorted(appr.tlog.hosts) == ['h1', 'h2']
+
+
+def test_last_snapshot_rewrites_changed_counters_only(app, zodb_conn):
+    _unused = app
+    dts = [(DT0 + timedelta(hours=x)).isoformat() for x in range(2)]
+    snap0 = {f'user{x}-phone': [x * 1000, x] for x in range(5000)} | {'__datetime': dts[0]}
+    snap1 = snap0 | {'user7-phone': [8000, 7], '__datetime': dts[1]}
+    with tcm.in_transaction(zodb_conn):
+        parse_snaps(get_app_root(zodb_conn), 'h1', {DT0: snap0})
+
+    with tcm.in_transaction(zodb_conn):
+        appr = get_app_root(zodb_conn)
+        parse_snaps(appr, 'h1', {DT0 + timedelta(hours=1): snap1})
+        buckets_changed = []
+        bucket = appr.hosts['h1'].snapshot.counters._firstbucket
+        while bucket is not None:
+            buckets_changed.append(bucket._p_changed)
+            bucket = bucket._next
+        assert buckets_changed.count(True) == 1 and len(buckets_changed) > 10
+        assert load_last_snapshot(appr, 'h1') == snap1
+
+
+def test_feed_delivers_in_order_with_back_pressure():
+    async def run() -> tuple[list, int]:
+        feed = SnapshotFeed(high_water_mark=2)
+        feed.listing_started()
+        slots = [feed.expect(DT0 + timedelta(hours=x)) for x in range(5)]
+        delivered = []
+        max_ahead = 0
+        fetched = set()
+
+        async def fetch(idx: int):
+            nonlocal max_ahead
+            await feed.wait_turn(slots[idx])
+            fetched.add(idx)
+            max_ahead = max(max_ahead, len(fetched) - len(delivered))
+            await asyncio.sleep(0.01 * (5 - idx))  # later snapshots arrive first
+            await feed.put(slots[idx], [idx])
+
+        async def consume():
+            while (items := await feed.get()) is not None:
+                delivered.extend(items)
+
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(consume())
+            for i in range(5):
+                tg.create_task(fetch(i))
+            await feed.listing_done()
+
+        return delivered, max_ahead
+
+    delivered, max_ahead = asyncio.run(run())
+    assert delivered == [0, 1, 2, 3, 4]
+    assert max_ahead <= 2
+
+
+@pytest.fixture
+def zodb_conn():
+    db = ZODB.DB(None)
+    conn = db.open(transaction_manager=transaction.TransactionManager(explicit=True))
+    yield conn
+    conn.close()
+    db.close()
+
+
+def save_recent_snapshots(dir_snapshots, num: int) -> list[dict]:
+    """Save hourly snapshots up to now along with the manifest, return the manifest records"""
+    records = []
+    dt_start = datetime.now(tz=timezone.utc) - timedelta(hours=num)
+    for i, counters in enumerate(make_counters(num)):
+        dt = dt_start + timedelta(hours=i)
+        path = f'{dt:%Y/%m/%d}/umbrella-{dt:%Y%m%d-%H%M%S}.json'
+        filepath = dir_snapshots.joinpath(path)
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        filepath.write_text(json_dumps(counters | {'__datetime': dt}), encoding='utf-8')
+        records.append(manifest_record(path, dt, filepath.stat().st_size))
+    update_manifest(dir_snapshots, records[-1:], filename_prefix='umbrella-', datetime_key='__datetime')
+    return records
+
+
+def test_make_report(override_settings, tmp_path, zodb_conn):
+    dir_snapshots = tmp_path.joinpath('snapshots')
+    records = save_recent_snapshots(dir_snapshots, 30)
+
+    filepath_metrics = tmp_path.joinpath('makerep.prom')
+    override_settings(dir_report=str(tmp_path), ingest_high_water_mark='3', metrics_textfile=str(filepath_metrics))
+
+    async def run():
+        async with serve_snapshots(dir_snapshots) as url:
+            override_settings(urls_traffic_snapshots=url)
+            await make_report(zodb_conn)
+
+    asyncio.run(run())
+
+    with tcm.in_transaction(zodb_conn):
+        appr = get_app_root(zodb_conn)
+        assert appr.hosts['127.0.0.1'].snapshot.datetime == records[-1]['datetime']
+        assert appr.num_snapshots() == len(records)
+        total = sum(v[0] for _k, v in appr.tlog.items())
+    counters_first, counters_last = make_counters(30)[0], make_counters(30)[-1]
+    assert total == sum(counters_last[k][0] - counters_first[k][0] for k in counters_last)
+
+    report = json.loads(tmp_path.joinpath('report.json').read_text(encoding='utf-8'))
+    assert sorted(x[0] for x in report['stats']) == sorted(counters_last)
+    assert [x['days'] for x in report['totals']] == [30, 90]
+    assert report['totals'][0]['stats'] == report['stats']  # all the snapshots are within both periods
+
+    metrics = dict(x.rsplit(' ', 1) for x in filepath_metrics.read_text().splitlines() if not x.startswith('#'))
+    assert int(metrics['makerep_host_snapshots_ingested_total{host="127.0.0.1"}']) == len(records)
+    assert int(metrics['makerep_host_requests_total{host="127.0.0.1"}']) > 0
+    assert int(metrics['makerep_host_request_latency_seconds_count{host="127.0.0.1"}']) > 0
+    assert int(metrics['makerep_host_tlog_records_total{host="127.0.0.1"}']) > 0
+    assert metrics['makerep_host_failed{host="127.0.0.1"}'] == '0'
+    assert int(metrics['makerep_db_objects']) > 0
+    assert {'prepare', 'fetch', 'report'} <= {x.split('"')[1] for x in metrics if x.startswith('makerep_stage_')}
+
+
+def test_report_daemon_polls_and_reports(override_settings, tmp_path, monkeypatch, zodb_conn):
+    dir_snapshots = tmp_path.joinpath('snapshots')
+    records = save_recent_snapshots(dir_snapshots, 5)
+    override_settings(dir_report=str(tmp_path), daemon_poll_interval='1')
+    reports = []
+    write_report = makerep.write_report
+    monkeypatch.setattr(makerep, 'write_report', lambda *args: reports.append(1) or write_report(*args))
+
+    async def wait_ingested(dt: str):
+        for _ in range(100):
+            with tcm.in_transaction(zodb_conn):
+                state = get_app_root(zodb_conn).hosts.get('127.0.0.1', None)
+                if state and state.snapshot.datetime == dt:
+                    return
+            await asyncio.sleep(0.05)
+        raise TimeoutError(dt)
+
+    async def run():
+        async with serve_snapshots(dir_snapshots) as url:
+            override_settings(urls_traffic_snapshots=url)
+            daemon = ReportDaemon(zodb_conn)
+            task = asyncio.create_task(daemon.run())
+            await wait_ingested(records[-1]['datetime'])
+
+            dt = datetime.now(tz=timezone.utc)
+            path = f'{dt:%Y/%m/%d}/umbrella-{dt:%Y%m%d-%H%M%S}.json'
+            dir_snapshots.joinpath(path).parent.mkdir(parents=True, exist_ok=True)
+            dir_snapshots.joinpath(path).write_text(json_dumps(make_counters(6)[-1] | {'__datetime': dt}))
+            record = manifest_record(path, dt, dir_snapshots.joinpath(path).stat().st_size)
+            update_manifest(dir_snapshots, [record], filename_prefix='umbrella-', datetime_key='__datetime')
+            await wait_ingested(record['datetime'])
+
+            daemon.stop()
+            await task
+
+    asyncio.run(run())
+    assert len(reports) >= 3  # at the start, after new snapshots have been ingested and when stopping
+    assert tmp_path.joinpath('report.json').exists()
+
+
+def test_report_lists_recent_issues_aggregated(override_settings, tmp_path, zodb_conn):
+    override_settings(
+        dir_report=str(tmp_path), report_issues_days='7', report_issues_max='3', issues_max_entries='2',
+        issues_retention_days='20'
+    )
+    now = datetime.now(tz=timezone.utc)
+    with tcm.in_transaction(zodb_conn):
+        appr = get_app_root(zodb_conn)
+        appr.issues = OOBTree({now - timedelta(days=100): 'legacy expired', now - timedelta(days=1): 'legacy recent'})
+        ensure_host_states(appr, ['h1', 'h2'])
+        for i in range(3):
+            appr.hosts['h1'].issues.add('snapshots_missed', f'missed {i}', now - timedelta(days=10 - i), count=2)
+        appr.hosts['h1'].issues.add('other', 'old', now - timedelta(days=30))
+        for i in range(4):
+            appr.hosts['h2'].issues.add('collection_failed', f'failed {i}', now - timedelta(hours=i), detail=str(i))
+
+    makerep.prepare_ingest(zodb_conn, ['http://h1/snapshots', 'http://h2/snapshots'])
+    makerep.update_host_states(zodb_conn, ['h1', 'h2'], {'h2': 'refused'})
+    makerep.write_report(zodb_conn)
+    report = json.loads(tmp_path.joinpath('report.json').read_text(encoding='utf-8'))
+    assert [x[1] for x in report['issues']] == [
+        'legacy recent', 'failed 0', 'h2: snapshots collection given up: refused'
+    ]
+    assert [x[0] for x in report['issues']] == sorted(x[0] for x in report['issues'])
+
+    with tcm.in_transaction(zodb_conn):
+        appr = get_app_root(zodb_conn)
+        assert len(appr.hosts['h1'].issues) == 1 and len(appr.hosts['h2'].issues) == 2
+        assert len(appr.issues) == 1
+        issue = next(appr.hosts['h1'].issues.recent())
+        assert issue.count == 6 and issue.describe().startswith('missed 2 (total 6 since')
+
+
+def test_report_daemon_retries_failed_report(override_settings, tmp_path, monkeypatch, zodb_conn):
+    override_settings(dir_report=str(tmp_path), daemon_report_retry_pause='0.01')
+    reports, exported = [], []
+
+    def write_report(_conn):
+        reports.append(1)
+        if len(reports) == 1:
+            raise ConflictError()
+
+    monkeypatch.setattr(makerep, 'write_report', write_report)
+    monkeypatch.setattr(makerep, 'export_metrics', lambda _metrics, hosts_failed, _db: exported.append(hosts_failed))
+
+    async def run():
+        daemon = ReportDaemon(zodb_conn)
+        daemon.hosts_failed = {'h1': 'refused'}
+        task = asyncio.create_task(daemon.report())
+        while not exported:
+            await asyncio.sleep(0.01)
+        daemon.stop()
+        await task
+
+    asyncio.run(asyncio.wait_for(run(), timeout=5))
+    assert len(reports) >= 2
+    assert exported[0] == {'h1': 'refused'}  # the servers given up are kept for the retried report
+
+
+@pytest.mark.parametrize('failure', ['refused', 'hanging'])
+def test_failed_host_given_up_healthy_host_ingested(override_settings, tmp_path, zodb_conn, failure):
+    dir_snapshots = tmp_path.joinpath('snapshots')
+    records = save_recent_snapshots(dir_snapshots, 5)
+    override_settings(
+        dir_report=str(tmp_path), collector_deadline='1',
+        aiohttp_retry_pause_initial='0.01', aiohttp_breaker_failures='2'
+    )
+
+    async def hang(_reader, _writer):
+        await asyncio.sleep(10)
+
+    async def run():
+        server = await asyncio.start_server(hang, '127.0.0.2', 0)
+        port = server.sockets[0].getsockname()[1]
+        if failure == 'refused':
+            server.close()
+            await server.wait_closed()
+        try:
+            async with serve_snapshots(dir_snapshots) as url:
+                urls = f'{url}\nhttp://127.0.0.2:{port}/snapshots'
+                override_settings(urls_traffic_snapshots=urls)
+                await make_report(zodb_conn)
+        finally:
+            server.close()
+
+    asyncio.run(run())
+
+    with tcm.in_transaction(zodb_conn):
+        appr = get_app_root(zodb_conn)
+        assert appr.hosts['127.0.0.1'].snapshot.datetime == records[-1]['datetime']
+        issues = [x.message for x in appr.hosts['127.0.0.2'].issues.recent()]
+    assert len(issues) == 1 and 'given up' in issues[0]
+    assert ('consecutive requests failed' if failure == 'refused' else 'deadline') in issues[0]
+
+
+def test_failed_ingest_gives_up_the_host_only(override_settings, tmp_path, monkeypatch):
+    # the hosts are committed concurrently, FileStorage resolves the conflicts of the snapshot counter
+    db = ZODB.DB(FileStorage(str(tmp_path.joinpath('Data.fs'))))
+    conn = db.open(transaction_manager=transaction.TransactionManager(explicit=True))
+    records = save_recent_snapshots(tmp_path.joinpath('snapshots'), 5)
+    override_settings(dir_report=str(tmp_path), ingest_checkpoint_snapshots='2')
+    parse = SnapshotParser.parse
+
+    def parse_failing(self, snap_current):
+        if self.hostname == '127.0.0.2' and self.num_parsed == 3:
+            raise RuntimeError('parse failed')
+        parse(self, snap_current)
+
+    monkeypatch.setattr(SnapshotParser, 'parse', parse_failing)
+
+    async def run():
+        async with serve_snapshots(tmp_path.joinpath('snapshots')) as url1:
+            async with serve_snapshots(tmp_path.joinpath('snapshots'), host='127.0.0.2') as url2:
+                override_settings(urls_traffic_snapshots=f'{url1}\n{url2}')
+                await make_report(conn)
+
+    asyncio.run(run())
+
+    with tcm.in_transaction(conn):
+        appr = get_app_root(conn)
+        assert appr.hosts['127.0.0.1'].snapshot.datetime == records[-1]['datetime']
+        assert appr.hosts['127.0.0.2'].snapshot.datetime == records[1]['datetime']  # the checkpoint is kept
+        assert not list(appr.hosts['127.0.0.1'].issues.recent())
+        issues = [x.message for x in appr.hosts['127.0.0.2'].issues.recent()]
+    assert len(issues) == 1 and 'given up' in issues[0] and 'parse failed' in issues[0]
+    conn.close()
+    db.close()
+
+
+def test_spooled_snapshots_not_downloaded_again(override_settings, tmp_path, monkeypatch, zodb_conn):
+    dir_snapshots, dir_spool = tmp_path.joinpath('snapshots'), tmp_path.joinpath('spool')
+    save_recent_snapshots(dir_snapshots, 10)
+    override_settings(dir_report=str(tmp_path), dir_spool=str(dir_spool))
+    requests_seen = []
+
+    async def run():
+        async with serve_snapshots(dir_snapshots, requests_seen) as url:
+            override_settings(urls_traffic_snapshots=url)
+            await make_report(zodb_conn)
+
+    def finish_failing(_self):
+        raise RuntimeError('database failure')
+
+    with monkeypatch.context() as m:
+        m.setattr(SnapshotParser, 'finish', finish_failing)
+        asyncio.run(run())  # the host is given up, the run goes on
+    assert len([x for x in requests_seen if x[0].endswith('.json')]) == 10
+    assert len(list(dir_spool.rglob('*.json'))) == 10
+
+    requests_seen.clear()
+    asyncio.run(run())
+    assert not [x for x in requests_seen if x[0].endswith('.json')]
+    assert not list(dir_spool.rglob('*.json'))  # removed once ingested
+
+
+def test_interrupted_ingest_resumes_from_checkpoint(override_settings, zodb_conn):
+    override_settings(ingest_checkpoint_snapshots='4')
+    dts = [(DT0 + timedelta(hours=x)).isoformat() for x in range(10)]
+    snaps = [c | {'__datetime': dt} for dt, c in zip(dts, make_counters(10))]
+
+    async def run():
+        async with HostIngest(zodb_conn.db(), 'h1') as worker:
+            await worker.parse_many(snaps)
+            raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        asyncio.run(run())
+
+    with tcm.in_transaction(zodb_conn):
+        appr = get_app_root(zodb_conn)
+        assert appr.hosts['h1'].snapshot.datetime == dts[7]
+        assert appr.num_snapshots() == 8
+
+
+def test_save_amounts_batch_matches_per_user():
+    rnd = random.Random(3)
+    appr = AppRoot()
+    tlog_expected, usage_expected = {}, UsageWindows(appr.host('host1').usage.num_hours)
+    user_ids = [f'user{x}-{y}' for x in range(50) for y in range(rnd.randrange(1, 3))]
+    dt = DT0
+    for _ in range(40):
+        dt_prev, dt = dt, dt + timedelta(seconds=rnd.choice([1, 59, 3600, 7207, 86400 * 3]) + rnd.random())
+        hostname = rnd.choice(['host1', 'host2'])
+        deltas = [(x, rnd.randrange(10 ** rnd.randrange(1, 13)), rnd.randrange(1000)) for x in user_ids]
+        save_amounts_batch(appr, hostname, dt_prev, dt, deltas)
+        for user_id, am_down, am_up in deltas:
+            save_amounts_per_user(tlog_expected, usage_expected, hostname, user_id, dt_prev, dt, am_down, am_up)
+    assert verify_matches_reference(appr.tlog, tlog_expected) > 0  # the data has amounts rounding to zero
+    hour_now = epoch_hour(dt)
+    totals = {}
+    for state in appr.hosts.values():
+        for uid, amount in state.usage.totals(hour_now).items():
+            totals[uid] = totals.get(uid, 0) + amount
+    assert totals == usage_expected.totals(hour_now)
+
+
+def test_save_amounts_snapshot_on_the_hour():
+    dt_prev, dt = datetime(2024, 5, 1, 10, 30, tzinfo=timezone.utc), datetime(2024, 5, 1, 12, tzinfo=timezone.utc)
+    with pytest.raises(ZeroDivisionError):
+        save_amounts_per_user({}, UsageWindows(24), 'h1', 'user1-phone', dt_prev, dt, 3000, 300)
+
+    appr = AppRoot()
+    save_amounts_batch(appr, 'h1', dt_prev, dt, [('user1-phone', 3000, 300)])
+    assert dict(appr.tlog.items()) == {
+        (datetime(2024, 5, 1, 10, tzinfo=timezone.utc), 'h1', 'user1-phone'): (1000, 100),
+        (datetime(2024, 5, 1, 11, tzinfo=timezone.utc), 'h1', 'user1-phone'): (2000, 200),
+    }
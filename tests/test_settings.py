@@ -0,0 +1,35 @@
+import dataclasses
+import pytest
+
+# local imports
+from vpnsutils.settings import Settings
+
+
+def test_invalid_parameters_reported_at_init():
+    s = Settings()
+    with pytest.raises(ValueError, match='"snapshot_keyframe_interval".*"snapshot_save_binary"'):
+        s.init({'snapshot_keyframe_interval': 'ten', 'snapshot_save_binary': 'maybe'})
+
+
+def test_defaults_and_missing_parameters():
+    s = Settings()
+    with pytest.raises(RuntimeError):
+        _unused = s.xui_name
+
+    s.init({
+        'xui_name': 'umbrella', 'urls_traffic_snapshots': '\nhttp://a/\nhttp://b/\n', 'snapshot_fetch_binary': 'no'
+    })
+    assert s.xui_name == 'umbrella'
+    assert s.urls_traffic_snapshots == ['http://a/', 'http://b/']
+    assert s.snapshot_fetch_binary is False
+    assert s.dir_spool == '' and s.daemon_poll_interval == 300
+    with pytest.raises(ValueError, match='missing parameter "dir_report"'):
+        _unused = s.dir_report
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        s.xui_name = 'other'
+
+    s.load({'xui_name': 'other'})
+    assert s.xui_name == 'other'
+    with pytest.raises(ValueError):
+        _unused = s.urls_traffic_snapshots
+
@@ -0,0 +1,30 @@
+from datetime import datetime, timezone
+
+# local imports
+from vpnsutils.snapbin import BinarySnapshot, encode_snapshot, is_binary_snapshot
+
+DT = datetime(2024, 5, 1, 10, 0, 12, 345678, tzinfo=timezone.utc)
+DT_BASE = datetime(2024, 5, 1, 9, 0, 11, 1, tzinfo=timezone.utc)
+
+
+def test_roundtrip():
+    counters = {'ü@example.com': [2**63 + 5, 7], 'a@example.com': [1, 2], 'b': [0, 0]}
+    data = encode_snapshot(counters, DT)
+    assert is_binary_snapshot(data)
+
+    snap = BinarySnapshot(data, '__datetime', '__base')
+    assert snap['__datetime'] == DT.isoformat()
+    assert '__base' not in snap
+    assert snap['ü@example.com'] == (2**63 + 5, 7)
+    assert snap.get('missing') is None
+    assert dict(snap) == {'__datetime': DT.isoformat()} | {k: tuple(v) for k, v in counters.items()}
+
+
+def test_delta_and_changed_items():
+    prev = BinarySnapshot(encode_snapshot({'a': [1, 1], 'b': [2, 2], 'c': [3, 3]}, DT_BASE), '__datetime', '__base')
+    snap = BinarySnapshot(encode_snapshot({'a': [1, 1], 'b': [5, 2], 'c': [3, 3]}, DT, DT_BASE), '__datetime', '__base')
+    assert snap['__base'] == DT_BASE.isoformat()
+    assert list(snap.items_changed(prev)) == [('b', (5, 2))]
+
+    other = BinarySnapshot(encode_snapshot({'a': [1, 1], 'c': [4, 3]}, DT), '__datetime', '__base')
+    assert list(other.items_changed(prev)) == [('c', (4, 3))]
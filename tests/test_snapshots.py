@@ -0,0 +1,155 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+
+# module imports
+from helpers.misc import json_dumps
+
+# local imports
+from tests.snapserver import serve_snapshots
+from vpnsutils.makerep import TrafficStatsCollector
+from vpnsutils.snapbin import BinarySnapshot, encode_snapshot
+from vpnsutils.snapshots import MANIFEST_FILENAME, BUNDLE_FILENAME
+from vpnsutils.snapshots import manifest_record, parse_manifest, update_manifest, compact_days, read_bundle
+
+DT0 = datetime(2024, 5, 1, 10, 0, 0, 500000, tzinfo=timezone.utc)
+
+
+def save_snapshot(dir_snapshots, dt: datetime, stats: dict, binary: bool = False) -> dict:
+    path = f'{dt:%Y/%m/%d}/umbrella-{dt:%Y%m%d-%H%M%S}.json'
+    filepath = dir_snapshots.joinpath(path)
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    filepath.write_text(json_dumps(stats | {'__datetime': dt, '__comment': 'test'}), encoding='utf-8')
+    path_binary = None
+    if binary:
+        path_binary = path.replace('.json', '.bin')
+        dir_snapshots.joinpath(path_binary).write_bytes(encode_snapshot(stats, dt))
+    return manifest_record(path, dt, filepath.stat().st_size, path_binary)
+
+
+def test_manifest_seeded_then_appended(tmp_path):
+    records = [save_snapshot(tmp_path, DT0 + timedelta(hours=x), {'u1': [x, x]}) for x in range(3)]
+    update_manifest(tmp_path, records[-1:], filename_prefix='umbrella-', datetime_key='__datetime')
+    assert parse_manifest(tmp_path.joinpath(MANIFEST_FILENAME).read_bytes()) == records
+
+    record = save_snapshot(tmp_path, DT0 + timedelta(hours=3), {'u1': [3, 3]})
+    update_manifest(tmp_path, [record], filename_prefix='umbrella-', datetime_key='__datetime')
+    assert parse_manifest(tmp_path.joinpath(MANIFEST_FILENAME).read_bytes()) == records + [record]
+
+
+def test_parse_manifest_tail():
+    data = b'me": 1}\n{"path": "a", "datetime": "2024-05-01T10:00:00+00:00", "size": 1}\n'
+    assert parse_manifest(data, skip_first_line=True) == [
+        {'path': 'a', 'datetime': '2024-05-01T10:00:00+00:00', 'size': 1}
+    ]
+
+
+def collect(dir_snapshots, last_datetimes: dict) -> tuple[dict, list]:
+    """Run the collector against a local HTTP server, return snapshots collected and requests seen"""
+    requests_seen = []
+
+    async def run() -> dict:
+        async with serve_snapshots(dir_snapshots, requests_seen) as url:
+            collector = TrafficStatsCollector(urls=[url], last_datetimes=last_datetimes)
+            async with collector:
+                await collector.execute()
+            return collector.snapshots
+
+    return asyncio.run(run()), requests_seen
+
+
+def test_collector_finishes_before_deadline(override_settings, tmp_path):
+    records = [save_snapshot(tmp_path, DT0 + timedelta(hours=x), {'u1': [x, x]}) for x in range(3)]
+    update_manifest(tmp_path, records[-1:], filename_prefix='umbrella-', datetime_key='__datetime')
+    override_settings(collector_deadline='30')
+
+    async def run(duplicate: bool) -> TrafficStatsCollector:
+        async with serve_snapshots(tmp_path) as url:
+            collector = TrafficStatsCollector(urls=[url, url] if duplicate else [], last_datetimes={})
+            async with collector:
+                await collector.execute()
+            return collector
+
+    for duplicate in [False, True]:
+        collector = asyncio.run(asyncio.wait_for(run(duplicate), timeout=5))
+        assert len(collector.snapshots.get('127.0.0.1', {})) == (3 if duplicate else 0)
+        assert not collector.hosts_failed
+
+
+def test_collector_uses_manifest_tail(app, tmp_path):
+    _unused = app
+    records = [save_snapshot(tmp_path, DT0 + timedelta(hours=x), {'u1': [x, x]}) for x in range(200)]
+    update_manifest(tmp_path, records[-1:], filename_prefix='umbrella-', datetime_key='__datetime')
+
+    snapshots, requests_seen = collect(tmp_path, {'127.0.0.1': datetime.fromisoformat(records[-3]['datetime'])})
+    assert sorted(snapshots['127.0.0.1']) == [datetime.fromisoformat(x['datetime']) for x in records[-2:]]
+    assert requests_seen[0][0] == f'/snapshots/{MANIFEST_FILENAME}' and requests_seen[0][1]
+    assert len(requests_seen) == 3
+    assert json.loads(json_dumps(snapshots['127.0.0.1'][DT0 + timedelta(hours=199)]))['u1'] == [199, 199]
+
+
+def test_collector_uses_bundles(app, tmp_path):
+    _unused = app
+    records = [save_snapshot(tmp_path, DT0 + timedelta(hours=x), {'u1': [x, x]}) for x in range(40)]
+    update_manifest(tmp_path, records[-1:], filename_prefix='umbrella-', datetime_key='__datetime')
+    bundles = compact_days(tmp_path, 'umbrella-', '__datetime', date_before=(DT0 + timedelta(hours=39)).date())
+    update_manifest(tmp_path, bundles, filename_prefix='umbrella-', datetime_key='__datetime')
+    assert [x['path'] for x in bundles] == [f'2024/05/01/{BUNDLE_FILENAME}', f'2024/05/02/{BUNDLE_FILENAME}']
+    assert len(list(read_bundle(tmp_path.joinpath(bundles[0]['path'])))) == 14
+
+    snapshots, requests_seen = collect(tmp_path, {'127.0.0.1': datetime.fromisoformat(records[2]['datetime'])})
+    assert sorted(snapshots['127.0.0.1']) == [datetime.fromisoformat(x['datetime']) for x in records[3:]]
+    assert [x[0] for x in requests_seen].count(f'/snapshots/2024/05/01/{BUNDLE_FILENAME}') == 1
+    assert len(requests_seen) == 1 + 2 + 2  # the manifest, two bundles and two snapshots of the current day
+
+
+def test_collector_prefers_binary(app, tmp_path):
+    _unused = app
+    records = [save_snapshot(tmp_path, DT0 + timedelta(hours=x), {'u1': [x, x]}, binary=x > 0) for x in range(3)]
+    update_manifest(tmp_path, records[-1:], filename_prefix='umbrella-', datetime_key='__datetime')
+    tmp_path.joinpath(records[2]['binary']).unlink()  # falls back to json
+
+    snapshots, requests_seen = collect(tmp_path, {'127.0.0.1': datetime.fromisoformat(records[0]['datetime'])})
+    snaps = snapshots['127.0.0.1']
+    assert isinstance(snaps[DT0 + timedelta(hours=1)], BinarySnapshot)
+    assert snaps[DT0 + timedelta(hours=1)]['u1'] == (1, 1)
+    assert snaps[DT0 + timedelta(hours=2)]['u1'] == [2, 2]
+    assert len(requests_seen) == 1 + 1 + 2
+
+
+def test_collector_walk_skips_files_being_written(app, tmp_path):
+    _unused = app
+    records = [save_snapshot(tmp_path, DT0 + timedelta(hours=x), {'u1': [x, x]}) for x in range(3)]
+    path_day = tmp_path.joinpath(records[0]['path']).parent
+    for filename in [f'{BUNDLE_FILENAME}.tmp', 'umbrella-20240501-130000.bin.tmp', 'umbrella-20240501-130000.json.tmp']:
+        path_day.joinpath(filename).write_bytes(b'')
+
+    snapshots, _requests_seen = collect(tmp_path, {})  # there is no manifest, the directory tree is walked
+    assert sorted(snapshots['127.0.0.1']) == [datetime.fromisoformat(x['datetime']) for x in records]
+
+
+def test_collector_caches_listings(override_settings, tmp_path):
+    dir_snapshots = tmp_path.joinpath('snapshots')
+    records = [save_snapshot(dir_snapshots, DT0 + timedelta(hours=x), {'u1': [x, x]}) for x in range(30)]
+    override_settings(dir_listing_cache=str(tmp_path.joinpath('cache')))
+    last_datetimes = {'127.0.0.1': datetime.fromisoformat(records[20]['datetime'])}
+    requests_seen = []
+
+    async def run() -> list[TrafficStatsCollector]:
+        collectors = []
+        async with serve_snapshots(dir_snapshots, requests_seen) as url:
+            for _ in range(2):
+                collectors.append(TrafficStatsCollector(urls=[url], last_datetimes=last_datetimes))
+                async with collectors[-1]:
+                    await collectors[-1].execute()
+                requests_seen.append(('-', None))
+        return collectors
+
+    collectors = asyncio.run(run())
+    assert [len(x.snapshots['127.0.0.1']) for x in collectors] == [9, 9]
+    listings = [x[0] for x in requests_seen if not x[0].endswith('.json')]
+    assert listings.index('-') == 5  # the manifest, the root, year, month and day listings
+
+    # listings of the past days are final and used from the cache, the root listing is revalidated
+    assert listings[6:] == [f'/snapshots/{MANIFEST_FILENAME}', '/snapshots', '-']
+    assert collectors[1].num_listings_cached == 3 and collectors[1].num_listings_not_modified == 1
@@ -0,0 +1,64 @@
+import asyncio
+import py3xui
+from types import SimpleNamespace
+
+# local imports
+from vpnsutils import snapstat
+from vpnsutils.snapshots import MANIFEST_FILENAME, parse_manifest
+from vpnsutils.snapstat import StatsDaemon, next_sample_time
+
+
+class FakeApi:
+    """3X-UI API client whose session expires after the given number of requests"""
+    num_logins = 0
+
+    def __init__(self, *_args, session_requests: int = 2):
+        self.session_requests = session_requests
+        self.num_requests = 0
+        self.inbound = SimpleNamespace(get_list=self.get_list)
+
+    def login(self):
+        FakeApi.num_logins += 1
+        self.num_requests = 0
+
+    def get_list(self):
+        self.num_requests += 1
+        if self.num_requests > self.session_requests:
+            raise ValueError('Response status is not successful, message: None')
+        client_stats = [SimpleNamespace(email=f'u{x}', down=x * self.num_requests, up=x) for x in range(3)]
+        return [SimpleNamespace(client_stats=client_stats)]
+
+
+def test_next_sample_time():
+    assert next_sample_time(3600 * 5 + 10, 900) == 3600 * 5 + 900
+    assert next_sample_time(3600 * 5, 900) == 3600 * 5 + 900
+    assert next_sample_time(3600 * 5 - 0.5, 3600) == 3600 * 5
+
+
+def test_stats_daemon_keeps_session(override_settings, tmp_path, monkeypatch):
+    override_settings(
+        xui_url='http://127.0.0.1/', xui_username='admin', xui_password='pass',
+        dir_snapshots=str(tmp_path), daemon_sample_interval='0.1',
+        snapshot_filename_suffix_format='%Y%m%d-%H%M%S-%f.json',
+    )
+    time_checks = []
+    monkeypatch.setattr(snapstat, 'verify_time_is_correct', lambda **kwargs: time_checks.append(1) or 0.001)
+    monkeypatch.setattr(py3xui, 'Api', FakeApi)
+    monkeypatch.setattr(FakeApi, 'num_logins', 0)
+
+    async def run():
+        daemon = StatsDaemon()
+        task = asyncio.create_task(daemon.run())
+        for _ in range(100):
+            if tmp_path.joinpath(MANIFEST_FILENAME).exists():
+                if len(parse_manifest(tmp_path.joinpath(MANIFEST_FILENAME).read_bytes())) >= 5:
+                    break
+            await asyncio.sleep(0.05)
+        daemon.stop()
+        await task
+
+    asyncio.run(run())
+    records = parse_manifest(tmp_path.joinpath(MANIFEST_FILENAME).read_bytes())
+    assert len(records) >= 5
+    assert FakeApi.num_logins == (len(records) + 1) // 2  # logged in again only after the session has expired
+    assert time_checks == [1]
@@ -0,0 +1,40 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+DIR_ROOT = Path(__file__).parent.parent
+
+
+def import_times(module: str) -> dict[str, int]:
+    """
+    Import the module in a fresh interpreter with -X importtime.
+    @return: name => cumulative import time, microseconds, for every module imported.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=DIR_ROOT, capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _self, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+# the import time bounds are about ten times the times measured on a development machine, generous enough
+# for a loaded CI machine, and still catching a heavy dependency imported at startup
+@pytest.mark.parametrize('module, heavy, max_ms', [
+    ('vpnsutils.checktime', ['pyramid', 'ZODB', 'aiohttp', 'requests', 'jsonpickle', 'py3xui'], 300),
+    ('vpnsutils.snapstat', ['pyramid', 'ZODB', 'aiohttp', 'jsonpickle', 'py3xui'], 300),
+    ('vpnsutils.makerep', ['pyramid', 'pyramid_zodbconn', 'jsonpickle', 'py3xui'], 2000),
+    ('vpnsutils.dbmaint', ['pyramid', 'pyramid_zodbconn', 'aiohttp', 'jsonpickle', 'py3xui'], 600),
+])
+def test_console_script_imports(module, heavy, max_ms):
+    times = import_times(module)
+    assert module in times
+    assert [x for x in heavy if x in times] == []
+    assert times[module] / 1000 < max_ms, f'{module} imported in {times[module] / 1000:.1f} ms'
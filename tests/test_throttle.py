@@ -0,0 +1,57 @@
+import asyncio
+import pytest
+
+# local imports
+from vpnsutils.throttle import AdaptiveLimiter, CircuitBreaker, HostUnavailableError
+
+
+def test_limiter_grows_on_success_and_halves_on_errors():
+    async def run():
+        limiter = AdaptiveLimiter(limit_max=8, limit_initial=2)
+        for _ in range(50):
+            await limiter.acquire()
+            await limiter.release(latency=0.01)
+        assert int(limiter.limit) == 8
+
+        await limiter.acquire()
+        await limiter.release(latency=None)
+        assert int(limiter.limit) == 4
+
+        await limiter.acquire()
+        await limiter.release(latency=0.1)  # ten times slower than the best one
+        assert int(limiter.limit) == 2
+
+    asyncio.run(run())
+
+
+def test_limiter_bounds_concurrency():
+    async def run() -> int:
+        limiter = AdaptiveLimiter(limit_max=3, limit_initial=3)
+        in_flight_max = 0
+
+        async def request():
+            nonlocal in_flight_max
+            await limiter.acquire()
+            in_flight_max = max(in_flight_max, limiter.in_flight)
+            await asyncio.sleep(0.001)
+            await limiter.release(latency=0.001)
+
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(20):
+                tg.create_task(request())
+        return in_flight_max
+
+    assert asyncio.run(run()) == 3
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failures_max=3)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+    breaker.check('h1')
+    breaker.failure()
+    with pytest.raises(HostUnavailableError):
+        breaker.check('h1')
@@ -0,0 +1,250 @@
+import random
+import pytest
+import transaction
+import ZEO
+import ZODB
+import zodburi
+from ZODB.FileStorage import FileStorage
+from datetime import datetime, timedelta, timezone
+# noinspection PyUnresolvedReferences
+from BTrees.OOBTree import OOBTree
+
+# module imports
+from zmodels import tcm, get_app_root
+from zmodels.misc import epoch_hour, epoch_hour_to_datetime
+from zmodels.issues import IssueLog
+from zmodels.tlog import TrafficLog
+from zmodels.usage import UsageWindows
+from vpnsutils.dbmaint import migrate_tlog, rollup_tlog, pack_db, compress_db
+
+
+def test_issue_log_aggregates_and_prunes():
+    dt = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    issues = IssueLog()
+    for i in range(5):
+        issues.add('snapshots_missed', f'missed {i}', dt + timedelta(hours=i), count=3)
+        issues.add('collection_failed', f'failed {i}', dt + timedelta(hours=i, minutes=1), detail=f'error {i % 2}')
+    assert len(issues) == 3
+    assert [x.message for x in issues.recent()] == ['failed 4', 'missed 4', 'failed 3']
+    assert [x.message for x in issues.recent(since=dt + timedelta(hours=4))] == ['failed 4', 'missed 4']
+    missed = next(x for x in issues.recent() if x.kind == 'snapshots_missed')
+    assert missed.count == 15 and missed.describe() == 'missed 4 (total 15 since 2024-05-01 00:00)'
+
+    assert issues.prune(before=dt + timedelta(hours=3, minutes=30), max_entries=10) == 1
+    assert issues.prune(before=dt, max_entries=1) == 1
+    assert [x.message for x in issues.recent()] == ['failed 4']
+    assert list(issues.entries) == [('collection_failed', 'error 0')]
+
+
+def test_usage_windows_match_full_scan():
+    rnd = random.Random(1)
+    num_hours = 24
+    usage = UsageWindows(num_hours=num_hours)
+    records = []
+    hour = 1000
+    for _ in range(2000):
+        hour += rnd.choice([0, 0, 0, 1, 1, 2, 30])
+        record_hour = hour - rnd.choice([0, 0, 1, 5, 23, 24, 40])  # some amounts arrive for earlier hours
+        user_id = f'user{rnd.randrange(5)}'
+        amount = rnd.randrange(1000)
+        usage.add(record_hour, user_id, amount)
+        records.append((record_hour, user_id, amount))
+
+        hour_now = hour + rnd.choice([0, 0, 3, 25])
+        expected = {}
+        for h, u, a in records:
+            if hour_now - num_hours < h <= hour_now and h > usage.users[u].hour_last - num_hours:
+                expected[u] = expected.get(u, 0) + a
+        assert usage.totals(hour_now) == {k: v for k, v in expected.items() if v}
+
+    assert usage.expire(hour + 100) == 5
+    assert not usage.users
+
+
+def test_tlog_migration():
+    db = ZODB.DB(None)
+    conn = db.open(transaction_manager=transaction.TransactionManager(explicit=True))
+    rnd = random.Random(2)
+    hour_start = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    legacy = {}
+    for _ in range(500):
+        key = hour_start + timedelta(hours=rnd.randrange(100)), f'host{rnd.randrange(3)}', f'user{rnd.randrange(20)}'
+        legacy[key] = rnd.randrange(1000), rnd.choice([0, rnd.randrange(1000)])
+
+    with tcm.in_transaction(conn):
+        appr = get_app_root(conn)
+        appr.tlog = OOBTree(legacy)
+
+    assert migrate_tlog(conn, batch_size=64) == len(legacy)
+    with tcm.in_transaction(conn):
+        appr = get_app_root(conn)
+        assert isinstance(appr.tlog, TrafficLog)
+        assert appr.tlog_migrating is None
+        assert dict(appr.tlog.items()) == legacy
+        hour_min = hour_start + timedelta(hours=50, minutes=1)
+        assert dict(appr.tlog.items(hour_min=hour_min)) == {
+            k: v for k, v in legacy.items() if k[0] >= hour_start + timedelta(hours=51)
+        }
+
+    assert migrate_tlog(conn, batch_size=64) == 0
+    conn.close()
+    db.close()
+
+
+def test_tlog_rollup(override_settings):
+    override_settings(tlog_hourly_retention_days='10', tlog_daily_retention_days='40')
+    db = ZODB.DB(None)
+    conn = db.open(transaction_manager=transaction.TransactionManager(explicit=True))
+    rnd = random.Random(3)
+    now = datetime(2024, 9, 15, 12, 30, tzinfo=timezone.utc)
+    hour_start = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    records = []
+    with tcm.in_transaction(conn):
+        tlog = get_app_root(conn).tlog
+        for hour in range(epoch_hour(hour_start), epoch_hour(now) + 1):
+            for _ in range(rnd.randrange(4)):
+                hostname, user_id, am_down = f'host{rnd.randrange(2)}', f'user{rnd.randrange(20)}', rnd.randrange(1000)
+                tlog.host(hostname).add(hour, user_id, am_down, 1)
+                records.append((hour, hostname, user_id, am_down, 1))
+
+    def expected(dt_min: datetime, dt_max: datetime = None) -> dict[str, tuple[int, int]]:
+        totals = {}
+        for hour, _hostname, user_id, am_down, am_up in records:
+            if hour >= epoch_hour(dt_min) and (dt_max is None or hour <= epoch_hour(dt_max)):
+                am_down_total, am_up_total = totals.get(user_id, (0, 0))
+                totals[user_id] = am_down_total + am_down, am_up_total + am_up
+        return totals
+
+    num_rolled_up = rollup_tlog(conn, batch_size=50, now=now)
+    assert num_rolled_up['hourly'] > num_rolled_up['daily'] > 0
+    assert rollup_tlog(conn, batch_size=50, now=now) == {'hourly': 0, 'daily': 0}
+
+    with tcm.in_transaction(conn):
+        tlog = get_app_root(conn).tlog
+        host_tlog = tlog.hosts['host0']
+        assert epoch_hour(now) - host_tlog.hours.minKey() < 11 * 24
+        assert host_tlog.months.keys()[-1] == host_tlog.months.keys()[0] + 2  # May to July
+        for month in [5, 7, 9]:
+            dt_min = datetime(2024, month, 1, tzinfo=timezone.utc)
+            assert tlog.totals(hour_min=dt_min) == expected(dt_min)
+        # ranges beginning and ending mid-month: exact where they cut no rolled up bucket, widened where they do
+        for dt_min, dt_max in [
+            (datetime(2024, 6, 1, tzinfo=timezone.utc), datetime(2024, 8, 17, 23, tzinfo=timezone.utc)),
+            (datetime(2024, 8, 10, tzinfo=timezone.utc), datetime(2024, 9, 10, 17, tzinfo=timezone.utc)),
+            (datetime(2024, 9, 6, 3, tzinfo=timezone.utc), datetime(2024, 9, 12, 5, tzinfo=timezone.utc)),
+        ]:
+            assert tlog.span(dt_min, dt_max) == (dt_min, dt_max)
+            assert tlog.totals(hour_min=dt_min, hour_max=dt_max) == expected(dt_min, dt_max)
+        for (dt_min, dt_max), (span_min, span_max) in [
+            ((datetime(2024, 6, 15, tzinfo=timezone.utc), None), (datetime(2024, 6, 1, tzinfo=timezone.utc), None)),
+            (
+                (datetime(2024, 5, 1, tzinfo=timezone.utc), datetime(2024, 6, 20, tzinfo=timezone.utc)),
+                (datetime(2024, 5, 1, tzinfo=timezone.utc), datetime(2024, 6, 30, 23, tzinfo=timezone.utc)),
+            ),
+            (
+                (datetime(2024, 8, 10, 5, tzinfo=timezone.utc), datetime(2024, 9, 1, 5, tzinfo=timezone.utc)),
+                (datetime(2024, 8, 10, tzinfo=timezone.utc), datetime(2024, 9, 1, 23, tzinfo=timezone.utc)),
+            ),
+        ]:
+            assert tlog.span(dt_min, dt_max) == (span_min, span_max)
+            assert tlog.totals(hour_min=dt_min, hour_max=dt_max) == expected(span_min, span_max)
+        num_buckets = sum(1 for x in tlog.hosts.values() for _ in x.buckets((epoch_hour(now) // 24 - 45) * 24))
+        assert num_buckets < 2 * (2 + 30 + 10 * 24)
+
+    conn.close()
+    db.close()
+
+
+def test_tlog_rolling_range_over_rolled_up_tiers():
+    rnd = random.Random(5)
+    tlog = TrafficLog()
+    h_now = epoch_hour(datetime(2024, 9, 15, 12, 30, tzinfo=timezone.utc))
+    records = []
+    for hour in range(h_now - 120 * 24, h_now + 1):
+        user_id, am_down = f'user{rnd.randrange(10)}', rnd.randrange(1000)
+        tlog.host(f'host{rnd.randrange(2)}').add(hour, user_id, am_down, 1)
+        records.append((hour, user_id, am_down))
+    for host_tlog in tlog.hosts.values():
+        while host_tlog.roll_up_hours(h_now - 31 * 24, 1000):
+            pass
+        while host_tlog.roll_up_days(h_now - 60 * 24, 1000):
+            pass
+
+    def expected(h_min: int, h_max: int) -> dict[str, tuple[int, int]]:
+        totals = {}
+        for hour, user_id, am_down in records:
+            if h_min <= hour <= h_max:
+                am_down_total, am_up_total = totals.get(user_id, (0, 0))
+                totals[user_id] = am_down_total + am_down, am_up_total + 1
+        return totals
+
+    for days, span_min in [
+        (30, datetime(2024, 8, 16, 13, tzinfo=timezone.utc)),  # within the hourly tier
+        (45, datetime(2024, 8, 1, tzinfo=timezone.utc)),  # mid-day within the daily tier
+        (90, datetime(2024, 6, 1, tzinfo=timezone.utc)),  # mid-month within the monthly tier
+    ]:
+        dt_min, dt_max = epoch_hour_to_datetime(h_now - days * 24 + 1), epoch_hour_to_datetime(h_now)
+        assert tlog.span(dt_min, dt_max) == (span_min, dt_max)
+        assert tlog.totals(dt_min, dt_max) == expected(epoch_hour(span_min), h_now)
+
+@pytest.mark.parametrize('via_zeo', [False, True])
+def test_pack(tmp_path, via_zeo):
+    path = str(tmp_path.joinpath('Data.fs'))
+    db = ZODB.DB(FileStorage(path))
+    conn = db.open(transaction_manager=transaction.TransactionManager(explicit=True))
+    for i in range(20):
+        with tcm.in_transaction(conn):
+            get_app_root(conn).issues = OOBTree({datetime(2024, 5, 1, tzinfo=timezone.utc): f'issue {i}' * 1000})
+    conn.close()
+    db.close()
+
+    if via_zeo:
+        address, stop = ZEO.server(path=path)
+        db = ZEO.DB(address)
+    else:
+        db, stop = ZODB.DB(FileStorage(path)), None
+    try:
+        stats = pack_db(db, days=0)
+    finally:
+        db.close()
+        if stop:
+            stop()
+
+    assert stats['objects_after'] < stats['objects_before']
+    assert stats['size_after'] < stats['size_before'] / 5
+    assert stats['seconds'] >= 0
+
+
+def test_compress_in_place(tmp_path):
+    path = tmp_path.joinpath('Data.fs')
+    db = ZODB.DB(FileStorage(str(path)))
+    conn = db.open(transaction_manager=transaction.TransactionManager(explicit=True))
+    with tcm.in_transaction(conn):
+        tlog = get_app_root(conn).tlog
+        for hour in range(1000, 1100):
+            tlog.host('umbrella.example.com').add_many(hour, [(f'user{x}@example.com', x, 1) for x in range(50)])
+    with tcm.in_transaction(conn):
+        expected = list(get_app_root(conn).tlog.items())
+    conn.close()
+    db.close()
+    size_uncompressed = path.stat().st_size
+
+    storage_factory, dbkw = zodburi.resolve_uri(f'zlibfile://{path}?connection_cache_size=100')
+    db = ZODB.DB(storage_factory(), **dbkw)
+    conn = db.open(transaction_manager=transaction.TransactionManager(explicit=True))
+    with tcm.in_transaction(conn):
+        assert list(get_app_root(conn).tlog.items()) == expected  # the uncompressed records are readable
+    stats = compress_db(conn, batch_size=20, days=0)
+    with tcm.in_transaction(conn):
+        assert list(get_app_root(conn).tlog.items()) == expected
+    conn.close()
+    db.close()
+
+    assert stats['size_after'] == path.stat().st_size < size_uncompressed * 0.8
+
+    db = ZODB.DB(FileStorage(str(tmp_path.joinpath('Plain.fs'))))
+    conn = db.open(transaction_manager=transaction.TransactionManager(explicit=True))
+    with pytest.raises(RuntimeError, match='not compressed'):
+        compress_db(conn, batch_size=20, days=0)
+    conn.close()
+    db.close()
@@ -1,16 +1,17 @@
 import atexit
 import logging
-import pyramid.config
-import pyramid_zodbconn
-import pyramid_tm
-import ZODB
 import sys
 import os
 import signal
+from typing import TYPE_CHECKING
 
 # module imports
-import zmodels
-import helpers.misc
+from helpers.misc import xdescr
+
+# Pyramid, pyramid_zodbconn and ZODB are imported where used: every console script imports this package,
+# while only the web application needs them
+if TYPE_CHECKING:
+    import ZODB
 
 log = logging.getLogger(__name__)
 
@@ -18,18 +19,23 @@ log = logging.getLogger(__name__)
 def root_factory(request):
     """ This function is called on every web request
     """
+    import pyramid_zodbconn
+    import zmodels
     conn = pyramid_zodbconn.get_connection(request)
     return zmodels.get_app_root(conn)
 
 
 # contains all ZODB database objects created by pyramid_zodbconn
-_zodbconn_databases: dict[str, ZODB.DB] | None = None
+_zodbconn_databases: dict[str, 'ZODB.DB'] | None = None
 
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
-    _unused = global_config
+    import pyramid.config
+    import pyramid_tm
+    import zmodels  # forces explicit transactions in the main thread
+    _unused = global_config, zmodels
 
     # force explicit transactions in waitress sub-threads
     # see: https://docs.pylonsproject.org/projects/pyramid_tm/en/latest/index.html#custom-transaction-managers
@@ -60,6 +66,7 @@ def main(global_config, **settings):
 @atexit.register
 def zodb_close():
     if _zodbconn_databases:
+        import pyramid_zodbconn
         log.info('closing all ZODB database objects created by pyramid_zodbconn tween')
         for db in _zodbconn_databases.values():
             try:
@@ -89,4 +96,4 @@ def _sigint_handler(_sig, _frame):
 try:
     signal.signal(signal.SIGINT, _sigint_handler)
 except ValueError as ex_:
-    print(f'Cannot set signal handler: {helpers.misc.xdescr(ex_)}, ignoring')
+    print(f'Cannot set signal handler: {xdescr(ex_)}, ignoring')
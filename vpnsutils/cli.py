@@ -0,0 +1,59 @@
+"""
+Lightweight environment of the console scripts: reads the settings from the ini-file and opens the database
+only if the command needs it, without building the Pyramid WSGI application as pyramid.paster.bootstrap does.
+"""
+
+import contextlib
+import logging
+from collections.abc import Iterator
+from typing import TYPE_CHECKING
+
+# local imports
+from .settings import settings
+
+if TYPE_CHECKING:
+    from ZODB.Connection import Connection
+
+log = logging.getLogger(__name__)
+
+
+def setup_logging(config_uri: str):
+    """Configure logging from the ini-file, same as pyramid.paster.setup_logging"""
+    import plaster
+    plaster.get_loader(config_uri, protocols=['wsgi']).setup_logging({})
+
+
+@contextlib.contextmanager
+def cli_env(config_uri: str, open_db: bool = False) -> Iterator['Connection | None']:
+    """
+    Initialize the application settings from the ini-file.
+    @param config_uri: the URI to the configuration file.
+    @param open_db: open the database configured by zodbconn.uri, closed on exit.
+    @return: context manager yielding a connection with an explicit transaction manager, None if open_db is false.
+    """
+    import plaster
+    settings_dict = plaster.get_loader(config_uri, protocols=['wsgi']).get_wsgi_app_settings()
+    settings.init(settings_dict)
+    if not open_db:
+        yield None
+        return
+
+    import transaction
+    from ZODB import DB
+    from zodburi import resolve_uri
+    from zmodels import tcm
+
+    storage_factory, dbkw = resolve_uri(settings_dict['zodbconn.uri'])
+    db = DB(storage_factory(), **dbkw)
+    try:
+        conn = db.open(transaction_manager=transaction.TransactionManager(explicit=True))
+        try:
+            yield conn
+
+        finally:
+            if tcm.has_transaction(cot=conn.transaction_manager):
+                conn.transaction_manager.abort()
+            conn.close()
+
+    finally:
+        db.close()
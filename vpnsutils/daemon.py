@@ -0,0 +1,32 @@
+"""
+Helpers for the resident (daemon) modes of the console scripts.
+"""
+
+import asyncio
+import logging
+import signal
+from collections.abc import Callable
+
+log = logging.getLogger(__name__)
+
+
+def install_stop_handlers(stop: Callable[[], None]):
+    """Call the given function on SIGTERM or SIGINT instead of terminating the process, where supported"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop)
+        except (NotImplementedError, RuntimeError) as ex:
+            log.debug(f'cannot set {sig.name} handler: {ex}, ignoring')  # e.g. on Windows
+
+
+async def sleep_unless(event: asyncio.Event, timeout: float) -> bool:
+    """
+    Sleep for the given time or until the event is set.
+    @return: True if the event is set.
+    """
+    try:
+        await asyncio.wait_for(event.wait(), timeout=max(0.0, timeout))
+        return True
+    except TimeoutError:
+        return event.is_set()
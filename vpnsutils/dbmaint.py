@@ -0,0 +1,245 @@
+import argparse
+import itertools
+import logging
+import time
+from datetime import datetime
+from ZODB import DB
+from ZODB.Connection import Connection
+from suid import utcnow
+
+# module import
+from helpers.misc import xdescr, json_dumps
+from zmodels import tcm, get_app_root
+from zmodels.misc import epoch_hour
+from zmodels.tlog import TrafficLog, HostTrafficLog
+
+# local imports
+from .settings import settings
+from .cli import cli_env, setup_logging
+from . import sys_exit
+
+log = logging.getLogger(__name__)
+
+URI_CONFIG_DEFAULT = 'config/makerep.ini'
+BATCH_SIZE_DEFAULT = 10000;  """Number of records to process in a single transaction"""
+
+
+def migrate_tlog(conn: Connection, batch_size: int) -> int:
+    """
+    Convert the legacy traffic log, a single OOBTree keyed by (hour, hostname, user_id), to TrafficLog.
+    Records are copied in batches, each batch in its own transaction; an interrupted migration resumes
+    from the last committed batch. The legacy traffic log is replaced when all records are copied.
+    @return: number of records copied.
+    """
+    num_copied = 0
+    while True:
+        with tcm.in_transaction(conn, note='dbmaint migrate'):
+            appr = get_app_root(conn)
+            if isinstance(appr.tlog, TrafficLog):
+                log.info(f'the traffic log has the current layout')
+                return num_copied
+
+            if appr.tlog_migrating is None:
+                log.info(f'starting migration of the traffic log')
+                appr.tlog_migrating = TrafficLog()
+                appr.tlog_migrated_key = None
+
+            key = appr.tlog_migrated_key
+            # noinspection PyArgumentList
+            items = appr.tlog.items(min=key, excludemin=True) if key else appr.tlog.items()
+            batch = list(itertools.islice(items, batch_size))
+            for (hour, hostname, user_id), (am_down, am_up) in batch:
+                appr.tlog_migrating.add(hour, hostname, user_id, am_down, am_up)
+
+            if batch:
+                appr.tlog_migrated_key = batch[-1][0]
+                num_copied += len(batch)
+                log.info(f'copied {num_copied} records, up to {batch[-1][0][0]:%Y-%m-%d %H:%M}')
+            else:
+                log.info(f'all records copied, replacing the traffic log')
+                appr.tlog = appr.tlog_migrating
+                appr.tlog_migrating = None
+                appr.tlog_migrated_key = None
+                return num_copied
+
+        conn.cacheMinimize()  # keep memory usage flat regardless of the traffic log size
+
+
+def rollup_tlog(conn: Connection, batch_size: int, now: datetime = None) -> dict[str, int]:
+    """
+    Roll up the hourly traffic log records older than settings.tlog_hourly_retention_days into daily ones,
+    and the daily records older than settings.tlog_daily_retention_days into monthly ones; the rolled up
+    records are dropped. Every batch is rolled up and dropped in its own transaction, so an interrupted rollup
+    never counts traffic twice and resumes where it stopped.
+    @return: tier ('hourly', 'daily') => number of records rolled up.
+    """
+    hours_retention = settings.tlog_hourly_retention_days * 24
+    if hours_retention < settings.report_window_hours:
+        raise ValueError(
+            f'tlog_hourly_retention_days={settings.tlog_hourly_retention_days} is shorter than the report window, '
+            f'the usage aggregates are built from the hourly records'
+        )
+    if settings.tlog_daily_retention_days < settings.tlog_hourly_retention_days:
+        raise ValueError(f'tlog_daily_retention_days must not be less than tlog_hourly_retention_days')
+
+    hour_now = epoch_hour(now or utcnow())
+    tiers = [
+        ('hourly', HostTrafficLog.roll_up_hours, hour_now - hours_retention),
+        ('daily', HostTrafficLog.roll_up_days, hour_now - settings.tlog_daily_retention_days * 24),
+    ]
+    with tcm.in_transaction(conn, note='dbmaint rollup'):
+        appr = get_app_root(conn)
+        if not isinstance(appr.tlog, TrafficLog):
+            raise RuntimeError(f'the traffic log has the legacy layout, run "dbmaint migrate" first')
+        hostnames = list(appr.tlog.hosts)
+
+    num_rolled_up = {}
+    for tier, roll_up, hour_before in tiers:
+        num_rolled_up[tier] = 0
+        for hostname in hostnames:
+            while True:
+                with tcm.in_transaction(conn, note=f'dbmaint rollup: {hostname}'):
+                    num = roll_up(get_app_root(conn).tlog.hosts[hostname], hour_before, batch_size)
+                conn.cacheMinimize()  # keep memory usage flat regardless of the traffic log size
+                if not num:
+                    break
+                num_rolled_up[tier] += num
+                log.info(f'{hostname}: rolled up {num} {tier} records')
+
+        log.info(f'rolled up {num_rolled_up[tier]} {tier} records in total')
+
+    return num_rolled_up
+
+
+def pack_db(db: DB, days: float) -> dict:
+    """
+    Pack the database: remove the non-current object revisions older than the given number of days and the objects
+    not reachable any more. Works on a FileStorage directly and through ZEO, where the server packs its storage.
+    @return: storage statistics: size, bytes, and number of objects before and after the pack, pack duration, seconds.
+    """
+    stats = {'size_before': db.getSize(), 'objects_before': db.objectCount()}
+    log.info(f'packing the database, keeping {days} days of history: {db.getName()}')
+    time_start = time.monotonic()
+    db.pack(days=days)
+    stats['seconds'] = round(time.monotonic() - time_start, 3)
+    stats |= {'size_after': db.getSize(), 'objects_after': db.objectCount()}
+    log.info(f'packed: {json_dumps(stats, indent=False)}')
+    return stats
+
+
+def compress_db(conn: Connection, batch_size: int, days: float) -> dict:
+    """
+    Convert the database to compressed records in place, once the storage is configured with compression:
+    the current revision of every object stored uncompressed is rewritten, each batch in its own transaction,
+    then the database is packed, removing the uncompressed revisions older than the given number of days.
+    Through ZEO, the server storage is expected to be compressed, and all objects are rewritten.
+    @return: pack statistics, as returned by pack_db().
+    """
+    from zc.zlibstorage import ZlibStorage
+    from ZEO.ClientStorage import ClientStorage
+
+    db = conn.db()
+    storage = db.storage
+    if isinstance(storage, ZlibStorage):
+        storage_raw = storage.base;  """Records as stored, to skip the compressed ones"""
+    elif isinstance(storage, ClientStorage):
+        storage_raw = storage
+        log.info(f'the storage is remote, rewriting all objects; the ZEO server storage must be compressed')
+    else:
+        raise RuntimeError(f'the storage is not compressed, configure a zlibfile:// URI first: {db.getName()}')
+
+    num_rewritten = 0
+    next_oid = None
+    while True:
+        oids = []
+        while len(oids) < batch_size:
+            oid, _tid, data, next_oid = storage_raw.record_iternext(next_oid)
+            if storage_raw is storage or data[:2] != b'.z':
+                oids.append(oid)
+            if next_oid is None:
+                break
+
+        with tcm.in_transaction(conn, note='dbmaint compress'):
+            for oid in oids:
+                obj = conn.get(oid)
+                obj._p_activate()
+                obj._p_changed = True
+        num_rewritten += len(oids)
+        log.info(f'rewritten {num_rewritten} objects')
+        conn.cacheMinimize()  # keep memory usage flat regardless of the database size
+        if next_oid is None:
+            break
+
+    return pack_db(db, days=days)
+
+
+def main():
+    try:
+        parser = argparse.ArgumentParser(
+            description='Database maintenance commands.'
+        )
+        parser.add_argument(
+            'config_uri', default=URI_CONFIG_DEFAULT, nargs='?',
+            help=f'The URI to the configuration file. Defaults to "{URI_CONFIG_DEFAULT}"'
+        )
+        subparsers = parser.add_subparsers(dest='command', required=True)
+        parser_migrate = subparsers.add_parser(
+            'migrate', help='Convert the traffic log to the current layout, in batches.'
+        )
+        parser_migrate.add_argument(
+            '--batch-size', type=int, default=BATCH_SIZE_DEFAULT,
+            help=f'Number of records to copy in a single transaction. Defaults to {BATCH_SIZE_DEFAULT}'
+        )
+        parser_rollup = subparsers.add_parser(
+            'rollup', help='Roll up the old hourly traffic log records into daily ones, and daily into monthly ones.'
+        )
+        parser_rollup.add_argument(
+            '--batch-size', type=int, default=BATCH_SIZE_DEFAULT,
+            help=f'Number of records to roll up in a single transaction. Defaults to {BATCH_SIZE_DEFAULT}'
+        )
+        parser_pack = subparsers.add_parser(
+            'pack', help='Pack the database, removing the old history; schedule it daily or weekly.'
+        )
+        parser_pack.add_argument(
+            '--days', type=float, default=None,
+            help='Days of history to keep. Defaults to the zodb_pack_days setting.'
+        )
+        parser_compress = subparsers.add_parser(
+            'compress', help='Rewrite the objects stored uncompressed, once the storage is configured with compression.'
+        )
+        parser_compress.add_argument(
+            '--batch-size', type=int, default=BATCH_SIZE_DEFAULT,
+            help=f'Number of objects to rewrite in a single transaction. Defaults to {BATCH_SIZE_DEFAULT}'
+        )
+        parser_compress.add_argument(
+            '--days', type=float, default=None,
+            help='Days of history to keep when packing afterwards. Defaults to the zodb_pack_days setting.'
+        )
+        args = parser.parse_args()
+
+        # setup logging from config file settings
+        setup_logging(args.config_uri)
+
+        # read the configuration and open the database
+        with cli_env(args.config_uri, open_db=True) as conn:
+            if args.command == 'migrate':
+                migrate_tlog(conn, batch_size=args.batch_size)
+            elif args.command == 'rollup':
+                rollup_tlog(conn, batch_size=args.batch_size)
+            elif args.command == 'pack':
+                pack_db(conn.db(), days=settings.zodb_pack_days if args.days is None else args.days)
+            elif args.command == 'compress':
+                days = settings.zodb_pack_days if args.days is None else args.days
+                compress_db(conn, batch_size=args.batch_size, days=days)
+
+    except KeyboardInterrupt as ex:
+        print(f'{xdescr(ex)}')
+        sys_exit(130)
+
+    except Exception as ex:
+        log.error(f'{xdescr(ex)}')
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
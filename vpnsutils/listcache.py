@@ -0,0 +1,79 @@
+"""
+On-disk cache of the directory listings fetched by makerep, revalidated with conditional GET requests.
+"""
+
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+from pathlib import Path
+from suid import utcnow
+
+# module import
+from helpers.misc import json_dumps
+
+log = logging.getLogger(__name__)
+
+IMMUTABLE_GRACE = timedelta(days=1);  """A finished day directory still gets the bundle of the day after it ends"""
+
+
+class ListingCache:
+    """
+    Directory listings keyed by URL, stored along with the ETag and Last-Modified response headers.
+    A listing of a directory fetched well after the period the directory stands for has ended never changes,
+    such listings are used without revalidation.
+    """
+    def __init__(self, dir_cache: Path):
+        self.dir_cache = dir_cache
+        self.dir_cache.mkdir(parents=True, exist_ok=True)
+
+    def _filepath(self, url: str) -> Path:
+        return self.dir_cache.joinpath(f'{hashlib.sha256(url.encode("utf-8")).hexdigest()}.json')
+
+    def get(self, url: str) -> dict | None:
+        """
+        @return: dict with keys: 'url', 'listing' - the parsed listing, 'etag' and 'last_modified' - validators, if
+            the server sent them, 'fetched' - ISO date/time the listing was fetched or revalidated; None if not cached.
+        """
+        filepath = self._filepath(url)
+        try:
+            with filepath.open(mode='r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if entry['url'] == url:
+                return entry
+        except FileNotFoundError:
+            pass
+        except Exception as ex:
+            log.warning(f'ignoring invalid listing cache entry {filepath}: {ex}')
+        return None
+
+    def put(self, url: str, listing: list | dict, etag: str | None, last_modified: str | None):
+        entry = {'url': url, 'listing': listing, 'fetched': utcnow().isoformat()}
+        if etag:
+            entry['etag'] = etag
+        if last_modified:
+            entry['last_modified'] = last_modified
+
+        filepath = self._filepath(url)
+        filepath_tmp = filepath.with_suffix('.tmp')
+        try:
+            with filepath_tmp.open(mode='w', encoding='utf-8') as f:
+                f.write(json_dumps(entry, indent=False))
+            filepath_tmp.rename(filepath)
+
+        finally:
+            filepath_tmp.unlink(missing_ok=True)
+
+    @staticmethod
+    def is_immutable(entry: dict, period_end: datetime) -> bool:
+        """Whether the cached listing of a directory of the period that ends at the given date/time is final"""
+        return datetime.fromisoformat(entry['fetched']) >= period_end + IMMUTABLE_GRACE
+
+    @staticmethod
+    def conditional_headers(entry: dict) -> dict[str, str]:
+        headers = {}
+        if 'etag' in entry:
+            headers['If-None-Match'] = entry['etag']
+        if 'last_modified' in entry:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
@@ -3,46 +3,188 @@ import logging
 import asyncio
 import aiohttp
 import pytz
+import bisect
+import contextlib
+import itertools
+import json
 import random
+import time
+import zlib
+from collections.abc import Awaitable, Callable, Coroutine, Mapping
+from typing import TypeVar
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from urllib.parse import urlparse
-from pyramid.paster import bootstrap, setup_logging
-from pyramid_zodbconn import get_connection
+from ZODB import DB
 from ZODB.Connection import Connection
+import transaction
 from urllib3.exceptions import ProtocolError, HTTPError
 from aiohttp.client_exceptions import ClientResponseError
 from suid import utcnow
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 
 # module import
 from helpers.checktime import verify_time_is_correct
 from helpers.misc import xdescr, json_dumps
 from zmodels import tcm, get_app_root, AppRoot
+# noinspection PyUnresolvedReferences
+from BTrees.OOBTree import OOBTree
+# noinspection PyUnresolvedReferences
+from BTrees.Length import Length
+from zmodels.misc import epoch_hour, epoch_hour_to_datetime
+from zmodels.issues import IssueLog
+from zmodels.usage import UsageWindows
+from zmodels.tlog import TrafficLog
 
 # local imports
 from .settings import settings
+from . import snapbin
+from .snapbin import BinarySnapshot
+from .listcache import ListingCache
+from .spool import SnapshotSpool
+from .throttle import AdaptiveLimiter, CircuitBreaker, HostUnavailableError
+from .daemon import install_stop_handlers, sleep_unless
+from .cli import cli_env, setup_logging
+from .metrics import RunMetrics
+from .snapshots import MANIFEST_FILENAME, MANIFEST_RECORD_SIZE_ESTIMATE, BUNDLE_FILENAME
+from .snapshots import parse_manifest, manifest_record_datetime, is_bundle_path, day_dir, parse_bundle_stream
 from . import sys_exit
 
 log = logging.getLogger(__name__)
 
 URI_CONFIG_DEFAULT = 'config/makerep.ini'
 
+BUNDLE_READ_CHUNK_SIZE = 64 * 1024;  """Size of chunks to decompress and parse a bundle while receiving it"""
+
+COUNTERS_NONE = (0, 0);  """Counters of a user absent from the previous snapshot"""
+
+ISSUE_DELTA_SKIPPED = 'delta_skipped'
+ISSUE_SNAPSHOTS_MISSED = 'snapshots_missed'
+ISSUE_COLLECTION_FAILED = 'collection_failed'
+ISSUE_LEGACY = 'legacy';  """Issues recorded by older versions, as plain messages"""
+
+T = TypeVar('T')
+
+
+class SnapshotFeed:
+    """
+    In-order delivery of the snapshots of a single host, fetched concurrently, to the parser.
+    Snapshots are delivered when all directory listings of the host are done and all earlier snapshots have arrived.
+    Fetch tasks too far ahead of the next snapshot to deliver wait for their turn, which limits the number
+    of snapshots kept in memory.
+    """
+    def __init__(self, high_water_mark: int):
+        self.high_water_mark = high_water_mark
+        self._pending: list[tuple[datetime, int]] = [];  """Sorted slots of the expected snapshots: (datetime, seq)"""
+        self._ready: dict[tuple[datetime, int], list[Mapping]] = {};  """Fetched, but not yet delivered snapshots"""
+        self._listings = 0;  """Number of directory listings in progress"""
+        self._seq = itertools.count()
+        self._aborted = False
+        self._changed = asyncio.Condition()
+
+    def listing_started(self):
+        self._listings += 1
+
+    async def listing_done(self):
+        async with self._changed:
+            self._listings -= 1
+            self._changed.notify_all()
+
+    def expect(self, dt: datetime) -> tuple[datetime, int]:
+        """
+        Register a slot for the snapshot(s) to be fetched.
+        @param dt: date/time of the snapshot or the earliest of several snapshots to be put in the slot.
+        """
+        slot = dt, next(self._seq)
+        bisect.insort(self._pending, slot)
+        return slot
+
+    async def wait_turn(self, slot: tuple[datetime, int]):
+        """Wait until there are less than high_water_mark undelivered slots before the given one"""
+        async with self._changed:
+            await self._changed.wait_for(
+                lambda: self._aborted or bisect.bisect_left(self._pending, slot) < self.high_water_mark
+            )
+
+    async def put(self, slot: tuple[datetime, int], snapshots: list[Mapping]):
+        async with self._changed:
+            self._ready[slot] = snapshots
+            self._changed.notify_all()
+
+    async def get(self) -> list[Mapping] | None:
+        """Get the snapshots of the next slot in chronological order, None if all slots have been delivered"""
+        async with self._changed:
+            await self._changed.wait_for(
+                lambda: self._aborted or self._listings == 0 and (not self._pending or self._pending[0] in self._ready)
+            )
+            if self._aborted or not self._pending:
+                return None
+
+            slot = self._pending.pop(0)
+            self._changed.notify_all()
+            return self._ready.pop(slot)
+
+    async def abort(self):
+        """Stop the delivery, the snapshots not delivered yet are dropped"""
+        async with self._changed:
+            self._aborted = True
+            self._pending.clear()
+            self._ready.clear()
+            self._changed.notify_all()
+
 
 class TrafficStatsCollector(asyncio.TaskGroup):
-    def __init__(self, urls: list[str], last_snapshots: dict[str, dict]):
+    def __init__(
+            self, urls: list[str], last_datetimes: dict[str, datetime],
+            consume: Callable[[str, list[Mapping]], Awaitable[None]] = None,
+            consumed: Callable[[str], Awaitable[None]] = None,
+            http_client: aiohttp.ClientSession = None, metrics: RunMetrics = None
+    ):
+        """
+        @param urls: URLs of the snapshots directories of the VPN servers.
+        @param last_datetimes: hostname => date/time of the latest snapshot saved in the database.
+        @param consume: coroutine function to parse the fetched snapshots of a host, called in chronological order;
+            by default the snapshots are collected to the snapshots attribute.
+        @param consumed: coroutine function called when all new snapshots of a host have been consumed.
+        @param http_client: HTTP session to use and leave open, by default a new one is created and closed on exit.
+        @param metrics: metrics to record the requests to, by default the collector keeps metrics of its own.
+        """
         super().__init__()
         self.urls = urls
-        self.last_snapshots = last_snapshots
-        self.snapshots: dict[str, dict[datetime, dict]] = {};  """hostname => datetime => fetched snapshot"""
-
-        connector = aiohttp.TCPConnector(limit_per_host=settings.aiohttp_limit_per_host)
-        self.http_client = aiohttp.ClientSession(connector=connector, json_serialize=json_dumps, raise_for_status=True)
+        self.last_datetimes = last_datetimes
+        self.consume = consume
+        self.consumed = consumed
+        self.feeds: dict[str, SnapshotFeed] = {};  """hostname => feed of its snapshots"""
+        self.snapshots: dict[str, dict[datetime, Mapping]] = {};  """hostname => datetime => fetched snapshot"""
+        self.listing_cache = ListingCache(Path(settings.dir_listing_cache)) if settings.dir_listing_cache else None
+        self.num_listings_cached = 0;  """Number of listings used from the cache without requesting the server"""
+        self.num_listings_not_modified = 0;  """Number of cached listings revalidated by the server"""
+        self.spool = SnapshotSpool(Path(settings.dir_spool)) if settings.dir_spool else None
+        self.limiters: dict[str, AdaptiveLimiter] = {};  """hostname => concurrency limiter of requests to the host"""
+        self.breakers: dict[str, CircuitBreaker] = {};  """hostname => circuit breaker of the host"""
+        self.host_tasks: dict[str, set[asyncio.Task]] = {};  """hostname => fetch and listing tasks in progress"""
+        self.hosts_failed: dict[str, str] = {};  """hostname => description of the failure the host was given up on"""
+        self.hostnames: set[str] = set();  """Hosts being collected"""
+        self.hosts_done: set[str] = set();  """Hosts all snapshots of which have been delivered or given up"""
+        self.all_hosts_done = asyncio.Event()
+        self.watchdog_task: asyncio.Task | None = None
+        self.num_spooled = 0;  """Number of snapshot and bundle files read from the spool instead of the server"""
+        self.metrics = metrics or RunMetrics()
+
+        self.own_http_client = http_client is None
+        self.http_client = http_client or self.create_http_client()
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         try:
             await super().__aexit__(exc_type, exc_val, exc_tb)
         finally:
-            await self.http_client.close()
+            if self.own_http_client:
+                await self.http_client.close()
+
+    @staticmethod
+    def create_http_client() -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(limit_per_host=settings.aiohttp_limit_per_host)
+        return aiohttp.ClientSession(connector=connector, json_serialize=json_dumps, raise_for_status=True)
 
     @staticmethod
     def pdot():
@@ -54,35 +196,169 @@ class TrafficStatsCollector(asyncio.TaskGroup):
 
     async def execute(self):
         for url in self.urls:
+            hostname = urlparse(url).hostname
+            if hostname in self.hostnames:
+                log.warning(f'{hostname}: ignoring {url}, the server is collected from another URL already')
+                continue
+            self.hostnames.add(hostname)
             self.create_task(self.fetch_url(url))
+        if not self.hostnames:
+            self.all_hosts_done.set()
+        elif settings.collector_deadline:
+            self.watchdog_task = self.create_task(self.watchdog(settings.collector_deadline))
 
-    async def fetch(self, url: str) -> dict:
+    async def watchdog(self, deadline: float):
+        """Give up the hosts that have not finished before the deadline"""
+        try:
+            await asyncio.wait_for(self.all_hosts_done.wait(), timeout=deadline)
+        except TimeoutError:
+            for hostname in self.feeds:
+                if hostname not in self.hosts_done:
+                    await self.fail_host(hostname, TimeoutError(f'the collector deadline of {deadline}s has passed'))
+
+    def create_host_task(self, hostname: str, coro: Coroutine):
+        """
+        Create a task fetching data from a host. A failed task gives up the host only, not the whole run:
+        the other tasks of the host are cancelled and the snapshots not delivered yet are dropped.
+        """
+        async def guarded():
+            try:
+                await coro
+            except Exception as ex:
+                await self.fail_host(hostname, ex)
+
+        tasks = self.host_tasks.setdefault(hostname, set())
+        task = self.create_task(guarded())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def fail_host(self, hostname: str, ex: Exception):
+        if hostname in self.hosts_failed:
+            return
+        self.hosts_failed[hostname] = xdescr(ex)
+        log.error(f'{hostname}: giving up the host for this run: {xdescr(ex)}')
+        for task in list(self.host_tasks.get(hostname, ())):
+            if task is not asyncio.current_task():
+                task.cancel()
+        await self.feeds[hostname].abort()
+
+    def host_limiter(self, hostname: str) -> AdaptiveLimiter:
+        if hostname not in self.limiters:
+            self.limiters[hostname] = AdaptiveLimiter(
+                limit_max=settings.aiohttp_limit_per_host, limit_initial=settings.aiohttp_limit_per_host_initial
+            )
+        return self.limiters[hostname]
+
+    def host_breaker(self, hostname: str) -> CircuitBreaker:
+        if hostname not in self.breakers:
+            self.breakers[hostname] = CircuitBreaker(failures_max=settings.aiohttp_breaker_failures)
+        return self.breakers[hostname]
+
+    async def fetch_with_retries(
+            self, url: str, parse: Callable[[aiohttp.ClientResponse], Awaitable[T]], **kwargs
+    ) -> T:
+        """
+        Execute HTTP GET request, retrying on network and protocol errors.
+        The number of concurrent requests to the host is limited adaptively, the requests fail immediately
+        once the circuit breaker of the host is open.
+        @param url: the URL to request.
+        @param parse: coroutine function to read and parse the response, may raise ProtocolError to retry.
+        @param kwargs: additional arguments to the aiohttp request.
+        """
+        hostname = urlparse(url).hostname
+        limiter, breaker = self.host_limiter(hostname), self.host_breaker(hostname)
         tries = settings.aiohttp_tries
         pause_initial = settings.aiohttp_retry_pause_initial
         retry_pause = random.uniform(pause_initial, pause_initial * 1.5)
+        retry = False
         while True:
+            breaker.check(hostname)
+            await limiter.acquire()
+            latency = None
             try:
-                resp = await self.http_client.get(url)
-                try:
-                    resp_json = await resp.json()
-                except ValueError:
-                    raise ProtocolError(f'response content is not Json')
-
-                if resp.status != 200:
-                    # this should never happen, as we set raise_on_status=True
-                    raise RuntimeError(f'HTTP status: {resp.status}, URL: {url}')
-
-                return resp_json
+                time_start = time.monotonic()
+                async with self.http_client.get(url, **kwargs) as resp:
+                    latency = time.monotonic() - time_start  # time to the response headers
+                    result = await parse(resp)
+                    self.metrics.request_done(hostname, latency, resp.content.total_bytes, retry=retry)
+                breaker.success()
+                return result
 
             except (aiohttp.ClientConnectorError, ProtocolError, HTTPError, ClientResponseError):
+                latency = None
+                self.metrics.request_done(hostname, None, retry=retry)
                 self.print_error()
+                breaker.failure()
                 if tries <= 0:
                     raise
 
+            finally:
+                await limiter.release(latency)
+
             await asyncio.sleep(retry_pause)
 
             retry_pause *= settings.aiohttp_retry_pause_multiplier
             tries -= 1
+            retry = True
+
+    async def fetch(self, url: str, period_end: datetime = None) -> dict:
+        """
+        Fetch a json directory listing, using the listing cache if enabled.
+        @param period_end: the end of the period the directory stands for, i.e. the next year, month or day;
+            a listing cached well after the period is over is used without revalidation.
+        """
+        entry = self.listing_cache.get(url) if self.listing_cache else None
+        if entry and period_end and self.listing_cache.is_immutable(entry, period_end):
+            self.num_listings_cached += 1
+            return entry['listing']
+
+        async def parse(resp: aiohttp.ClientResponse) -> dict:
+            if resp.status == 304 and entry:
+                self.num_listings_not_modified += 1
+                self.listing_cache.put(url, entry['listing'], entry.get('etag'), entry.get('last_modified'))
+                return entry['listing']
+
+            try:
+                resp_json = await resp.json()
+            except ValueError:
+                raise ProtocolError(f'response content is not Json')
+
+            if resp.status != 200:
+                # this should never happen, as we set raise_on_status=True
+                raise RuntimeError(f'HTTP status: {resp.status}, URL: {url}')
+
+            if self.listing_cache:
+                self.listing_cache.put(url, resp_json, resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+            return resp_json
+
+        headers = self.listing_cache.conditional_headers(entry) if entry else None
+        return await self.fetch_with_retries(url, parse, headers=headers)
+
+    async def fetch_tail(self, url: str, size: int | None) -> tuple[bytes, bool] | None:
+        """
+        Fetch the last bytes of a file using HTTP range request.
+        @param url: the file URL.
+        @param size: number of bytes to fetch from the end of the file, None to fetch the whole file.
+        @return: fetched bytes and whether they are the whole file content, None if there is no such file.
+        """
+        async def parse(resp: aiohttp.ClientResponse) -> tuple[bytes, bool] | None:
+            if resp.status == 404:
+                return None
+            if resp.status == 416:
+                return b'', True  # range not satisfiable, the file is empty
+            resp.raise_for_status()
+            if resp.status == 200:
+                return await resp.read(), True  # the server ignored the range or the whole file requested
+            if resp.status != 206:
+                raise RuntimeError(f'HTTP status: {resp.status}, URL: {url}')
+
+            data = await resp.read()
+            content_range = resp.headers.get('Content-Range', '')
+            total = content_range.rpartition('/')[2]
+            return data, total.isdigit() and int(total) <= len(data)
+
+        headers = {'Range': f'bytes=-{size}'} if size else None
+        return await self.fetch_with_retries(url, parse, headers=headers, raise_for_status=False)
 
     @staticmethod
     def verify_dir_item_get_name(item: dict, type_expected: str, name_min: str = None, name_max: str = None) -> str:
@@ -98,167 +374,772 @@ class TrafficStatsCollector(asyncio.TaskGroup):
 
         return item_name
 
+    def create_listing_task(self, hostname: str, coro: Coroutine):
+        """Create a directory listing task, the host snapshots are not delivered until all its listings are done"""
+        feed = self.feeds[hostname]
+        feed.listing_started()
+
+        async def listing():
+            try:
+                await coro
+            finally:
+                await feed.listing_done()
+
+        self.create_host_task(hostname, listing())
+
     async def fetch_url(self, url: str):
         hostname = urlparse(url).hostname
-        last_snapshot = self.last_snapshots.get(hostname, None)
-        last_datetime: datetime = datetime.fromisoformat(last_snapshot['__datetime']) if last_snapshot else None
+        if self.spool and self.last_datetimes.get(hostname, None):
+            self.spool.remove_ingested(hostname, self.last_datetimes[hostname])
+        self.feeds[hostname] = SnapshotFeed(high_water_mark=settings.ingest_high_water_mark)
+        self.create_listing_task(hostname, self.fetch_root(hostname, url))
+        self.create_task(self.deliver(hostname))
+
+    async def deliver(self, hostname: str):
+        """
+        Pass the snapshots of a host to the consumer. A failure to consume gives up the host only, like a failure
+        to fetch: the checkpoints the consumer has committed are kept, the other hosts go on.
+        """
+        feed = self.feeds[hostname]
+        try:
+            while (snapshots := await feed.get()) is not None:
+                if self.consume:
+                    await self.consume(hostname, snapshots)
+                else:
+                    for snapshot in snapshots:
+                        self.store_snapshot(hostname, snapshot)
+            if self.consumed:
+                await self.consumed(hostname)  # the snapshots delivered before a failure of the host are kept
+
+        except Exception as ex:
+            await self.fail_host(hostname, ex)
+
+        finally:
+            self.hosts_done.add(hostname)
+            if self.hosts_done >= self.hostnames:
+                self.all_hosts_done.set()
+                if self.watchdog_task:
+                    self.watchdog_task.cancel()
+
+    async def fetch_root(self, hostname: str, url: str):
+        last_datetime = self.last_datetimes.get(hostname, None)
+        if await self.fetch_manifest(hostname, url, last_datetime):
+            return
+
+        # there is no manifest on this server, walk the directory tree
         items = await self.fetch(url)
         self.pdot()
         for item in items:
+            if item['type'] == 'file':
+                continue  # the manifest or the snapstat state file
             year = int(self.verify_dir_item_get_name(item, 'directory', '2024', '2500'))
             if last_datetime and year < last_datetime.year:
                 # this year is earlier then the last saved snapshot in the database for this server
                 continue
-            self.create_task(self.fetch_year(hostname, url, year, last_datetime))
+            self.create_listing_task(hostname, self.fetch_year(hostname, url, year, last_datetime))
+
+    async def fetch_manifest(self, hostname: str, url: str, last_dt: datetime | None) -> bool:
+        """
+        Fetch the server manifest and schedule fetching of the snapshots saved after the last one in the database.
+        Only the tail of the manifest is fetched, growing it until it reaches the last saved snapshot.
+        @return: False if there is no manifest on the server.
+        """
+        url_manifest = f'{url}/{MANIFEST_FILENAME}'
+        size = None
+        if last_dt:
+            hours = max(0, int((utcnow() - last_dt).total_seconds() // 3600)) + 1
+            size = max(hours * 2 * MANIFEST_RECORD_SIZE_ESTIMATE, 4096)
+
+        while True:
+            fetched = await self.fetch_tail(url_manifest, size)
+            self.pdot()
+            if fetched is None:
+                return False
+
+            data, complete = fetched
+            records = parse_manifest(data, skip_first_line=not complete)
+            if complete or any(
+                manifest_record_datetime(x) <= last_dt for x in records if not is_bundle_path(x['path'])
+            ):
+                # bundles are appended after the day is over, only snapshot records are in chronological order
+                break
+            size *= 4
+
+        bundles = {day_dir(x['path']): x['path'] for x in records if is_bundle_path(x['path'])}
+        paths_by_day: dict[str, list[tuple[datetime, str]]] = {}
+        paths_binary = {x['path']: x['binary'] for x in records if 'binary' in x}
+        for record in records:
+            if is_bundle_path(record['path']):
+                continue
+            if last_dt and manifest_record_datetime(record) <= last_dt:
+                # this snapshot is not later than the last saved snapshot in the database for this server
+                continue
+            paths_by_day.setdefault(day_dir(record['path']), []).append(
+                (manifest_record_datetime(record), record['path'])
+            )
+
+        for day, paths in paths_by_day.items():
+            self.schedule_day(hostname, url, paths, bundles.get(day), last_dt, paths_binary)
+
+        return True
+
+    def schedule_day(
+            self, hostname: str, url: str, paths: list[tuple[datetime, str]], path_bundle: str | None,
+            last_dt: datetime, paths_binary: dict[str, str]
+    ):
+        """
+        Schedule fetching of the new snapshots of a day, as a single bundle if it is available and worth it.
+        @param paths: date/time and path of the new snapshots.
+        @param paths_binary: json snapshot path => path of the same snapshot in the binary format, if saved.
+        """
+        feed = self.feeds[hostname]
+        if path_bundle and len(paths) > 1:
+            slot = feed.expect(min(x[0] for x in paths))
+            self.create_host_task(hostname, self.fetch_bundle(hostname, url, slot, path_bundle, last_dt))
+        else:
+            for dt, path in paths:
+                slot = feed.expect(dt)
+                self.create_host_task(
+                    hostname, self.fetch_snapshot(hostname, url, slot, path, paths_binary.get(path, None))
+                )
 
     async def fetch_year(self, hostname: str, url: str, year: int, last_dt: datetime):
-        items = await self.fetch(f'{url}/{year}/')
+        items = await self.fetch(f'{url}/{year}/', period_end=datetime(year + 1, 1, 1, tzinfo=pytz.UTC))
         self.pdot()
         for item in items:
             month = int(self.verify_dir_item_get_name(item, 'directory', '01', '12'))
             if last_dt and year == last_dt.year and month < last_dt.month:
                 # this month is earlier then the last saved snapshot in the database for this server
                 continue
-            self.create_task(self.fetch_month(hostname, url, year, month, last_dt))
+            self.create_listing_task(hostname, self.fetch_month(hostname, url, year, month, last_dt))
 
     async def fetch_month(self, hostname: str, url: str, year: int, month: int, last_dt: datetime):
-        items = await self.fetch(f'{url}/{year}/{month:02}/')
+        period_end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=pytz.UTC)
+        items = await self.fetch(f'{url}/{year}/{month:02}/', period_end=period_end)
         self.pdot()
         for item in items:
             day = int(self.verify_dir_item_get_name(item, 'directory', '01', '31'))
             if last_dt and year == last_dt.year and month == last_dt.month and day < last_dt.day:
                 # this day is earlier then the last saved snapshot in the database for this server
                 continue
-            self.create_task(self.fetch_day(hostname, url, year, month, day, last_dt))
+            self.create_listing_task(hostname, self.fetch_day(hostname, url, year, month, day, last_dt))
 
     async def fetch_day(self, hostname: str, url: str, year: int, month: int, day: int, last_dt: datetime):
-        items = await self.fetch(f'{url}/{year}/{month:02}/{day:02}/')
+        period_end = datetime(year, month, day, tzinfo=pytz.UTC) + timedelta(days=1)
+        items = await self.fetch(f'{url}/{year}/{month:02}/{day:02}/', period_end=period_end)
         self.pdot()
+        paths = []
+        path_bundle = None
+        paths_binary = {}
         for item in items:
             filename = self.verify_dir_item_get_name(item, 'file')
+            if filename.endswith('.tmp'):
+                continue  # a bundle or a snapshot being written
+            if filename == BUNDLE_FILENAME:
+                path_bundle = f'{year}/{month:02}/{day:02}/{filename}'
+                continue
+            if filename.endswith(snapbin.FILENAME_SUFFIX):
+                path = f'{year}/{month:02}/{day:02}/{filename}'
+                paths_binary[str(PurePosixPath(path).with_suffix('.json'))] = path
+                continue
             filename_suffix = filename[-settings.snapshot_filename_suffix_length:]
             dt = datetime.strptime(filename_suffix, settings.snapshot_filename_suffix_format).replace(tzinfo=pytz.UTC)
             if last_dt and dt <= last_dt:
                 # this snapshot is earlier then the last saved snapshot in the database for this server
                 continue
-            self.create_task(self.fetch_snapshot(hostname, url, year, month, day, filename))
+            paths.append((dt, f'{year}/{month:02}/{day:02}/{filename}'))
+
+        self.schedule_day(hostname, url, paths, path_bundle, last_dt, paths_binary)
+
+    async def fetch_snapshot(
+            self, hostname: str, url: str, slot: tuple[datetime, int], path: str, path_binary: str = None
+    ):
+        feed = self.feeds[hostname]
+        await feed.wait_turn(slot)
+        dt = slot[0]
+        snapshot = self.read_spooled_snapshot(hostname, dt) if self.spool else None
+        if snapshot is None and path_binary and settings.snapshot_fetch_binary:
+            snapshot = await self.fetch_snapshot_data(f'{url}/{path_binary}', missing_ok=True, spool_as=(hostname, dt))
+        if snapshot is None:
+            snapshot = await self.fetch_snapshot_data(f'{url}/{path}', spool_as=(hostname, dt))
+        self.pdot()
+        await feed.put(slot, [snapshot])
 
-    async def fetch_snapshot(self, hostname: str, url: str, year: int, month: int, day: int, filename: str):
-        snapshot = await self.fetch(f'{url}/{year}/{month:02}/{day:02}/{filename}')
+    @staticmethod
+    def load_snapshot(data: bytes, content_type: str = None) -> Mapping:
+        """Load a snapshot from either binary or json file content, raise ValueError if the content is invalid"""
+        if content_type == snapbin.CONTENT_TYPE or snapbin.is_binary_snapshot(data):
+            return BinarySnapshot(data, settings.snapshot_dict_datetime_key, settings.snapshot_dict_base_key)
+        return json.loads(data)
+
+    def read_spooled_snapshot(self, hostname: str, dt: datetime) -> Mapping | None:
+        data = self.spool.get_snapshot(hostname, dt)
+        if data is None:
+            return None
+        try:
+            snapshot = self.load_snapshot(data)
+        except ValueError as ex:
+            log.warning(f'{hostname}: ignoring invalid spooled snapshot {dt.isoformat()}: {ex}')
+            return None
+        self.num_spooled += 1
+        return snapshot
+
+    async def fetch_snapshot_data(
+            self, url: str, missing_ok: bool = False, spool_as: tuple[str, datetime] = None
+    ) -> Mapping | None:
+        """
+        Fetch a snapshot, negotiating the binary format with the server if enabled, and falling back to json.
+        @param missing_ok: return None if there is no such file on the server.
+        @param spool_as: hostname and date/time to save the fetched snapshot in the spool with, if it is enabled.
+        """
+        async def parse(resp: aiohttp.ClientResponse) -> Mapping | None:
+            if missing_ok and resp.status == 404:
+                return None
+            resp.raise_for_status()
+            data = await resp.read()
+            try:
+                snapshot = self.load_snapshot(data, resp.content_type)
+            except ValueError:
+                raise ProtocolError(f'response content is not a valid snapshot')
+            if self.spool and spool_as:
+                self.spool.put_snapshot(*spool_as, data)
+            return snapshot
+
+        headers = None
+        if settings.snapshot_fetch_binary:
+            headers = {'Accept': f'{snapbin.CONTENT_TYPE}, application/json;q=0.5'}
+        return await self.fetch_with_retries(url, parse, headers=headers, raise_for_status=False)
+
+    async def fetch_bundle(
+            self, hostname: str, url: str, slot: tuple[datetime, int], path: str, last_dt: datetime | None
+    ):
+        """Fetch all snapshots of a finished day at once, keeping only those later than the last saved snapshot"""
+        feed = self.feeds[hostname]
+        await feed.wait_turn(slot)
+        day = datetime.strptime(day_dir(path), '%Y/%m/%d').date()
+
+        snapshots = None
+        data = self.spool.get_bundle(hostname, day) if self.spool else None
+        if data is not None:
+            async def spooled_chunks():
+                yield data
+            try:
+                snapshots = [x async for x in parse_bundle_stream(spooled_chunks())]
+                self.num_spooled += 1
+            except (ValueError, zlib.error) as ex:
+                log.warning(f'{hostname}: ignoring invalid spooled bundle {day.isoformat()}: {ex}')
+
+        async def parse(resp: aiohttp.ClientResponse) -> list[dict]:
+            chunks = []
+
+            async def received_chunks():
+                async for chunk in resp.content.iter_chunked(BUNDLE_READ_CHUNK_SIZE):
+                    if self.spool:
+                        chunks.append(chunk)
+                    yield chunk
+
+            try:
+                result = [x async for x in parse_bundle_stream(received_chunks())]
+            except (ValueError, zlib.error):
+                raise ProtocolError(f'response content is not a valid bundle')
+            if self.spool:
+                self.spool.put_bundle(hostname, day, b''.join(chunks))
+            return result
+
+        if snapshots is None:
+            snapshots = await self.fetch_with_retries(f'{url}/{path}', parse)
         self.pdot()
+        key = settings.snapshot_dict_datetime_key
+        snapshots.sort(key=lambda x: datetime.fromisoformat(x[key]))
+        await feed.put(slot, [x for x in snapshots if not last_dt or datetime.fromisoformat(x[key]) > last_dt])
+
+    def store_snapshot(self, hostname: str, snapshot: Mapping):
         dt_str = snapshot[settings.snapshot_dict_datetime_key]
         dt = datetime.fromisoformat(dt_str)
         self.snapshots[hostname] = self.snapshots.get(hostname, {})
         self.snapshots[hostname][dt] = snapshot
 
 
-def save_amounts(appr: AppRoot, hostname: str, user_id: str, dt_prev: datetime, dt: datetime, am_down: int, am_up: int):
-    # distribute amounts proportionally to the time intervals
+def hour_splits(dt_prev: datetime, dt: datetime) -> list[tuple[datetime, float, float]]:
+    """
+    Split the interval between two snapshots by the hours it spans.
+    @return: list of (hour, seconds from the part start to dt, seconds in the part), parts of zero length are omitted.
+    """
     hour_dt = dt.replace(minute=0, second=0, microsecond=0);  """The hour the current snap belongs"""
     hour_dt_prev = dt_prev.replace(minute=0, second=0, microsecond=0);  """The hour that the prev snapshot belongs to"""
 
+    splits = []
     hour = hour_dt_prev
     while hour <= hour_dt:
         dt_left = max(hour, dt_prev)
         dt_right = min(dt, hour + timedelta(hours=1))
-        am_down_sec = am_down / (dt - dt_left).total_seconds()
-        am_up_sec = am_up / (dt - dt_left).total_seconds()
-        am_down_part = round(am_down_sec * (dt_right - dt_left).total_seconds())
-        am_up_part = round(am_up_sec * (dt_right - dt_left).total_seconds())
-        am_down -= am_down_part
-        am_up -= am_up_part
-        key = hour, hostname, user_id
-        am_down_saved, am_up_saved = appr.tlog.get(key, (0, 0))
-        appr.tlog[key] = (am_down_saved + am_down_part, am_up_saved + am_up_part)
+        if dt_right > dt_left:
+            splits.append((hour, (dt - dt_left).total_seconds(), (dt_right - dt_left).total_seconds()))
         hour += timedelta(hours=1)
 
-
-def parse_snap(appr: AppRoot, hostname: str, snap_current: dict, snap_prev: dict):
+    return splits
+
+
+def save_amounts_batch(
+        appr: AppRoot, hostname: str, dt_prev: datetime, dt: datetime, deltas: list[tuple[str, int, int]]
+):
+    """
+    Distribute traffic amounts of many users proportionally to the time intervals of the hours between two snapshots.
+    The hour splits are computed once for all users, amounts are split hour by hour for all users at once,
+    and every hour bucket of the traffic log is updated in a single pass.
+    @param deltas: list of (user_id, bytes downloaded, bytes uploaded) since the previous snapshot.
+    @return: the number of traffic log records updated.
+    """
+    if not deltas:
+        return 0
+
+    num_records = 0
+    host_tlog = appr.tlog.host(hostname)
+    usage = appr.host(hostname).usage
+    user_ids = [x[0] for x in deltas]
+    uids = [x.split('-')[0] for x in user_ids];  """The report aggregates traffic of all clients of a user"""
+    rest_down = [x[1] for x in deltas]
+    rest_up = [x[2] for x in deltas]
+
+    for hour, sec_rest, sec_part in hour_splits(dt_prev, dt):
+        # same float operations as splitting the amounts one user at a time, so the rounding is the same
+        parts_down = [round(x / sec_rest * sec_part) for x in rest_down]
+        parts_up = [round(x / sec_rest * sec_part) for x in rest_up]
+        rest_down = [x - y for x, y in zip(rest_down, parts_down)]
+        rest_up = [x - y for x, y in zip(rest_up, parts_up)]
+
+        hour_epoch = epoch_hour(hour)
+        host_tlog.add_many(hour_epoch, zip(user_ids, parts_down, parts_up))
+        num_records += len(user_ids)
+
+        usage_hour = {}
+        for uid, am_down_part, am_up_part in zip(uids, parts_down, parts_up):
+            usage_hour[uid] = usage_hour.get(uid, 0) + am_down_part + am_up_part
+        for uid, amount in sorted(usage_hour.items()):
+            usage.add(hour_epoch, uid, amount)
+
+    return num_records
+
+
+def parse_snap(appr: AppRoot, hostname: str, snap_current: Mapping, snap_prev: Mapping) -> int:
+    """
+    Save traffic amounts between two snapshots.
+    @param snap_current: the current snapshot, either full or a delta one.
+    @param snap_prev: the previous snapshot, always full.
+    @return: the number of traffic log records updated.
+    """
     dt = datetime.fromisoformat(snap_current[settings.snapshot_dict_datetime_key])
     dt_prev = datetime.fromisoformat(snap_prev[settings.snapshot_dict_datetime_key])
+    keys_meta = settings.snapshot_dict_datetime_key, settings.snapshot_dict_comment_key, settings.snapshot_dict_base_key
 
-    for user_id, amounts in snap_current.items():
-        if user_id in (settings.snapshot_dict_datetime_key, settings.snapshot_dict_comment_key):
+    if isinstance(snap_current, BinarySnapshot) and isinstance(snap_prev, BinarySnapshot):
+        items = snap_current.items_changed(snap_prev)  # skip idle users without even decoding their ids
+    else:
+        items = snap_current.items()
+
+    deltas = []
+    get_prev = snap_prev.get
+    for user_id, amounts in items:
+        if user_id in keys_meta:
             continue
 
         am_down, am_up = amounts
-        am_down_prev, am_up_prev = snap_prev.get(user_id, (0, 0))
+        am_down_prev, am_up_prev = get_prev(user_id, COUNTERS_NONE)
 
         if (am_down_prev > am_down or am_up_prev > am_up) or (am_down_prev == am_down and am_up_prev == am_up):
             # traffic statistics have been reset for this VPN user on this hostname, or no user traffic
             continue
 
-        am_down -= am_down_prev
-        am_up -= am_up_prev
-
-        save_amounts(appr, hostname, user_id, dt_prev, dt, am_down, am_up)
-
-
-def parse_snaps(appr: AppRoot, hostname: str, snaps: dict[datetime, dict]):
-    snap_prev = appr.last_snapshots.get(hostname, None)
-    dt_prev = datetime.fromisoformat(snap_prev[settings.snapshot_dict_datetime_key]) if snap_prev else None
-
-    for dt, snap_current in sorted(snaps.items()):
+        deltas.append((user_id, am_down - am_down_prev, am_up - am_up_prev))
+
+    return save_amounts_batch(appr, hostname, dt_prev, dt, deltas)
+
+
+def load_last_snapshot(appr: AppRoot, hostname: str) -> dict | None:
+    """The latest snapshot of a server parsed, None if there is none yet"""
+    snapshot = appr.host(hostname).snapshot
+    if snapshot.datetime is None:
+        return None
+    return snapshot.load(appr.tlog.host(hostname)) | {settings.snapshot_dict_datetime_key: snapshot.datetime}
+
+
+def save_last_snapshot(appr: AppRoot, hostname: str, snap: Mapping):
+    """Save the latest snapshot of a server parsed, only the changed counters are written"""
+    state = appr.host(hostname)
+    keys_meta = settings.snapshot_dict_datetime_key, settings.snapshot_dict_comment_key, settings.snapshot_dict_base_key
+    state.snapshot.save(
+        snap[settings.snapshot_dict_datetime_key],
+        ((k, v) for k, v in snap.items() if k not in keys_meta),
+        appr.tlog.host(hostname)
+    )
+
+
+def apply_delta(snap_prev: Mapping, snap_delta: Mapping) -> dict:
+    """Rebuild the full snapshot from the previous full snapshot and a delta one"""
+    snap = dict(snap_prev)
+    snap.update(snap_delta)
+    del snap[settings.snapshot_dict_base_key]
+    return snap
+
+
+class SnapshotParser:
+    """Parses snapshots of a single host in chronological order, keeping the previous snapshot in between"""
+    def __init__(self, appr: AppRoot, hostname: str):
+        self.appr = appr
+        self.hostname = hostname
+        self.state = appr.host(hostname)
+        self.snap_prev: Mapping | None = load_last_snapshot(appr, hostname)
+        self.dt_prev = datetime.fromisoformat(self.snap_prev[settings.snapshot_dict_datetime_key]) \
+            if self.snap_prev else None
+        self.dt_saved = self.dt_prev;  """Date/time of the latest snapshot saved to the ingest state"""
+        self.num_parsed = 0
+        self.num_records = 0;  """Number of traffic log records updated"""
+        self.num_counted = 0;  """Number of parsed snapshots already added to the counter of all hosts"""
+
+    def parse(self, snap_current: Mapping):
+        appr, hostname, snap_prev, dt_prev = self.appr, self.hostname, self.snap_prev, self.dt_prev
+        dt = datetime.fromisoformat(snap_current[settings.snapshot_dict_datetime_key])
         if dt_prev and dt_prev > dt:
             raise RuntimeError(f'hostname={hostname}, dt_prev={dt_prev.isoformat()}, dt={dt.isoformat()}')
 
+        base = snap_current.get(settings.snapshot_dict_base_key, None)
+        if base is not None and (not dt_prev or datetime.fromisoformat(base) != dt_prev):
+            # the snapshot the delta is relative to was not parsed, skip until the next full snapshot
+            msg_delta_skipped = f'{hostname}: skipped delta snapshot {dt:%Y%m%d-%H%M}, its base is missing'
+            log.warning(msg_delta_skipped)
+            self.state.issues.add(ISSUE_DELTA_SKIPPED, msg_delta_skipped, utcnow())
+            return
+
         if dt_prev and (dt - dt_prev).total_seconds() > 3600 + 1800:
             num_missed = int(((dt - dt_prev).total_seconds() - 1800) // 3600)
             msg_snaps_missed = f'{hostname}: missed {num_missed} snapshot(s) before {dt:%Y%m%d-%H%M}'
             log.warning(msg_snaps_missed)
-            appr.issues[utcnow()] = msg_snaps_missed
+            self.state.issues.add(ISSUE_SNAPSHOTS_MISSED, msg_snaps_missed, utcnow(), count=num_missed)
 
         if snap_prev:
-            parse_snap(appr, hostname, snap_current, snap_prev)
+            # delta snapshots are parsed directly, as they contain changed counters only
+            self.num_records += parse_snap(appr, hostname, snap_current, snap_prev)
+
+        self.snap_prev = apply_delta(snap_prev, snap_current) if base is not None else snap_current
+        self.dt_prev = dt
+        self.num_parsed += 1
+
+    def parse_many(self, snaps: list[Mapping]):
+        for snap in snaps:
+            self.parse(snap)
+
+    def finish(self):
+        """Save the ingest state, called at checkpoints and after the last snapshot"""
+        if self.snap_prev and self.dt_prev != self.dt_saved:
+            save_last_snapshot(self.appr, self.hostname, self.snap_prev)
+            self.dt_saved = self.dt_prev
+        if self.num_parsed > self.num_counted:
+            self.appr.num_snapshots.change(self.num_parsed - self.num_counted)
+            self.num_counted = self.num_parsed
+
+
+def parse_snaps(appr: AppRoot, hostname: str, snaps: dict[datetime, Mapping]):
+    parser = SnapshotParser(appr, hostname)
+    for _dt, snap_current in sorted(snaps.items()):
+        parser.parse(snap_current)
+    parser.finish()
+
+
+def ensure_usage_windows(appr: AppRoot, hostname: str, rebuild: bool = False):
+    """Build the rolling window usage aggregates of a server from the traffic log, if of a different length"""
+    state = appr.host(hostname)
+    num_hours = settings.report_window_hours
+    if not rebuild and state.usage.num_hours == num_hours:
+        return
+
+    log.info(f'{hostname}: building usage aggregates for the last {num_hours} hours from the traffic log')
+    state.usage = usage = UsageWindows(num_hours=num_hours)
+    host_tlog = appr.tlog.hosts.get(hostname, None)
+    if host_tlog is not None:
+        for hour, user_id, am_down, am_up in host_tlog.items(hour_min=epoch_hour(utcnow()) - num_hours + 1):
+            usage.add(hour, user_id.split('-')[0], am_down + am_up)
+
+
+def ensure_host_states(appr: AppRoot, hostnames: list[str]):
+    """
+    Create the ingest state and traffic log partitions of the servers before the ingest workers start, so that
+    the workers never write to objects shared with other workers.
+    The ingest state of databases created before the per-server partitions is moved into the partitions:
+    the latest snapshot dicts are converted to the compact snapshot state, the issues log to IssueLog.
+    """
+    if appr.hosts is None:
+        log.info(f'moving the ingest state to per-server partitions')
+        appr.hosts = OOBTree()
+        appr.num_snapshots = Length()
+
+    last_snapshots = appr.last_snapshots or {}
+    for hostname in sorted(set(hostnames) | set(last_snapshots)):
+        is_new = hostname not in appr.hosts
+        state = appr.host(hostname)
+        appr.tlog.host(hostname)
+        snap_legacy = last_snapshots.get(hostname, None)
+        if snap_legacy is not None:
+            save_last_snapshot(appr, hostname, snap_legacy)  # move the snapshot dict to the compact state
+        ensure_usage_windows(appr, hostname, rebuild=is_new)
+
+    if appr.last_snapshots is not None:
+        appr.last_snapshots = None
+    if not isinstance(appr.issues, IssueLog):
+        appr.issues = convert_issues(appr.issues)
+
+
+def convert_issues(issues: OOBTree) -> IssueLog:
+    """Convert the issues log of older versions, date/time => message, to IssueLog"""
+    issue_log = IssueLog()
+    for at, message in issues.items():
+        issue_log.add(ISSUE_LEGACY, message, at, detail=message)
+    return issue_log
+
+
+def verify_tlog_layout(appr: AppRoot):
+    if not isinstance(appr.tlog, TrafficLog):
+        raise RuntimeError(f'the traffic log has the legacy layout, run "dbmaint migrate" first')
+
+
+def get_last_datetimes(appr: AppRoot) -> dict[str, datetime]:
+    """hostname => date/time of the latest snapshot saved in the database"""
+    return {
+        k: datetime.fromisoformat(v.snapshot.datetime)
+        for k, v in appr.hosts.items() if v.snapshot.datetime
+    }
+
+
+class HostIngest:
+    """
+    Parses the snapshots of a single server in transactions of its own, using a separate database connection
+    and thread. Servers are ingested in parallel and committed independently of each other.
+    The ingest state is committed every settings.ingest_checkpoint_snapshots snapshots or
+    settings.ingest_checkpoint_seconds seconds, an interrupted run resumes from the latest checkpoint.
+    """
+    def __init__(self, db: DB, hostname: str, metrics: RunMetrics = None):
+        self.db = db
+        self.hostname = hostname
+        self.metrics = metrics or RunMetrics()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'zodb-{hostname}')
+        self.conn: Connection | None = None
+        self.tcm: tcm.TransactionContextManager | None = None;  """The transaction, None when it is finished"""
+        self.parser: SnapshotParser | None = None
+        self.num_uncommitted = 0;  """Number of snapshots parsed since the latest checkpoint"""
+        self.time_begin = 0.0;  """Monotonic time the current transaction began"""
+        self.num_reported = (0, 0);  """Snapshots parsed and traffic log records updated, as recorded to metrics"""
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        """Run a function in the thread of the connection"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _begin(self):
+        if self.conn is None:
+            self.conn = self.db.open(transaction_manager=transaction.TransactionManager(explicit=True))
+        self.tcm = tcm.in_transaction(self.conn, note=f'makerep: {self.hostname}')
+        self.tcm.__enter__()
+        self.time_begin = time.monotonic()
+        if self.parser is None:
+            self.parser = SnapshotParser(get_app_root(self.conn), self.hostname)
+
+    def _commit(self):
+        with self.metrics.stage('commit', self.hostname):
+            self.parser.finish()
+            tcm_, self.tcm = self.tcm, None
+            tcm_.__exit__(None, None, None)
+        self.num_uncommitted = 0
+
+        num_parsed, num_records = self.parser.num_parsed, self.parser.num_records
+        self.metrics.ingested(self.hostname, num_parsed - self.num_reported[0], num_records - self.num_reported[1])
+        self.num_reported = num_parsed, num_records
+
+    def _parse_many(self, snaps: list[Mapping]):
+        for snap in snaps:
+            with self.metrics.stage('parse', self.hostname):
+                self.parser.parse(snap)
+            self.num_uncommitted += 1
+            if self.num_uncommitted >= settings.ingest_checkpoint_snapshots \
+                    or time.monotonic() - self.time_begin >= settings.ingest_checkpoint_seconds:
+                self._commit()
+                log.debug(f'{self.hostname}: checkpoint, {self.parser.num_parsed} snapshots parsed so far')
+                self.conn.cacheMinimize()  # objects are reloaded on demand, memory use stays flat whatever the backlog
+                self._begin()
+
+    def _close(self):
+        if self.tcm:
+            self.tcm.__exit__(RuntimeError, None, None)  # abort the transaction, the server ingest is incomplete
+        if self.conn:
+            self.conn.close()
+
+    async def __aenter__(self) -> 'HostIngest':
+        await self.run(self._begin)
+        return self
 
-        snap_prev = snap_current
-        dt_prev = dt
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            await self.run(self._close)
+        finally:
+            self.executor.shutdown(wait=False)
 
-    appr.last_snapshots[hostname] = snap_prev  # save the latest snapshot for this hostname
+    async def parse_many(self, snaps: list[Mapping]):
+        await self.run(self._parse_many, snaps)
 
+    async def commit(self):
+        await self.run(self._commit)
+        log.debug(f'{self.hostname}: committed {self.parser.num_parsed} parsed snapshots')
 
-async def make_report(conn: Connection):
-    with tcm.in_transaction(conn):
-        appr = get_app_root(conn)
 
-        collector = TrafficStatsCollector(urls=settings.urls_traffic_snapshots, last_snapshots=appr.last_snapshots)
-        log.info(f'collecting traffic snapshots from {len(settings.urls_traffic_snapshots)} servers')
+def prepare_ingest(conn: Connection, urls: list[str]) -> dict[str, datetime]:
+    """
+    Verify the database and create the ingest partitions of the servers.
+    @return: hostname => date/time of the latest snapshot saved in the database.
+    """
+    hostnames = [urlparse(x).hostname for x in urls]
+    with tcm.in_transaction(conn, note='makerep: prepare'):
+        appr = get_app_root(conn)
+        verify_tlog_layout(appr)
+        ensure_host_states(appr, hostnames)
+        prune_issues(appr.issues, utcnow())
+        return get_last_datetimes(appr)
+
+
+async def collect_and_ingest(
+        conn: Connection, urls: list[str], last_datetimes: dict[str, datetime],
+        http_client: aiohttp.ClientSession = None, metrics: RunMetrics = None
+) -> tuple[TrafficStatsCollector, int]:
+    """
+    Fetch the new snapshots from the servers and parse them into the database.
+    @param metrics: metrics to record the requests and the ingest to.
+    @return: the collector used and the number of snapshots parsed.
+    """
+    metrics = metrics or RunMetrics()
+    # every server is parsed by its own worker, so that parsing overlaps with the remaining downloads
+    workers: dict[str, HostIngest] = {}
+    async with contextlib.AsyncExitStack() as stack:
+        async def consume(hostname: str, snaps: list[Mapping]):
+            if hostname not in workers:
+                workers[hostname] = await stack.enter_async_context(HostIngest(conn.db(), hostname, metrics))
+            await workers[hostname].parse_many(snaps)
+
+        async def consumed(hostname: str):
+            if hostname in workers:
+                worker = workers[hostname]
+                await worker.commit()
+                if collector.spool and worker.parser.dt_prev:
+                    collector.spool.remove_ingested(hostname, worker.parser.dt_prev)
+
+        collector = TrafficStatsCollector(
+            urls=urls, last_datetimes=last_datetimes, consume=consume, consumed=consumed, http_client=http_client,
+            metrics=metrics
+        )
+        log.info(f'collecting traffic snapshots from {len(urls)} servers')
 
         print('Fetching ', end='')
         async with collector:
             await collector.execute()
         print(' DONE')
 
-        if collector.snapshots:
-            log.info(f'parsing {sum([len(x) for _, x in collector.snapshots.items()])} received snapshots')
-            for hostname, snaps in collector.snapshots.items():
-                parse_snaps(appr, hostname, snaps)
+    # the ingest workers of the servers have finished, their partitions can be written here without conflicts
+    update_host_states(conn, [urlparse(x).hostname for x in urls], collector.hosts_failed)
 
-            log.info(f'parsed')
+    if collector.spool:
+        log.info(f'{collector.num_spooled} snapshot file(s) read from the spool')
+    if collector.listing_cache:
+        log.info(
+            f'directory listings: {collector.num_listings_cached} used from the cache, '
+            f'{collector.num_listings_not_modified} revalidated'
+        )
 
-        else:
-            log.info(f'there are no new snapshots')
+    num_parsed = sum(x.parser.num_parsed for x in workers.values())
+    if num_parsed:
+        log.info(f'parsed {num_parsed} received snapshots')
+    else:
+        log.info(f'there are no new snapshots')
 
-    uid_to_bytes = {}
+    return collector, num_parsed
 
-    with tcm.in_transaction(conn):
-        appr = get_app_root(conn)
 
-        dt_from = utcnow() - timedelta(days=7)
-        key_min = (dt_from, '', '')
-        # noinspection PyArgumentList
-        for k, v in appr.tlog.items(min=key_min):
-            uid = k[2].split('-')[0]
-            uid_to_bytes[uid] = uid_to_bytes.get(uid, 0) + v[0] + v[1]
+def prune_issues(issue_log: IssueLog, now: datetime):
+    """Apply the retention limits of the settings to an issues log"""
+    issue_log.prune(now - timedelta(days=settings.issues_retention_days), settings.issues_max_entries)
 
-    arr_stats = [
+
+def update_host_states(conn: Connection, hostnames: list[str], hosts_failed: dict[str, str]):
+    """
+    Record the servers given up in their issues logs, expire the usage windows and apply the retention limits
+    of the issues logs. Called after the ingest workers of the servers have finished, so that an ingest partition
+    has a single writer at a time, and the report only reads the database.
+    @param hostnames: servers just collected.
+    @param hosts_failed: hostname => description of the failure the server was given up on.
+    """
+    with tcm.in_transaction(conn, note='makerep: host states'):
+        appr = get_app_root(conn)
+        now = utcnow()
+        for hostname in hostnames:
+            state = appr.host(hostname)
+            descr = hosts_failed.get(hostname, None)
+            if descr is not None:
+                state.issues.add(
+                    ISSUE_COLLECTION_FAILED, f'{hostname}: snapshots collection given up: {descr}', now, detail=descr
+                )
+            state.usage.expire(epoch_hour(now))
+            prune_issues(state.issues, now)
+
+
+def stats_gb(uid_to_bytes: dict[str, int]) -> list[tuple[str, float]]:
+    """@return: list of (user id, gigabytes), the heaviest users first"""
+    return [
         (k, round(v / 1024 / 1024 / 1024, ndigits=2))
         for k, v in sorted(uid_to_bytes.items(), key=lambda x: x[1], reverse=True)
     ]
-    arr_issues = [(x.isoformat(), v) for x, v in appr.issues.items()]
+
+
+def traffic_totals(appr: AppRoot, hour_now: int, days: int) -> dict:
+    """
+    Traffic of the users over the given number of days up to the current hour, read from the traffic log tiers.
+    The rolled up daily and monthly buckets can not be split by hour: the range begins or ends with the whole
+    buckets it falls within, the report gives the range covered.
+    @return: report section with the range covered, the beginning inclusive, the end exclusive, and the stats.
+    """
+    dt_min, dt_max = appr.tlog.span(
+        epoch_hour_to_datetime(hour_now - days * 24 + 1), epoch_hour_to_datetime(hour_now)
+    )
+    uid_to_bytes = {}
+    for user_id, (am_down, am_up) in appr.tlog.totals(dt_min, dt_max).items():
+        uid = user_id.split('-')[0]
+        uid_to_bytes[uid] = uid_to_bytes.get(uid, 0) + am_down + am_up
+    return {
+        'days': days,
+        'from': dt_min.isoformat(),
+        'to': (dt_max + timedelta(hours=1)).isoformat(),
+        'stats': stats_gb(uid_to_bytes),
+    }
+
+
+def write_report(conn: Connection):
+    """
+    Write the report, the database is only read. The report lists the latest settings.report_issues_max issues
+    seen within settings.report_issues_days, repeated occurrences aggregated, and the traffic totals over
+    settings.report_totals_days.
+    """
+    with tcm.in_transaction(conn):
+        appr = get_app_root(conn)
+        now = utcnow()
+        hour_now = epoch_hour(now)
+        uid_to_bytes = {}
+        for state in appr.hosts.values():
+            for uid, amount in state.usage.totals(hour_now).items():
+                uid_to_bytes[uid] = uid_to_bytes.get(uid, 0) + amount
+        totals = [traffic_totals(appr, hour_now, x) for x in settings.report_totals_days]
+
+        issues = []
+        for issue_log in [appr.issues, *(x.issues for x in appr.hosts.values())]:
+            issues.extend(issue_log.recent(since=now - timedelta(days=settings.report_issues_days)))
+        issues = sorted(issues, key=lambda x: x.last_seen, reverse=True)[:settings.report_issues_max]
+        arr_issues = [(x.last_seen.isoformat(), x.describe()) for x in reversed(issues)]
 
     str_report = json_dumps({
-        'stats': arr_stats,
+        'stats': stats_gb(uid_to_bytes),
+        'totals': totals,
         'issues': arr_issues
     })
 
@@ -276,6 +1157,122 @@ async def make_report(conn: Connection):
     log.info(f'saved to: {filepath}')
 
 
+def export_metrics(metrics: RunMetrics, hosts_failed: dict[str, str], db: DB):
+    """Log the metrics summary and write the metrics for the node exporter, if configured"""
+    metrics.finish(hosts_failed, db_size=db.getSize(), db_objects=db.objectCount())
+    log.info(f'metrics: {json_dumps(metrics.summary(), indent=False)}')
+    if settings.metrics_textfile:
+        try:
+            metrics.write_textfile(Path(settings.metrics_textfile))
+        except OSError as ex:
+            log.error(f'failed to write the metrics: {xdescr(ex)}')
+
+
+async def make_report(conn: Connection, metrics: RunMetrics = None):
+    metrics = metrics or RunMetrics()
+    with metrics.stage('prepare'):
+        last_datetimes = prepare_ingest(conn, settings.urls_traffic_snapshots)
+    with metrics.stage('fetch'):
+        collector, _num_parsed = await collect_and_ingest(
+            conn, settings.urls_traffic_snapshots, last_datetimes, metrics=metrics
+        )
+    with metrics.stage('report'):
+        write_report(conn)
+    export_metrics(metrics, collector.hosts_failed, conn.db())
+
+
+def poll_intervals() -> dict[str, int]:
+    """hostname => poll interval in the daemon mode, seconds, for the servers with an interval of their own"""
+    intervals = {}
+    for line in settings.daemon_poll_intervals:
+        try:
+            hostname, seconds = line.split()
+            intervals[hostname] = int(seconds)
+        except ValueError:
+            raise ValueError(f'invalid daemon_poll_intervals line: "{line}", expected: hostname seconds')
+    return intervals
+
+
+class ReportDaemon:
+    """
+    Resident mode of makerep: polls every server on its own schedule and rewrites the report whenever new data lands.
+    The HTTP session with its keep-alive connections, the database connections and their caches stay warm
+    between polls. Stops on SIGTERM or SIGINT: polls in progress are cancelled, keeping their committed checkpoints,
+    and the report is written for the last time.
+    """
+    def __init__(self, conn: Connection, metrics: RunMetrics = None):
+        self.conn = conn
+        self.metrics = metrics or RunMetrics();  """Metrics of all polls, exported with every report"""
+        self.stopping = asyncio.Event()
+        self.report_pending = asyncio.Event()
+        self.hosts_failed: dict[str, str] = {};  """Servers given up since the latest report"""
+        self.poll_tasks: set[asyncio.Task] = set()
+
+    def stop(self):
+        log.info(f'stopping the daemon')
+        self.stopping.set()
+        self.report_pending.set()  # the final report
+        for task in self.poll_tasks:
+            task.cancel()
+
+    async def run(self):
+        install_stop_handlers(self.stop)
+        urls = settings.urls_traffic_snapshots
+        prepare_ingest(self.conn, urls)
+        intervals = poll_intervals()
+        async with TrafficStatsCollector.create_http_client() as http_client:
+            async with asyncio.TaskGroup() as tg:
+                for url in urls:
+                    interval = intervals.get(urlparse(url).hostname, settings.daemon_poll_interval)
+                    task = tg.create_task(self.poll(url, interval, http_client))
+                    self.poll_tasks.add(task)
+                tg.create_task(self.report())
+        log.info(f'the daemon stopped')
+
+    async def poll(self, url: str, interval: float, http_client: aiohttp.ClientSession):
+        hostname = urlparse(url).hostname
+        log.info(f'{hostname}: polling every {interval} seconds')
+        while not self.stopping.is_set():
+            time_start = time.monotonic()
+            try:
+                with tcm.in_transaction(self.conn):
+                    last_datetimes = get_last_datetimes(get_app_root(self.conn))
+                with self.metrics.stage('fetch'):
+                    collector, num_parsed = await collect_and_ingest(
+                        self.conn, [url], last_datetimes, http_client, self.metrics
+                    )
+                if num_parsed or collector.hosts_failed:
+                    self.hosts_failed.update(collector.hosts_failed)
+                    self.report_pending.set()
+
+            except Exception as ex:
+                log.error(f'{hostname}: poll failed: {xdescr(ex)}')
+
+            await sleep_unless(self.stopping, interval - (time.monotonic() - time_start))
+
+    async def report(self):
+        self.report_pending.set()  # the report reflects the database state from the start
+        while True:
+            await self.report_pending.wait()
+            self.report_pending.clear()
+            hosts_failed, self.hosts_failed = self.hosts_failed, {}
+            try:
+                with self.metrics.stage('report'):
+                    write_report(self.conn)
+                export_metrics(self.metrics, hosts_failed, self.conn.db())
+            except Exception as ex:
+                if self.stopping.is_set():
+                    log.error(f'failed to write the report: {xdescr(ex)}')
+                    return
+                pause = settings.daemon_report_retry_pause
+                log.error(f'failed to write the report, retrying in {pause} seconds: {xdescr(ex)}')
+                self.hosts_failed = hosts_failed | self.hosts_failed
+                await sleep_unless(self.stopping, pause)
+                self.report_pending.set()
+            if self.stopping.is_set():
+                return
+
+
 def main():
     try:
         parser = argparse.ArgumentParser(
@@ -285,19 +1282,31 @@ def main():
             'config_uri', default=URI_CONFIG_DEFAULT, nargs='?',
             help='The URI to the configuration file.'
         )
+        parser.add_argument(
+            '--daemon', action='store_true',
+            help='Keep running, polling the servers and updating the report as new snapshots arrive.'
+        )
         args = parser.parse_args()
 
         # setup logging from config file settings
         setup_logging(args.config_uri)
 
-        # bootstrap Pyramid environment to get configuration
-        with bootstrap(args.config_uri) as env:
+        # read the configuration and open the database
+        with cli_env(args.config_uri, open_db=True) as conn:
+            metrics = RunMetrics()
             # compares the local time with the time received from the NTP servers
             # throws an exception if it differs significantly
-            verify_time_is_correct(diff_fatal=settings.max_allowable_time_drift)
-
-            log.debug('get database connection and run asyncio loop')
-            asyncio.run(make_report(conn=get_connection(request=env['request'])))
+            with metrics.stage('ntp_check'):
+                verify_time_is_correct(
+                    diff_fatal=settings.max_allowable_time_drift,
+                    cache_path=settings.time_check_cache or None, cache_ttl=settings.time_check_cache_ttl
+                )
+
+            log.debug('run asyncio loop')
+            if args.daemon:
+                asyncio.run(ReportDaemon(conn, metrics).run())
+            else:
+                asyncio.run(make_report(conn, metrics))
 
     except KeyboardInterrupt as ex:
         print(f'{xdescr(ex)}')
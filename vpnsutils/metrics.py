@@ -0,0 +1,202 @@
+"""
+Run instrumentation of makerep: stage durations, per-host request statistics and ingest counters,
+exported as a Prometheus textfile for the node exporter textfile collector and summarized in the log.
+"""
+
+import bisect
+import contextlib
+import os
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0);  """Upper bounds, seconds"""
+METRIC_PREFIX = 'makerep'
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus sense: the count of observations less or equal to every bound"""
+    def __init__(self, bounds: tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1);  """Observations per bucket, not cumulative; the last one is +Inf"""
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def buckets(self) -> Iterator[tuple[str, int]]:
+        """@return: iterator of (upper bound as the 'le' label value, cumulative count)"""
+        total = 0
+        for bound, num in zip([f'{x:g}' for x in self.bounds] + ['+Inf'], self.counts):
+            total += num
+            yield bound, total
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket the quantile falls into, None if there are no observations"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, num in zip(self.bounds + (float('inf'),), self.counts):
+            total += num
+            if total >= rank:
+                return bound
+
+
+class HostMetrics:
+    """Statistics of a single VPN server"""
+    def __init__(self):
+        self.requests = 0;  """Number of HTTP requests made, retries included"""
+        self.errors = 0;  """Number of failed HTTP requests"""
+        self.retries = 0;  """Number of HTTP requests repeated after a failure"""
+        self.bytes = 0;  """Response body bytes received, after content decoding"""
+        self.latency = Histogram();  """Time to the response headers, seconds"""
+        self.snapshots = 0;  """Number of snapshots ingested"""
+        self.tlog_records = 0;  """Number of traffic log records updated"""
+        self.stage_seconds: dict[str, float] = {};  """Ingest stage (parse, commit) => seconds"""
+
+
+class RunMetrics:
+    """
+    Metrics of makerep runs, all counters accumulate over the runs of the daemon mode. The ingest stages (parse,
+    commit) are measured in the ingest threads of the servers, they overlap with the fetch stage.
+    """
+    def __init__(self):
+        self.stage_seconds: dict[str, float] = {};  """Stage => seconds"""
+        self.hosts: dict[str, HostMetrics] = {}
+        self.hosts_failed: set[str] = set()
+        self.time_finished: float | None = None;  """Unix time the latest run finished"""
+        self.db_size: int | None = None;  """Database storage size after the latest run, bytes"""
+        self.db_objects: int | None = None;  """Number of objects in the database after the latest run"""
+        self._lock = threading.Lock()
+
+    def host(self, hostname: str) -> HostMetrics:
+        with self._lock:
+            if hostname not in self.hosts:
+                self.hosts[hostname] = HostMetrics()
+            return self.hosts[hostname]
+
+    @contextlib.contextmanager
+    def stage(self, name: str, hostname: str = None):
+        """Measure the duration of a stage, of the whole run or of a single server"""
+        time_start = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - time_start
+            stage_seconds = self.host(hostname).stage_seconds if hostname else self.stage_seconds
+            with self._lock:
+                stage_seconds[name] = stage_seconds.get(name, 0.0) + seconds
+
+    def request_done(self, hostname: str, latency: float | None, num_bytes: int = 0, retry: bool = False):
+        """
+        Record an HTTP request.
+        @param latency: time to the response headers, seconds; None if the request failed.
+        @param num_bytes: response body bytes received.
+        @param retry: the request repeats a failed one.
+        """
+        host = self.host(hostname)
+        host.requests += 1
+        host.retries += retry
+        host.bytes += num_bytes
+        if latency is None:
+            host.errors += 1
+        else:
+            host.latency.observe(latency)
+
+    def ingested(self, hostname: str, num_snapshots: int, num_tlog_records: int):
+        host = self.host(hostname)
+        with self._lock:
+            host.snapshots += num_snapshots
+            host.tlog_records += num_tlog_records
+
+    def finish(self, hosts_failed: dict[str, str], db_size: int = None, db_objects: int = None):
+        self.hosts_failed = set(hosts_failed)
+        self.time_finished = time.time()
+        self.db_size, self.db_objects = db_size, db_objects
+
+    def summary(self) -> dict:
+        """Short summary for the log"""
+        return {
+            'stages': {k: round(v, 3) for k, v in sorted(self.stage_seconds.items())},
+            'db': {'size': self.db_size, 'objects': self.db_objects},
+            'hosts': {
+                hostname: {
+                    'requests': x.requests, 'errors': x.errors, 'retries': x.retries, 'bytes': x.bytes,
+                    'latency_p50': x.latency.quantile(0.5), 'latency_p95': x.latency.quantile(0.95),
+                    'snapshots': x.snapshots, 'tlog_records': x.tlog_records,
+                    'stages': {k: round(v, 3) for k, v in sorted(x.stage_seconds.items())},
+                    'failed': hostname in self.hosts_failed,
+                }
+                for hostname, x in sorted(self.hosts.items())
+            },
+        }
+
+    def to_prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+        hosts = sorted(self.hosts.items())
+
+        def metric(name: str, kind: str, descr: str, samples: Iterable[tuple[str, dict[str, str], float]]):
+            """@param samples: iterable of (metric name suffix, labels, value)"""
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {descr}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} {kind}')
+            for suffix, labels, value in samples:
+                str_labels = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                str_value = repr(float(value)) if isinstance(value, float) else str(value)
+                lines.append(f'{METRIC_PREFIX}_{name}{suffix}{{{str_labels}}} {str_value}' if labels else
+                             f'{METRIC_PREFIX}_{name}{suffix} {str_value}')
+
+        def per_host(name: str, descr: str, attr: str):
+            metric(name, 'counter', descr, (('', {'host': h}, getattr(x, attr)) for h, x in hosts))
+
+        metric('stage_seconds_total', 'counter', 'Time spent in the stages of the runs, seconds.', (
+            ('', {'stage': k}, v) for k, v in sorted(self.stage_seconds.items())
+        ))
+        metric('host_stage_seconds_total', 'counter', 'Time spent ingesting the snapshots of the server, seconds.', (
+            ('', {'host': h, 'stage': k}, v) for h, x in hosts for k, v in sorted(x.stage_seconds.items())
+        ))
+        per_host('host_requests_total', 'HTTP requests made to the server, retries included.', 'requests')
+        per_host('host_request_errors_total', 'Failed HTTP requests to the server.', 'errors')
+        per_host('host_request_retries_total', 'HTTP requests to the server repeated after a failure.', 'retries')
+        per_host('host_response_bytes_total', 'Response body bytes received from the server.', 'bytes')
+        metric('host_request_latency_seconds', 'histogram', 'Time to the response headers, seconds.', (
+            sample for h, x in hosts for sample in [
+                *(('_bucket', {'host': h, 'le': le}, num) for le, num in x.latency.buckets()),
+                ('_sum', {'host': h}, x.latency.sum),
+                ('_count', {'host': h}, x.latency.count),
+            ]
+        ))
+        per_host('host_snapshots_ingested_total', 'Snapshots of the server parsed into the database.', 'snapshots')
+        per_host('host_tlog_records_total', 'Traffic log records updated with the server traffic.', 'tlog_records')
+        metric('host_failed', 'gauge', 'The server was given up in the latest run.', (
+            ('', {'host': h}, int(h in self.hosts_failed)) for h, x in hosts
+        ))
+        if self.db_size is not None:
+            metric('db_size_bytes', 'gauge', 'Database storage size, bytes.', [('', {}, self.db_size)])
+        if self.db_objects is not None:
+            metric('db_objects', 'gauge', 'Number of objects in the database.', [('', {}, self.db_objects)])
+        if self.time_finished:
+            metric('last_run_timestamp_seconds', 'gauge', 'Unix time the latest run finished.', [
+                ('', {}, self.time_finished)
+            ])
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, filepath: Path):
+        """Write the metrics atomically, the node exporter never sees a partially written file"""
+        filepath_tmp = filepath.with_name(f'{filepath.name}.{os.getpid()}.tmp')
+        try:
+            filepath_tmp.write_text(self.to_prometheus(), encoding='utf-8')
+            filepath_tmp.replace(filepath)
+
+        finally:
+            filepath_tmp.unlink(missing_ok=True)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -1,176 +1,248 @@
 """
 Convenient access to global application settings located in the ini-file.
 PyCharm typing support, misconfiguration detection and error reporting.
+
+All parameters are validated and converted once, when the settings are initialized, reading a parameter is
+a plain attribute access.
 """
 
-import inspect
-import pyramid.config
-import decimal
+import dataclasses
+from collections.abc import Callable, Mapping
+from typing import Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pyramid.config
+
+_REQUIRED = object();  """Marks a parameter without a default value"""
+
+
+def _param(parse: Callable[[str], Any], default: Any = _REQUIRED) -> Any:
+    """
+    Declare a settings parameter.
+    @param parse: converts the raw ini-file value, raises ValueError if the value is invalid.
+    @param default: value of the parameter missing in the ini-file; a required parameter missing in the ini-file
+        raises an error when read, so that an ini-file can omit the parameters of the other console scripts.
+    """
+    return dataclasses.field(metadata={'parse': parse, 'default': default})
+
 
+def _bool(raw_value: str) -> bool:
+    raw_value = raw_value.strip().lower()
+    if raw_value in ('true', 'yes', 'on', '1'):
+        return True
+    if raw_value in ('false', 'no', 'off', '0'):
+        return False
+    raise ValueError(f'not a boolean value: {raw_value}')
 
+
+def _str_list(raw_value: str) -> list[str]:
+    return [x.strip() for x in raw_value.strip().split('\n')] if raw_value and raw_value.strip() else []
+
+
+def _int_list(raw_value: str) -> list[int]:
+    return [int(x) for x in raw_value.split()]
+
+
+@dataclasses.dataclass(init=False, repr=False, eq=False, slots=True)
 class Settings:
     """Global application configuration settings"""
-    def __init__(self):
-        self._settings_dict = None
+    _settings_dict: Mapping[str, str] | None
 
-    def init(self, settings_dict: dict[str, str]):
-        if self._settings_dict:
-            raise RuntimeError(f'_settings_dict is already initialized')
-        self._settings_dict = settings_dict
+    xui_name: str = _param(str)
+    """Local 3X-UI server name"""
 
-    def _get_int_param(self) -> int:
-        param_key = inspect.currentframe().f_back.f_code.co_name  # the calling function name
-        if not self._settings_dict:
-            raise RuntimeError(f'_settings_dict is not initialized yet')
+    max_allowable_time_drift: float = _param(float)
+    """Maximum non-fatal local time drift with respect to NTP, seconds"""
 
-        try:
-            value = int(self._settings_dict[param_key])
-            return value
-        except Exception as e:
-            raise ValueError(f'invalid or misconfigured integer parameter "{param_key}": {e}')
+    time_check_cache: str = _param(str, '')
+    """File keeping the result of the latest successful NTP check, empty to query NTP servers on every start"""
 
-    def _get_decimal_param(self) -> decimal.Decimal:
-        param_key = inspect.currentframe().f_back.f_code.co_name  # the calling function name
-        if not self._settings_dict:
-            raise RuntimeError(f'_settings_dict is not initialized yet')
+    time_check_cache_ttl: float = _param(float, 300.0)
+    """Time the result of the latest successful NTP check is trusted by the commands started later, seconds"""
+
+    daemon_sample_interval: float = _param(float, 3600.0)
+    """
+    Interval between snapshots in the snapstat daemon mode, seconds. Snapshots are aligned to the wall clock,
+    e.g. 900 takes them at :00, :15, :30 and :45 of every hour.
+    """
 
-        try:
-            value = decimal.Decimal(str(self._settings_dict[param_key]))
-            return value
-        except Exception as e:
-            raise ValueError(f'invalid or misconfigured decimal parameter "{param_key}": {e}')
+    daemon_time_check_interval: float = _param(float, 86400.0)
+    """Interval between the checks of the system time against NTP in the snapstat daemon mode, seconds"""
 
-    def _get_float_param(self) -> float:
-        param_key = inspect.currentframe().f_back.f_code.co_name  # the calling function name
-        if not self._settings_dict:
-            raise RuntimeError(f'_settings_dict is not initialized yet')
+    xui_url: str = _param(str)
+    """Local 3X-UI server URL"""
 
-        try:
-            value = float(str(self._settings_dict[param_key]))
-            return value
-        except Exception as e:
-            raise ValueError(f'invalid or misconfigured decimal parameter "{param_key}": {e}')
+    xui_username: str = _param(str)
+    """Local 3X-UI username"""
 
-    def _get_str_param(self) -> str:
-        param_key = inspect.currentframe().f_back.f_code.co_name  # the calling function name
-        if not self._settings_dict:
-            raise RuntimeError(f'_settings_dict is not initialized yet')
+    xui_password: str = _param(str)
+    """Local 3X-UI password"""
 
-        try:
-            value = self._settings_dict[param_key]
-            return value
-        except Exception as e:
-            raise ValueError(f'invalid or misconfigured string parameter "{param_key}": {e}')
+    dir_snapshots: str = _param(str)
+    """Directory for saving traffic snapshots"""
 
-    def _get_int_list_param(self) -> list[int]:
-        param_key = inspect.currentframe().f_back.f_code.co_name  # the calling function name
-        if not self._settings_dict:
-            raise RuntimeError(f'_settings_dict is not initialized yet')
+    dir_report: str = _param(str)
+    """Directory for saving the report"""
+
+    dir_listing_cache: str = _param(str, '')
+    """Directory for caching the directory listings fetched from the VPN servers, empty to disable caching"""
+
+    dir_spool: str = _param(str, '')
+    """Directory for keeping the downloaded snapshots until they are ingested, empty to disable the spool"""
+
+    metrics_textfile: str = _param(str, '')
+    """File for the makerep metrics in the Prometheus text format, for the node exporter textfile collector"""
+
+    urls_traffic_snapshots: list[str] = _param(_str_list)
+    """List of URLs for VPN server traffic statistics"""
+
+    daemon_poll_interval: int = _param(int, 300)
+    """Interval between polls of a VPN server in the makerep daemon mode, seconds"""
+
+    daemon_poll_intervals: list[str] = _param(_str_list, [])
+    """Poll intervals of particular VPN servers in the makerep daemon mode, lines of: hostname seconds"""
+
+    daemon_report_retry_pause: float = _param(float, 10.0)
+    """Pause before writing the report again after a failure in the makerep daemon mode, seconds"""
+
+    snapshot_dict_datetime_key: str = _param(str)
+    """key name datetime value saved in snapshot json"""
 
-        try:
-            raw_value = self._settings_dict[param_key]
-            value = [int(x.strip()) for x in raw_value.split(',')] if raw_value and raw_value.strip() else []
-            return value
-        except Exception as e:
-            raise ValueError(f'invalid or misconfigured list of integers parameter "{param_key}": {e}')
+    snapshot_dict_comment_key: str = _param(str)
+    """Key name for comment saved in snapshot json"""
 
-    def _get_str_list_param(self) -> list[str]:
-        param_key = inspect.currentframe().f_back.f_code.co_name  # the calling function name
-        if not self._settings_dict:
+    snapshot_dict_base_key: str = _param(str, '__base')
+    """Key name for the datetime of the snapshot a delta snapshot is relative to"""
+
+    snapshot_keyframe_interval: int = _param(int, 0)
+    """Save a full snapshot every N snapshots and only changed counters in between, 0 or 1 to disable deltas"""
+
+    snapshot_save_binary: bool = _param(_bool, False)
+    """Save each snapshot in the compact binary format too, next to the json one"""
+
+    snapshot_fetch_binary: bool = _param(_bool, True)
+    """Prefer the compact binary snapshot format when fetching snapshots, fall back to json"""
+
+    report_window_hours: int = _param(int, 168)
+    """Length of the rolling window of the traffic usage report, hours"""
+
+    report_totals_days: list[int] = _param(_int_list, [30, 90])
+    """Lengths of the periods the report gives the traffic totals for, read from the traffic log tiers, days"""
+
+    report_issues_days: int = _param(int, 7)
+    """The report lists the issues seen within this number of days"""
+
+    report_issues_max: int = _param(int, 100)
+    """Maximum number of the latest issues listed in the report"""
+
+    issues_retention_days: int = _param(int, 90)
+    """Issues not seen for this number of days are removed from the issues logs"""
+
+    issues_max_entries: int = _param(int, 500)
+    """Maximum number of issues kept in an issues log of a server, the oldest ones are removed"""
+
+    tlog_hourly_retention_days: int = _param(int, 31)
+    """Age after which the hourly traffic log records are rolled up into daily ones by "dbmaint rollup", days"""
+
+    tlog_daily_retention_days: int = _param(int, 366)
+    """Age after which the daily traffic log records are rolled up into monthly ones by "dbmaint rollup", days"""
+
+    zodb_pack_days: float = _param(float, 7.0)
+    """History kept by "dbmaint pack": object revisions older than this number of days are removed"""
+
+    ingest_high_water_mark: int = _param(int, 50)
+    """Maximum number of fetched snapshots per host waiting to be parsed, further fetches are paused"""
+
+    ingest_checkpoint_snapshots: int = _param(int, 100)
+    """Number of snapshots of a host parsed in a single transaction before the ingest state is committed"""
+
+    ingest_checkpoint_seconds: int = _param(int, 30)
+    """Maximum duration of a single ingest transaction of a host, seconds"""
+
+    aiohttp_limit_per_host: int = _param(int)
+    """Maximum number of simultaneous HTTP connections"""
+
+    aiohttp_limit_per_host_initial: int = _param(int, 4)
+    """Initial number of simultaneous HTTP requests to a host, adapted to its latency and errors during a run"""
+
+    aiohttp_breaker_failures: int = _param(int, 10)
+    """Number of consecutive failed HTTP requests to a host after which it is given up for the run"""
+
+    collector_deadline: int = _param(int, 900)
+    """Maximum duration of collecting the snapshots, hosts not finished by then are given up, seconds; 0 - none"""
+
+    aiohttp_tries: int = _param(int)
+    """The number of attempts to execute an HTTP request before failure"""
+
+    aiohttp_retry_pause_initial: float = _param(float)
+    """Pause after the first failed HTTP request, seconds"""
+
+    aiohttp_retry_pause_multiplier: float = _param(float)
+    """Multiplier for the next pause in case of unsuccessful repeated HTTP request"""
+
+    snapshot_filename_suffix_format: str = _param(str)
+    """File name suffix format for saving a snapshot"""
+
+    snapshot_filename_suffix_length: int = _param(int)
+    """The length of the file name suffix according to the format"""
+
+    def __init__(self):
+        object.__setattr__(self, '_settings_dict', None)
+
+    def __setattr__(self, name: str, value):
+        # frozen=True of dataclass is broken for slotted classes in Python 3.11
+        raise dataclasses.FrozenInstanceError(f'cannot assign to field "{name}", the settings are read-only')
+
+    def __delattr__(self, name: str):
+        raise dataclasses.FrozenInstanceError(f'cannot delete field "{name}", the settings are read-only')
+
+    def __getattr__(self, name: str):
+        # called only for the parameters not set by load()
+        if self._settings_dict is None:
             raise RuntimeError(f'_settings_dict is not initialized yet')
+        raise ValueError(f'missing parameter "{name}"')
 
-        try:
-            raw_value = self._settings_dict[param_key]
-            value = [x.strip() for x in raw_value.strip().split('\n')] if raw_value and raw_value.strip() else []
-            return value
-        except Exception as e:
-            raise ValueError(f'invalid or misconfigured list of string parameter "{param_key}": {e}')
-
-    @property
-    def xui_name(self) -> str:
-        """Local 3X-UI server name"""
-        return self._get_str_param()
-
-    @property
-    def max_allowable_time_drift(self) -> float:
-        """Maximum non-fatal local time drift with respect to NTP, seconds"""
-        return self._get_float_param()
-
-    @property
-    def xui_url(self) -> str:
-        """Local 3X-UI server URL"""
-        return self._get_str_param()
-
-    @property
-    def xui_username(self) -> str:
-        """Local 3X-UI username"""
-        return self._get_str_param()
-
-    @property
-    def xui_password(self) -> str:
-        """Local 3X-UI password"""
-        return self._get_str_param()
-
-    @property
-    def dir_snapshots(self) -> str:
-        """Directory for saving traffic snapshots"""
-        return self._get_str_param()
-
-    @property
-    def dir_report(self) -> str:
-        """Directory for saving the report"""
-        return self._get_str_param()
-
-    @property
-    def urls_traffic_snapshots(self) -> list[str]:
-        """List of URLs for VPN server traffic statistics"""
-        return self._get_str_list_param()
-
-    @property
-    def snapshot_dict_datetime_key(self) -> str:
-        """key name datetime value saved in snapshot json"""
-        return self._get_str_param()
-
-    @property
-    def snapshot_dict_comment_key(self) -> str:
-        """Key name for comment saved in snapshot json"""
-        return self._get_str_param()
-
-    @property
-    def aiohttp_limit_per_host(self) -> int:
-        """Maximum number of simultaneous HTTP connections"""
-        return self._get_int_param()
-
-    @property
-    def aiohttp_tries(self) -> int:
-        """The number of attempts to execute an HTTP request before failure"""
-        return self._get_int_param()
-
-    @property
-    def aiohttp_retry_pause_initial(self) -> float:
-        """Pause after the first failed HTTP request, seconds"""
-        return self._get_float_param()
-
-    @property
-    def aiohttp_retry_pause_multiplier(self) -> float:
-        """Multiplier for the next pause in case of unsuccessful repeated HTTP request"""
-        return self._get_float_param()
-
-    @property
-    def snapshot_filename_suffix_format(self) -> str:
-        """File name suffix format for saving a snapshot"""
-        return self._get_str_param()
-
-    @property
-    def snapshot_filename_suffix_length(self) -> int:
-        """The length of the file name suffix according to the format"""
-        return self._get_int_param()
+    def init(self, settings_dict: Mapping[str, str]):
+        if self._settings_dict:
+            raise RuntimeError(f'_settings_dict is already initialized')
+        self.load(settings_dict)
+
+    def load(self, settings_dict: Mapping[str, str]):
+        """
+        Validate and convert all parameters, replacing the current values. Raises ValueError listing all invalid
+        parameters. Besides init(), used by tests to override parameters.
+        """
+        values = {}
+        errors = []
+        for field in dataclasses.fields(self):
+            if 'parse' not in field.metadata:
+                continue
+            if field.name not in settings_dict:
+                if field.metadata['default'] is not _REQUIRED:
+                    values[field.name] = field.metadata['default']
+                continue
+            try:
+                values[field.name] = field.metadata['parse'](str(settings_dict[field.name]))
+            except Exception as e:
+                errors.append(f'invalid or misconfigured parameter "{field.name}": {e}')
+        if errors:
+            raise ValueError('; '.join(errors))
+
+        for field in dataclasses.fields(self):
+            if field.name in values:
+                object.__setattr__(self, field.name, values[field.name])
+            elif 'parse' in field.metadata:
+                try:
+                    object.__delattr__(self, field.name)  # missing in the new settings
+                except AttributeError:
+                    pass
+        object.__setattr__(self, '_settings_dict', settings_dict)
 
 
 settings = Settings()
 
 
-def includeme(config: pyramid.config.Configurator):
+def includeme(config: 'pyramid.config.Configurator'):
     """This function is called by the Pyramid configurator.
     """
     settings.init(config.registry.settings)
@@ -0,0 +1,160 @@
+"""
+Compact binary traffic snapshot format.
+
+Layout, all integers little-endian:
+    header: magic, format version, flags, number of users, snapshot datetime and base datetime (delta snapshots only)
+            as microseconds since the Unix Epoch;
+    uint32[n+1]: offsets of user ids in the names block;
+    names block: utf-8 encoded user ids, sorted bytewise, padded with zeros to a multiple of 8 bytes;
+    uint64[n]: bytes downloaded;
+    uint64[n]: bytes uploaded.
+
+The arrays are used in place via memoryview, no per-user Python objects are created on loading.
+"""
+
+import bisect
+import struct
+import sys
+from collections.abc import Iterator, Mapping
+from datetime import datetime, timedelta, timezone
+
+MAGIC = b'VSNB'
+VERSION = 1
+FLAG_DELTA = 1;  """The snapshot contains only counters changed since the base snapshot"""
+CONTENT_TYPE = 'application/x-vpnsutils-snapshot'
+FILENAME_SUFFIX = '.bin';  """Replaces the .json suffix of the snapshot file name"""
+
+_header = struct.Struct('<4sHHIqq')
+_epoch = datetime(year=1970, month=1, day=1, tzinfo=timezone.utc)
+
+
+def _to_micros(dt: datetime) -> int:
+    return (dt - _epoch) // timedelta(microseconds=1)
+
+
+def _from_micros(micros: int) -> datetime:
+    return _epoch + timedelta(microseconds=micros)
+
+
+def _pad8(size: int) -> int:
+    return (size + 7) // 8 * 8
+
+
+def is_binary_snapshot(data: bytes | memoryview) -> bool:
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def encode_snapshot(counters: dict[str, list[int]], dt: datetime, dt_base: datetime = None) -> bytes:
+    """
+    Encode traffic counters to the binary snapshot format.
+    @param counters: user_id => [bytes downloaded, bytes uploaded].
+    @param dt: the snapshot date/time.
+    @param dt_base: date/time of the snapshot the delta is relative to, None for a full snapshot.
+    """
+    names = sorted(x.encode('utf-8') for x in counters)
+    offsets = [0]
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+    blob = b''.join(names)
+    blob += bytes(_pad8(len(blob)) - len(blob))
+
+    num = len(names)
+    counters_by_name = {k.encode('utf-8'): v for k, v in counters.items()}
+    parts = [
+        _header.pack(MAGIC, VERSION, FLAG_DELTA if dt_base else 0, num, _to_micros(dt), _to_micros(dt_base or _epoch)),
+        struct.pack(f'<{num + 1}I', *offsets),
+        bytes(_pad8(4 * (num + 1)) - 4 * (num + 1)),
+        blob,
+        struct.pack(f'<{num}Q', *(counters_by_name[x][0] for x in names)),
+        struct.pack(f'<{num}Q', *(counters_by_name[x][1] for x in names)),
+    ]
+    return b''.join(parts)
+
+
+class BinarySnapshot(Mapping):
+    """
+    Read-only view of a binary snapshot with the same mapping interface as a snapshot loaded from json:
+    user_id => (bytes downloaded, bytes uploaded), plus the datetime and, for delta snapshots, the base datetime keys.
+    """
+    def __init__(self, data: bytes, datetime_key: str, base_key: str):
+        if len(data) < _header.size or not is_binary_snapshot(data):
+            raise ValueError('not a binary snapshot')
+        magic, version, flags, num, dt_micros, base_micros = _header.unpack_from(data)
+        if version != VERSION:
+            raise ValueError(f'unsupported binary snapshot version: {version}')
+
+        size_offsets = 4 * (num + 1)
+        pos = _header.size
+        mv = memoryview(data)
+        offsets = mv[pos:pos + size_offsets]
+        pos += _pad8(size_offsets)
+        offsets_end = offsets[-4:].cast('I')[0] if sys.byteorder == 'little' else struct.unpack('<I', offsets[-4:])[0]
+        self._names = bytes(mv[pos:pos + offsets_end])
+        pos += _pad8(offsets_end)
+        size_counters = 8 * num
+        down, up = mv[pos:pos + size_counters], mv[pos + size_counters:pos + 2 * size_counters]
+        if len(up) != size_counters:
+            raise ValueError('binary snapshot is truncated')
+
+        if sys.byteorder == 'little':
+            self._offsets, self._down, self._up = offsets.cast('I'), down.cast('Q'), up.cast('Q')
+        else:
+            self._offsets = struct.unpack(f'<{num + 1}I', offsets)
+            self._down, self._up = struct.unpack(f'<{num}Q', down), struct.unpack(f'<{num}Q', up)
+
+        self._num = num
+        self._meta = {datetime_key: _from_micros(dt_micros).isoformat()}
+        if flags & FLAG_DELTA:
+            self._meta[base_key] = _from_micros(base_micros).isoformat()
+
+    def _name(self, idx: int) -> bytes:
+        return self._names[self._offsets[idx]:self._offsets[idx + 1]]
+
+    def _index(self, user_id: str) -> int:
+        name = user_id.encode('utf-8')
+        idx = bisect.bisect_left(range(self._num), name, key=self._name)
+        if idx < self._num and self._name(idx) == name:
+            return idx
+        return -1
+
+    def __getitem__(self, key: str):
+        if key in self._meta:
+            return self._meta[key]
+        idx = self._index(key)
+        if idx < 0:
+            raise KeyError(key)
+        return self._down[idx], self._up[idx]
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._meta
+        for idx in range(self._num):
+            yield self._name(idx).decode('utf-8')
+
+    def __len__(self) -> int:
+        return len(self._meta) + self._num
+
+    def items_changed(self, prev: 'BinarySnapshot') -> Iterator[tuple[str, tuple[int, int]]]:
+        """
+        Iterate over users whose counters differ from those in the previous snapshot.
+        Users are compared by position if both snapshots have the same user table, the common case.
+        """
+        if self._names != prev._names or self._offsets != prev._offsets:
+            for key in self:
+                if key not in self._meta and self[key] != prev.get(key, None):
+                    yield key, self[key]
+            return
+
+        down, up, down_prev, up_prev = self._down, self._up, prev._down, prev._up
+        for idx in range(self._num):
+            if down[idx] != down_prev[idx] or up[idx] != up_prev[idx]:
+                yield self._name(idx).decode('utf-8'), (down[idx], up[idx])
+
+    def to_numpy(self):
+        """
+        User ids and counters as NumPy arrays sharing memory with the snapshot data. NumPy is an optional dependency.
+        @return: tuple of: list of user ids, uint64 array of bytes downloaded, uint64 array of bytes uploaded.
+        """
+        import numpy
+        user_ids = [self._name(x).decode('utf-8') for x in range(self._num)]
+        dtype = numpy.dtype('<u8')
+        return user_ids, numpy.frombuffer(self._down, dtype=dtype), numpy.frombuffer(self._up, dtype=dtype)
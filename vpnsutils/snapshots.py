@@ -0,0 +1,238 @@
+"""
+Layout of the traffic snapshots directory shared by snapstat (the writer) and makerep (the reader).
+"""
+
+import gzip
+import json
+import logging
+import zlib
+from collections.abc import AsyncIterable, Iterator
+from datetime import datetime, date
+from pathlib import Path, PurePosixPath
+
+# module import
+from helpers.misc import json_dumps
+
+# local imports
+from . import snapbin
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = 'manifest.jsonl';  """Append-only list of saved snapshots in the root of the snapshots directory"""
+MANIFEST_RECORD_SIZE_ESTIMATE = 120;   """Approximate length of a single manifest line, bytes"""
+BUNDLE_FILENAME = 'bundle.ndjson.gz';  """All snapshots of a finished day, one json per line, gzip-compressed"""
+STATE_FILENAME = '.snapstat-state.json';  """Counters of the latest snapshot saved, the base for the next delta"""
+
+
+def manifest_record(path: str, dt: datetime, size: int, path_binary: str = None) -> dict:
+    """
+    Create a manifest record for a saved snapshot.
+    @param path: snapshot file path relative to the snapshots directory, always with forward slashes.
+    @param dt: the snapshot date/time, as saved in the snapshot itself.
+    @param size: the snapshot file size, bytes.
+    @param path_binary: path of the same snapshot saved in the binary format, if any.
+    """
+    record = {'path': path, 'datetime': dt.isoformat(), 'size': size}
+    if path_binary:
+        record['binary'] = path_binary
+    return record
+
+
+def manifest_record_datetime(record: dict) -> datetime:
+    return datetime.fromisoformat(record['datetime'])
+
+
+def is_bundle_path(path: str) -> bool:
+    return PurePosixPath(path).name == BUNDLE_FILENAME
+
+
+def day_dir(path: str) -> str:
+    """The day directory a snapshot or a bundle belongs to, i.e. 'YYYY/MM/DD'"""
+    return str(PurePosixPath(path).parent)
+
+
+def parse_manifest(data: bytes, skip_first_line: bool = False) -> list[dict]:
+    """
+    Parse manifest content.
+    @param data: manifest file content or its tail.
+    @param skip_first_line: the data is a tail of the manifest, the first line can be incomplete.
+    @return: list of manifest records in the order of appending.
+    """
+    lines = data.split(b'\n')
+    if skip_first_line:
+        lines = lines[1:]
+
+    return [json.loads(x) for x in lines if x.strip()]
+
+
+def build_manifest(dir_snapshots: Path, filename_prefix: str, datetime_key: str) -> list[dict]:
+    """
+    Scan the snapshots directory tree and create manifest records for all snapshots found.
+    Used once to seed the manifest on servers that have been saving snapshots before manifests were introduced.
+    @param dir_snapshots: root of the snapshots directory.
+    @param filename_prefix: snapshot file name prefix, i.e. the local 3X-UI server name followed by a dash.
+    @param datetime_key: key name of the datetime value saved in snapshot json.
+    """
+    records = []
+    for filepath in dir_snapshots.glob(f'[0-9][0-9][0-9][0-9]/[0-9][0-9]/[0-9][0-9]/{filename_prefix}*'):
+        if filepath.suffix in ('.tmp', snapbin.FILENAME_SUFFIX) or not filepath.is_file():
+            continue
+        try:
+            with filepath.open(mode='r', encoding='utf-8') as f:
+                dt = datetime.fromisoformat(json.load(f)[datetime_key])
+        except Exception as ex:
+            log.warning(f'skipping unreadable snapshot {filepath}: {ex}')
+            continue
+        path = filepath.relative_to(dir_snapshots).as_posix()
+        filepath_binary = filepath.with_suffix(snapbin.FILENAME_SUFFIX)
+        path_binary = filepath_binary.relative_to(dir_snapshots).as_posix() if filepath_binary.exists() else None
+        records.append(manifest_record(path, dt, filepath.stat().st_size, path_binary))
+
+    for filepath in dir_snapshots.glob(f'[0-9][0-9][0-9][0-9]/[0-9][0-9]/[0-9][0-9]/{BUNDLE_FILENAME}'):
+        snapshots = list(read_bundle(filepath))
+        if snapshots:
+            path = filepath.relative_to(dir_snapshots).as_posix()
+            dt = datetime.fromisoformat(snapshots[-1][datetime_key])
+            records.append(manifest_record(path, dt, filepath.stat().st_size))
+
+    records.sort(key=manifest_record_datetime)
+    return records
+
+
+def update_manifest(dir_snapshots: Path, records: list[dict], filename_prefix: str, datetime_key: str):
+    """
+    Append records to the manifest. If there is no manifest yet, create it listing all snapshots saved so far,
+    the files described by the records are expected to be already saved.
+    """
+    filepath = dir_snapshots.joinpath(MANIFEST_FILENAME)
+    if filepath.exists():
+        with filepath.open(mode='a', encoding='utf-8') as f:
+            f.writelines(f'{json_dumps(x, indent=False)}\n' for x in records)
+        return
+
+    records = build_manifest(dir_snapshots, filename_prefix, datetime_key)
+    log.info(f'creating manifest with {len(records)} records: {filepath}')
+    filepath_tmp = dir_snapshots.joinpath(f'{MANIFEST_FILENAME}.tmp')
+    try:
+        with filepath_tmp.open(mode='w', encoding='utf-8') as f:
+            f.writelines(f'{json_dumps(x, indent=False)}\n' for x in records)
+        filepath_tmp.rename(filepath)
+
+    finally:
+        filepath_tmp.unlink(missing_ok=True)
+
+
+def read_bundle(filepath: Path) -> Iterator[dict]:
+    """Read snapshots from a local bundle file"""
+    with gzip.open(filepath, mode='rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+async def parse_bundle_stream(chunks: AsyncIterable[bytes]) -> AsyncIterable[dict]:
+    """
+    Parse bundle content while it is being received.
+    The content is decompressed only if it starts with the gzip magic number: the HTTP client may have already
+    decompressed it if the server declared gzip content encoding.
+    """
+    decompressor = None
+    tail = b''
+    async for chunk in chunks:
+        if decompressor is None:
+            decompressor = zlib.decompressobj(wbits=31) if chunk[:2] == b'\x1f\x8b' else False
+        data = tail + (decompressor.decompress(chunk) if decompressor else chunk)
+        lines = data.split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+    if decompressor:
+        tail += decompressor.flush()
+    if tail.strip():
+        yield json.loads(tail)
+
+
+def compact_days(dir_snapshots: Path, filename_prefix: str, datetime_key: str, date_before: date) -> list[dict]:
+    """
+    Fold every finished day directory into a single bundle file. The snapshot files themselves are kept.
+    @param dir_snapshots: root of the snapshots directory.
+    @param filename_prefix: snapshot file name prefix, i.e. the local 3X-UI server name followed by a dash.
+    @param datetime_key: key name of the datetime value saved in snapshot json.
+    @param date_before: only days earlier than this date are considered finished.
+    @return: manifest records of the bundles created.
+    """
+    records = []
+    for path_day in sorted(dir_snapshots.glob('[0-9][0-9][0-9][0-9]/[0-9][0-9]/[0-9][0-9]')):
+        try:
+            day = date(int(path_day.parent.parent.name), int(path_day.parent.name), int(path_day.name))
+        except ValueError:
+            continue
+        if day >= date_before or path_day.joinpath(BUNDLE_FILENAME).exists():
+            continue
+
+        snapshots = []
+        for filepath in sorted(path_day.glob(f'{filename_prefix}*')):
+            if filepath.suffix in ('.tmp', snapbin.FILENAME_SUFFIX) or not filepath.is_file():
+                continue
+            with filepath.open(mode='r', encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        if not snapshots:
+            continue
+
+        snapshots.sort(key=lambda x: x[datetime_key])
+        filepath = path_day.joinpath(BUNDLE_FILENAME)
+        filepath_tmp = path_day.joinpath(f'{BUNDLE_FILENAME}.tmp')
+        log.info(f'compacting {len(snapshots)} snapshot(s) to: {filepath}')
+        try:
+            with gzip.open(filepath_tmp, mode='wt', encoding='utf-8') as f:
+                f.writelines(f'{json_dumps(x, indent=False)}\n' for x in snapshots)
+            filepath_tmp.rename(filepath)
+
+        finally:
+            filepath_tmp.unlink(missing_ok=True)
+
+        path = filepath.relative_to(dir_snapshots).as_posix()
+        dt = datetime.fromisoformat(snapshots[-1][datetime_key])
+        records.append(manifest_record(path, dt, filepath.stat().st_size))
+
+    return records
+
+
+def make_delta(counters: dict[str, list[int]], counters_prev: dict[str, list[int]]) -> dict[str, list[int]]:
+    """Select the counters that have changed (or appeared) since the previous snapshot"""
+    return {k: v for k, v in counters.items() if counters_prev.get(k) != v}
+
+
+def load_state(dir_snapshots: Path) -> dict | None:
+    """
+    Load the state saved along with the latest snapshot.
+    @return: dict with keys: 'datetime' - ISO datetime of the latest snapshot, 'since_keyframe' - number of delta
+        snapshots saved after the latest full snapshot, 'counters' - all counters of the latest snapshot;
+        None if there is no valid state.
+    """
+    filepath = dir_snapshots.joinpath(STATE_FILENAME)
+    try:
+        with filepath.open(mode='r', encoding='utf-8') as f:
+            state = json.load(f)
+        _unused = state['datetime'], state['since_keyframe'], state['counters']
+        return state
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        log.warning(f'ignoring invalid state file {filepath}: {ex}')
+        return None
+
+
+def save_state(dir_snapshots: Path, dt: datetime, since_keyframe: int, counters: dict[str, list[int]]):
+    filepath = dir_snapshots.joinpath(STATE_FILENAME)
+    filepath_tmp = dir_snapshots.joinpath(f'{STATE_FILENAME}.tmp')
+    state = {'datetime': dt.isoformat(), 'since_keyframe': since_keyframe, 'counters': counters}
+    try:
+        with filepath_tmp.open(mode='w', encoding='utf-8') as f:
+            f.write(json_dumps(state, indent=False))
+        filepath_tmp.rename(filepath)
+
+    finally:
+        filepath_tmp.unlink(missing_ok=True)
@@ -1,9 +1,11 @@
 import argparse
+import asyncio
 import logging
-from pyramid.paster import bootstrap, setup_logging
-from py3xui import Api
+import time
 from suid import utcnow
 from pathlib import Path
+from datetime import datetime
+from typing import TYPE_CHECKING
 
 # module import
 from helpers.checktime import verify_time_is_correct
@@ -11,29 +13,70 @@ from helpers.misc import xdescr, json_dumps
 
 # local imports
 from .settings import settings
+from . import snapbin
+from .snapbin import encode_snapshot
+from .snapshots import manifest_record, update_manifest, compact_days, load_state, save_state, make_delta
+from .daemon import install_stop_handlers, sleep_unless
+from .cli import cli_env, setup_logging
 from . import sys_exit
 
+if TYPE_CHECKING:
+    from py3xui import Api
+
 log = logging.getLogger(__name__)
 
 URI_CONFIG_DEFAULT = 'config/snapstat.ini'
 
 
-def save_stats():
-    stats = {}
+def connect() -> 'Api':
+    from py3xui import Api  # takes a while to import, not needed until the snapshot is due in the daemon mode
     log.info(f'connecting to: {settings.xui_name}')
     api = Api(settings.xui_url, settings.xui_username, settings.xui_password)
     api.login()
+    return api
+
+
+def fetch_counters(api: 'Api') -> tuple[datetime, dict[str, list[int]]]:
+    """
+    Read the traffic counters of all clients of the local 3X-UI server.
+    @return: tuple of: the reading date/time, client_id => [bytes downloaded, bytes uploaded].
+    """
+    counters = {}
     dt_stats = utcnow()
     inbounds = api.inbound.get_list()
     for inbound in inbounds:
         for cstats in inbound.client_stats:
-            stats[cstats.email] = (cstats.down, cstats.up)
+            counters[cstats.email] = [cstats.down, cstats.up]
+    return dt_stats, counters
+
+
+def save_stats():
+    save_snapshot(*fetch_counters(connect()))
+
+
+def save_snapshot(dt_stats: datetime, counters: dict[str, list[int]]):
+    """Save the counters as a full or delta snapshot and register it in the manifest"""
+    dir_snapshots = Path(settings.dir_snapshots)
+    state = load_state(dir_snapshots) if settings.snapshot_keyframe_interval > 1 else None
+    if state and state['since_keyframe'] + 1 < settings.snapshot_keyframe_interval:
+        # save only the counters changed since the previous snapshot
+        stats = make_delta(counters, state['counters'])
+        stats[settings.snapshot_dict_base_key] = state['datetime']
+        dt_base = datetime.fromisoformat(state['datetime'])
+        stats[settings.snapshot_dict_comment_key] = (
+            f'client_id => [bytes downloaded, bytes uploaded], changed since {settings.snapshot_dict_base_key} only'
+        )
+        since_keyframe = state['since_keyframe'] + 1
+    else:
+        stats = dict(counters)
+        stats[settings.snapshot_dict_comment_key] = 'client_id => [bytes downloaded, bytes uploaded]'
+        dt_base = None
+        since_keyframe = 0
 
     stats[settings.snapshot_dict_datetime_key] = dt_stats
-    stats[settings.snapshot_dict_comment_key] = 'client_id => [bytes downloaded, bytes uploaded]'
 
     str_stats = json_dumps(stats)
-    path_out = Path(settings.dir_snapshots, f'{dt_stats:%Y/%m/%d}')
+    path_out = dir_snapshots.joinpath(f'{dt_stats:%Y/%m/%d}')
     path_out.mkdir(parents=True, exist_ok=True)
     filename = f'{settings.xui_name}-{dt_stats:{settings.snapshot_filename_suffix_format}}'
     filepath_tmp = path_out.joinpath(f'{filename}.tmp')
@@ -49,6 +92,103 @@ def save_stats():
 
     log.info(f'saved to: {filepath}')
 
+    filepath_binary = None
+    if settings.snapshot_save_binary:
+        keys_meta = (
+            settings.snapshot_dict_datetime_key, settings.snapshot_dict_comment_key, settings.snapshot_dict_base_key
+        )
+        data = encode_snapshot({k: v for k, v in stats.items() if k not in keys_meta}, dt_stats, dt_base)
+        filepath_binary = filepath.with_suffix(snapbin.FILENAME_SUFFIX)
+        filepath_tmp = path_out.joinpath(f'{filepath_binary.name}.tmp')
+        try:
+            filepath_tmp.write_bytes(data)
+            filepath_tmp.rename(filepath_binary)
+
+        finally:
+            filepath_tmp.unlink(missing_ok=True)
+
+        log.info(f'saved to: {filepath_binary}')
+
+    if settings.snapshot_keyframe_interval > 1:
+        save_state(dir_snapshots, dt_stats, since_keyframe, counters)
+
+    # register the snapshot in the manifest, so that the collector does not need to walk the directory tree
+    record = manifest_record(
+        path=filepath.relative_to(dir_snapshots).as_posix(), dt=dt_stats, size=filepath.stat().st_size,
+        path_binary=filepath_binary.relative_to(dir_snapshots).as_posix() if filepath_binary else None
+    )
+    filename_prefix = f'{settings.xui_name}-'
+    datetime_key = settings.snapshot_dict_datetime_key
+    update_manifest(dir_snapshots, [record], filename_prefix=filename_prefix, datetime_key=datetime_key)
+
+    # fold finished days into bundles, so that the collector can fetch a whole day with a single request
+    records = compact_days(dir_snapshots, filename_prefix, datetime_key, date_before=dt_stats.date())
+    if records:
+        update_manifest(dir_snapshots, records, filename_prefix=filename_prefix, datetime_key=datetime_key)
+
+
+def next_sample_time(now: float, interval: float) -> float:
+    """The earliest multiple of the interval after now, both in seconds since the Unix Epoch"""
+    return (now // interval + 1) * interval
+
+
+class StatsDaemon:
+    """
+    Resident mode of snapstat: saves snapshots on a wall-clock schedule. The 3X-UI session is kept between snapshots
+    and renewed only when the server rejects it, the system time is checked against NTP only once in a while.
+    Stops on SIGTERM or SIGINT, a snapshot being taken at the moment is saved first.
+    """
+    def __init__(self):
+        self.stopping = asyncio.Event()
+        self.api: 'Api | None' = None;  """Logged in 3X-UI API client"""
+        self.time_checked: float | None = None;  """Monotonic time of the latest successful system time check"""
+
+    def stop(self):
+        log.info(f'stopping the daemon')
+        self.stopping.set()
+
+    async def run(self):
+        install_stop_handlers(self.stop)
+        interval = settings.daemon_sample_interval
+        log.info(f'saving snapshots every {interval} seconds')
+        time_next = next_sample_time(time.time(), interval)
+        while not self.stopping.is_set():
+            delay = time_next - time.time()
+            if delay > 0:
+                # wake up at least every minute to follow the wall clock should it be stepped meanwhile
+                await sleep_unless(self.stopping, min(delay, 60.0))
+                continue
+
+            try:
+                await asyncio.to_thread(self.sample)
+            except Exception as ex:
+                log.error(f'failed to save a snapshot: {xdescr(ex)}')
+            time_next = next_sample_time(time.time(), interval)
+
+        log.info(f'the daemon stopped')
+
+    def sample(self):
+        if self.time_checked is None or time.monotonic() - self.time_checked >= settings.daemon_time_check_interval:
+            # do not wait for NTP servers endlessly, the check is repeated on the next snapshot if failed to measure
+            if verify_time_is_correct(wait=False, diff_fatal=settings.max_allowable_time_drift) is not None:
+                self.time_checked = time.monotonic()
+
+        save_snapshot(*self.fetch_counters())
+
+    def fetch_counters(self) -> tuple[datetime, dict[str, list[int]]]:
+        from requests import HTTPError
+        if self.api is None:
+            self.api = connect()
+            return fetch_counters(self.api)
+
+        try:
+            return fetch_counters(self.api)
+        except (HTTPError, ValueError) as ex:
+            # the session has expired or the panel has been restarted, connection errors are not retried here
+            log.info(f'logging in again: {xdescr(ex)}')
+            self.api.login()
+            return fetch_counters(self.api)
+
 
 def main():
     try:
@@ -60,18 +200,27 @@ def main():
             default=URI_CONFIG_DEFAULT, nargs='?',
             help=f'The URI to the configuration file. Defaults to "{URI_CONFIG_DEFAULT}"'
         )
+        parser.add_argument(
+            '--daemon', action='store_true',
+            help='Keep running, saving snapshots on the schedule set by daemon_sample_interval.'
+        )
         args = parser.parse_args()
 
         # setup logging from config file settings
         setup_logging(args.config_uri)
 
-        # bootstrap Pyramid environment to get configuration
-        with bootstrap(args.config_uri):
-            # compares the local time with the time received from the NTP servers
-            # throws an exception if it differs significantly
-            verify_time_is_correct(diff_fatal=settings.max_allowable_time_drift)
-
-            save_stats()
+        # read the configuration, the database is not needed
+        with cli_env(args.config_uri):
+            if args.daemon:
+                asyncio.run(StatsDaemon().run())
+            else:
+                # compares the local time with the time received from the NTP servers
+                # throws an exception if it differs significantly
+                verify_time_is_correct(
+                    diff_fatal=settings.max_allowable_time_drift,
+                    cache_path=settings.time_check_cache or None, cache_ttl=settings.time_check_cache_ttl
+                )
+                save_stats()
 
     except KeyboardInterrupt as ex:
         print(f'{xdescr(ex)}')
@@ -0,0 +1,91 @@
+"""
+Local spool of the snapshot files downloaded by makerep.
+
+Downloaded snapshots and bundles are kept until they are ingested and committed, so a failed or interrupted run
+is retried without downloading them again. Layout: hostname/YYYYMMDD-HHMMSS-ffffff.json (or .bin) for snapshots,
+keyed by the snapshot date/time, and hostname/YYYYMMDD-bundle.ndjson.gz for bundles, keyed by the day.
+"""
+
+import logging
+from datetime import datetime, date, timezone
+from pathlib import Path
+
+# local imports
+from . import snapbin
+
+log = logging.getLogger(__name__)
+
+_DT_FORMAT = '%Y%m%d-%H%M%S-%f'
+_DT_LENGTH = len('YYYYMMDD-HHMMSS-ffffff')
+_BUNDLE_SUFFIX = '-bundle.ndjson.gz'
+
+
+class SnapshotSpool:
+    def __init__(self, dir_spool: Path):
+        self.dir_spool = dir_spool
+
+    def _dir_host(self, hostname: str) -> Path:
+        return self.dir_spool.joinpath(hostname)
+
+    def _snapshot_filepath(self, hostname: str, dt: datetime, suffix: str) -> Path:
+        return self._dir_host(hostname).joinpath(f'{dt.astimezone(timezone.utc).strftime(_DT_FORMAT)}{suffix}')
+
+    @staticmethod
+    def _write_atomically(filepath: Path, data: bytes):
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        filepath_tmp = filepath.with_name(f'{filepath.name}.tmp')
+        try:
+            filepath_tmp.write_bytes(data)
+            filepath_tmp.rename(filepath)
+
+        finally:
+            filepath_tmp.unlink(missing_ok=True)
+
+    def get_snapshot(self, hostname: str, dt: datetime) -> bytes | None:
+        """@return: the snapshot file content, either json or binary, None if not spooled"""
+        for suffix in (snapbin.FILENAME_SUFFIX, '.json'):
+            filepath = self._snapshot_filepath(hostname, dt, suffix)
+            if filepath.exists():
+                return filepath.read_bytes()
+        return None
+
+    def put_snapshot(self, hostname: str, dt: datetime, data: bytes):
+        suffix = snapbin.FILENAME_SUFFIX if snapbin.is_binary_snapshot(data) else '.json'
+        self._write_atomically(self._snapshot_filepath(hostname, dt, suffix), data)
+
+    def get_bundle(self, hostname: str, day: date) -> bytes | None:
+        filepath = self._dir_host(hostname).joinpath(f'{day:%Y%m%d}{_BUNDLE_SUFFIX}')
+        return filepath.read_bytes() if filepath.exists() else None
+
+    def put_bundle(self, hostname: str, day: date, data: bytes):
+        self._write_atomically(self._dir_host(hostname).joinpath(f'{day:%Y%m%d}{_BUNDLE_SUFFIX}'), data)
+
+    def remove_ingested(self, hostname: str, last_dt: datetime) -> int:
+        """
+        Remove the files of the snapshots not later than the latest snapshot saved in the database, and the bundles
+        of the days before it.
+        @return: number of files removed.
+        """
+        dir_host = self._dir_host(hostname)
+        if not dir_host.is_dir():
+            return 0
+
+        last_dt = last_dt.astimezone(timezone.utc)
+        num_removed = 0
+        for filepath in dir_host.iterdir():
+            name = filepath.name
+            try:
+                if name.endswith(_BUNDLE_SUFFIX):
+                    ingested = datetime.strptime(name[:8], '%Y%m%d').date() < last_dt.date()
+                else:
+                    dt = datetime.strptime(name[:_DT_LENGTH], _DT_FORMAT).replace(tzinfo=timezone.utc)
+                    ingested = dt <= last_dt
+            except ValueError:
+                continue  # not a spool file
+            if ingested:
+                filepath.unlink(missing_ok=True)
+                num_removed += 1
+
+        if num_removed:
+            log.debug(f'{hostname}: removed {num_removed} ingested file(s) from the spool')
+        return num_removed
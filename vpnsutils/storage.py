@@ -0,0 +1,30 @@
+"""
+Compressed ZODB record storage: the zodburi resolver of zlibfile:// URIs, which are file:// URIs with the FileStorage
+wrapped by zc.zlibstorage, so the Pyramid application and the console scripts open it transparently:
+
+    zodbconn.uri = zlibfile://%(here)s/../zodb-data/Data.fs?connection_cache_size=20000
+
+A ZEO server compresses its storage itself, with the zlibstorage section in its configuration, the clients keep
+using zeo:// URIs. Records written before the compression was enabled stay readable,
+"dbmaint compress" rewrites them compressed.
+"""
+
+from collections.abc import Callable
+from zodburi.resolvers import FileStorageURIResolver
+
+SCHEME = 'zlibfile'
+
+
+class ZlibFileStorageURIResolver(FileStorageURIResolver):
+    """Resolves zlibfile:// URIs, taking the same parameters as file:// ones"""
+    def __call__(self, uri: str) -> tuple[Callable, dict]:
+        factory_file, unused = super().__call__(uri.replace(f'{SCHEME}://', 'file://', 1))
+
+        def factory():
+            from zc.zlibstorage import ZlibStorage
+            return ZlibStorage(factory_file())
+
+        return factory, unused
+
+
+zlib_file_storage_resolver = ZlibFileStorageURIResolver()
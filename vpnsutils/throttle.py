@@ -0,0 +1,69 @@
+"""
+Per-host request throttling for the traffic statistics collector: adaptive concurrency limit and circuit breaker.
+"""
+
+import asyncio
+
+
+class HostUnavailableError(RuntimeError):
+    """The circuit breaker of the host is open, no more requests are made to it during this run"""
+
+
+class AdaptiveLimiter:
+    """
+    Limits the number of concurrent requests to a host, adapting the limit to the host's health: additive increase
+    while the requests succeed with the response latency close to the best one seen, multiplicative decrease
+    on errors and on slow responses.
+    """
+    def __init__(self, limit_max: int, limit_initial: int, slow_factor: float = 3.0):
+        """
+        @param limit_max: the limit never grows above this number of concurrent requests.
+        @param limit_initial: the limit to start with.
+        @param slow_factor: a response is slow if its latency exceeds the best latency seen this many times.
+        """
+        self.limit_max = limit_max
+        self.limit = float(max(1, min(limit_initial, limit_max)));  """Current limit, its integer part is in effect"""
+        self.slow_factor = slow_factor
+        self.in_flight = 0;  """Number of requests in progress"""
+        self.latency_min: float | None = None;  """The best response latency seen, seconds"""
+        self._changed = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency: float | None):
+        """
+        Release the request slot, adapting the limit.
+        @param latency: the response latency, seconds; None if the request failed.
+        """
+        async with self._changed:
+            self.in_flight -= 1
+            if latency is None or (self.latency_min is not None and latency > self.latency_min * self.slow_factor):
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.limit_max), self.limit + 1 / self.limit)  # +1 per limit requests
+            if latency is not None:
+                self.latency_min = latency if self.latency_min is None else min(self.latency_min, latency)
+            self._changed.notify_all()
+
+
+class CircuitBreaker:
+    """Opens after a number of consecutive failed requests to a host and stays open until the end of the run"""
+    def __init__(self, failures_max: int):
+        self.failures_max = failures_max
+        self.failures = 0;  """Number of consecutive failures"""
+        self.is_open = False
+
+    def check(self, hostname: str):
+        if self.is_open:
+            raise HostUnavailableError(f'{hostname}: {self.failures} consecutive requests failed, giving up')
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.failures_max:
+            self.is_open = True
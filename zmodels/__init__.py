@@ -6,9 +6,16 @@ from datetime import datetime
 
 # noinspection PyUnresolvedReferences
 from BTrees.OOBTree import OOBTree
+# noinspection PyUnresolvedReferences
+from BTrees.Length import Length
 
 # local imports
 from . import tcm
+from .tlog import TrafficLog
+from .hosts import HostState
+from .issues import IssueLog
+
+USAGE_WINDOW_HOURS_DEFAULT = 7 * 24;  """Default length of the rolling usage window, hours"""
 
 # force explicit transactions in the main thread
 # see: https://relstorage.readthedocs.io/en/latest/things-to-know.html#use-explicit-transaction-managers
@@ -20,13 +27,32 @@ class AppRoot(persistent.Persistent):  # in Cookiecutter: base class was Persist
     """
     __parent__ = __name__ = None   # used by Request.resource_path()
 
+    hosts: dict[str, HostState] | None = None;  """Server hostname => ingest state, absent in older databases"""
+    num_snapshots: Length | None = None;  """Number of snapshots parsed, conflict-free counter shared by all hosts"""
+
+    last_snapshots: dict[str, dict] | None = None;  """Legacy, server hostname => latest traffic statistics fetched"""
+
+    tlog_migrating: TrafficLog | None = None;  """The traffic log being converted from the legacy layout"""
+    tlog_migrated_key: tuple[datetime, str, str] | None = None;  """The last legacy traffic log key converted"""
+
     def __init__(self):
-        self.last_snapshots: dict[str, dict] = OOBTree();  """Server hostname => latest traffic statistics fetched"""
+        self.hosts = OOBTree()
+        self.num_snapshots = Length()
+
+        self.tlog: TrafficLog | OOBTree = TrafficLog()
+        """Traffic amount records, in databases created before TrafficLog: an OOBTree to be migrated,
+        (hour, hostname, user_id) => (bytes downloaded, bytes uploaded)"""
 
-        self.tlog: dict[tuple[datetime, str, str], tuple[int, int]] = OOBTree()
-        """Traffic amount records: (hour, hostname, user_id) => (bytes downloaded, bytes uploaded)"""
+        self.issues: IssueLog | OOBTree = IssueLog()
+        """Log of errors or inconsistencies not related to a server, in older databases: an OOBTree to be converted,
+        date/time => message"""
 
-        self.issues: dict[datetime, str] = OOBTree();  """Log of errors or inconsistencies found"""
+    def host(self, hostname: str) -> HostState:
+        """Get the ingest state of a server, creating it if it does not exist yet"""
+        state = self.hosts.get(hostname, None)
+        if state is None:
+            state = self.hosts[hostname] = HostState(usage_hours=USAGE_WINDOW_HOURS_DEFAULT)
+        return state
 
 
 def get_app_root(conn: ZODB.Connection.Connection) -> AppRoot:
@@ -0,0 +1,59 @@
+"""
+Per-server partitions of the ingest state.
+
+Every VPN server has its own state object, usage aggregates, issues log and traffic log partition, so several
+workers can ingest different servers at the same time, each in its own transaction, without write conflicts.
+"""
+
+import persistent
+from collections.abc import Iterable, Sequence
+
+# noinspection PyUnresolvedReferences
+from BTrees.LLBTree import LLBTree
+
+# local imports
+from .usage import UsageWindows
+from .tlog import HostTrafficLog
+from .issues import IssueLog
+
+
+class SnapshotState(persistent.Persistent):
+    """
+    The latest snapshot of a server parsed: its date/time and the traffic counters of the users.
+    The counters are packed into an integer-keyed BTree like the traffic log buckets, using the user numbers
+    of the server traffic log partition; saving the next snapshot rewrites only the BTree buckets of the users
+    whose counters have changed, not the whole users map.
+    """
+    def __init__(self):
+        self.datetime: str | None = None;  """Date/time of the snapshot, in the ISO format as in the snapshot"""
+        self.counters: dict[int, int] = LLBTree();  """(user number << 1 | direction) => counter, bytes"""
+
+    def load(self, host_tlog: HostTrafficLog) -> dict[str, list[int]]:
+        """@return: user_id => [bytes downloaded, bytes uploaded]"""
+        return {user_id: [am_down, am_up] for user_id, am_down, am_up in host_tlog.unpack(self.counters)}
+
+    def save(self, dt: str, counters: Iterable[tuple[str, Sequence[int]]], host_tlog: HostTrafficLog):
+        """
+        Replace the snapshot, unchanged counters are left untouched.
+        @param dt: date/time of the snapshot, in the ISO format.
+        @param counters: iterable of (user_id, (bytes downloaded, bytes uploaded)).
+        """
+        self.datetime = dt
+        packed = {}
+        for user_id, (am_down, am_up) in counters:
+            key = host_tlog.intern(user_id) << 1
+            packed[key] = am_down
+            packed[key | 1] = am_up
+
+        for key in set(self.counters.keys()).difference(packed):
+            del self.counters[key]
+        # setting a key to its current value does not mark the BTree bucket as changed
+        self.counters.update(sorted(packed.items()))
+
+
+class HostState(persistent.Persistent):
+    """Ingest state of a single VPN server"""
+    def __init__(self, usage_hours: int):
+        self.snapshot = SnapshotState();  """The latest snapshot parsed"""
+        self.usage = UsageWindows(num_hours=usage_hours);  """Rolling window traffic usage of the server users"""
+        self.issues = IssueLog();  """Log of errors or inconsistencies found for the server"""
@@ -0,0 +1,84 @@
+"""
+Issues log: errors and inconsistencies found while collecting the traffic statistics.
+
+Repeated occurrences of an issue are aggregated into a single entry, keyed by the issue kind and detail, which counts
+them and keeps the latest message. Entries are indexed by the time last seen, for the recent issues of the report and
+for the retention limits. Every VPN server has an issues log of its own, in its ingest state partition.
+"""
+
+import itertools
+import persistent
+from datetime import datetime
+from collections.abc import Iterator
+
+# noinspection PyUnresolvedReferences
+from BTrees.OOBTree import OOBTree
+
+
+class Issue(persistent.Persistent):
+    """Aggregated occurrences of an issue"""
+    def __init__(self, kind: str, detail: str, at: datetime):
+        self.kind = kind;  """Issue type, e.g. snapshots_missed"""
+        self.detail = detail;  """Distinguishes issues of the same kind to be counted separately, often empty"""
+        self.count = 0;  """Total of the occurrences, e.g. number of snapshots missed"""
+        self.first_seen = at
+        self.last_seen = at
+        self.message = '';  """Description of the latest occurrence"""
+
+    def describe(self) -> str:
+        """The latest message, with the total if the issue occurred more than once"""
+        if self.first_seen == self.last_seen:
+            return self.message
+        return f'{self.message} (total {self.count} since {self.first_seen:%Y-%m-%d %H:%M})'
+
+
+class IssueLog(persistent.Persistent):
+    """Aggregated issues of a VPN server or of the whole application, indexed by the time last seen"""
+    def __init__(self):
+        self.entries: dict[tuple[str, str], Issue] = OOBTree();  """(kind, detail) => issue"""
+        self.by_time: dict[tuple[datetime, str, str], Issue] = OOBTree();  """(last seen, kind, detail) => issue"""
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, kind: str, message: str, at: datetime, detail: str = '', count: int = 1) -> Issue:
+        """
+        Record an occurrence of an issue.
+        @param kind: issue type.
+        @param message: description of the occurrence.
+        @param at: date/time of the occurrence.
+        @param detail: issues of the same kind and detail are aggregated.
+        @param count: amount of the occurrence, e.g. number of snapshots missed.
+        """
+        issue = self.entries.get((kind, detail), None)
+        if issue is None:
+            issue = self.entries[(kind, detail)] = Issue(kind, detail, at)
+        else:
+            del self.by_time[(issue.last_seen, kind, detail)]
+            issue.last_seen = max(issue.last_seen, at)
+        self.by_time[(issue.last_seen, kind, detail)] = issue
+        issue.count += count
+        issue.message = message
+        return issue
+
+    def recent(self, since: datetime = None) -> Iterator[Issue]:
+        """@return: iterator of the issues last seen at or after the given date/time, the latest first"""
+        # noinspection PyArgumentList
+        return reversed(list(self.by_time.values(min=(since,) if since else None)))
+
+    def prune(self, before: datetime, max_entries: int) -> int:
+        """
+        Apply the retention limits: remove the issues last seen before the given date/time,
+        then the oldest ones beyond the maximum number of entries.
+        @return: number of issues removed.
+        """
+        # noinspection PyArgumentList
+        keys = list(self.by_time.keys(max=(before,), excludemax=True))
+        num_excess = len(self.by_time) - len(keys) - max_entries
+        if num_excess > 0:
+            # noinspection PyArgumentList
+            keys.extend(itertools.islice(self.by_time.keys(min=(before,)), num_excess))
+        for key in keys:
+            del self.by_time[key]
+            del self.entries[key[1:]]
+        return len(keys)
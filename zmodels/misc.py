@@ -19,6 +19,28 @@ BOOL_NONE: bool | None = None;              """None-value typed as bool"""
 DEC_NONE: Decimal | None = None;            """None-value typed as Decimal"""
 DEC_INT_NONE: int | Decimal | None = None;  """None-value typed as Decimal or int"""
 INT_NONE: int | None = None;                """None-value typed as int"""
+DATETIME_UNIX_EPOCH = datetime(year=1970, month=1, day=1, tzinfo=timezone.utc);  """Date/time of the Unix Epoch"""
+
+
+def epoch_hour(dt: datetime) -> int:
+    """Number of whole hours since the Unix Epoch"""
+    return (dt - DATETIME_UNIX_EPOCH) // timedelta(hours=1)
+
+
+def epoch_hour_to_datetime(hour: int) -> datetime:
+    """The beginning of the hour given as a number of hours since the Unix Epoch, in UTC"""
+    return DATETIME_UNIX_EPOCH + timedelta(hours=hour)
+
+
+def epoch_month(dt: datetime) -> int:
+    """Number of whole months since the Unix Epoch, in UTC"""
+    dt = dt.astimezone(timezone.utc)
+    return (dt.year - DATETIME_UNIX_EPOCH.year) * 12 + dt.month - 1
+
+
+def epoch_month_to_datetime(month: int) -> datetime:
+    """The beginning of the month given as a number of months since the Unix Epoch, in UTC"""
+    return datetime(year=DATETIME_UNIX_EPOCH.year + month // 12, month=month % 12 + 1, day=1, tzinfo=timezone.utc)
 
 
 class TodayCounter(persistent.Persistent):
@@ -0,0 +1,310 @@
+"""
+Traffic log: hourly traffic amounts per VPN server and user.
+
+Layout: hostname => epoch hour => user number => amount, where user ids are interned to integers per host and both
+amounts of a user are packed into a single integer-keyed BTree: the key is the user number shifted left by one bit,
+the lowest bit selects bytes downloaded (0) or uploaded (1).
+
+Old hourly records are rolled up into daily buckets, keyed by epoch day, and old daily buckets into monthly ones,
+keyed by epoch month, the buckets have the same packed layout. The records of a period are in a single tier,
+except for the amounts arriving for an hour after its day has been rolled up, until the next rollup.
+"""
+
+import itertools
+import persistent
+from datetime import datetime
+from collections.abc import Callable, Iterable, Iterator
+
+# noinspection PyUnresolvedReferences
+from BTrees.OOBTree import OOBTree
+# noinspection PyUnresolvedReferences
+from BTrees.OIBTree import OIBTree
+# noinspection PyUnresolvedReferences
+from BTrees.IOBTree import IOBTree
+# noinspection PyUnresolvedReferences
+from BTrees.LOBTree import LOBTree
+# noinspection PyUnresolvedReferences
+from BTrees.LLBTree import LLBTree
+
+# local imports
+from .misc import epoch_hour, epoch_hour_to_datetime, epoch_month, epoch_month_to_datetime
+
+HOURS_PER_DAY = 24
+
+
+def _add_amounts(amounts: LLBTree, amounts_added: LLBTree):
+    amounts.update([(k, amounts.get(k, 0) + v) for k, v in amounts_added.items()])
+
+
+def _roll_up(
+        buckets: LOBTree, buckets_up: LOBTree, key_max: int, key_up: Callable[[int], int], max_records: int
+) -> int:
+    """
+    Add the oldest buckets up to key_max, inclusive, to the buckets of the coarser tier and delete them.
+    @param key_up: function returning the key of the coarser tier bucket for a bucket key.
+    @param max_records: stop after the buckets of at least this number of records have been rolled up.
+    @return: number of records rolled up.
+    """
+    num_records = 0
+    # noinspection PyArgumentList
+    for key in list(itertools.islice(buckets.keys(max=key_max), max_records)):
+        amounts = buckets[key]
+        amounts_up = buckets_up.get(key_up(key), None)
+        if amounts_up is None:
+            amounts_up = buckets_up[key_up(key)] = LLBTree()
+        _add_amounts(amounts_up, amounts)
+        num_records += len(amounts)
+        del buckets[key]
+        if num_records >= max_records:
+            break
+    return num_records
+
+
+def day_to_month(day: int) -> int:
+    return epoch_month(epoch_hour_to_datetime(day * HOURS_PER_DAY))
+
+
+def month_to_hour(month: int) -> int:
+    """The epoch hour the epoch month begins with"""
+    return epoch_hour(epoch_month_to_datetime(month))
+
+
+class HostTrafficLog(persistent.Persistent):
+    """Traffic amounts of the users of a single VPN server: hourly, and older ones rolled up to days and months"""
+    def __init__(self):
+        self.hours: dict[int, LLBTree] = LOBTree();  """epoch hour => (user number << 1 | direction) => bytes"""
+        self.user_numbers: dict[str, int] = OIBTree();  """user_id => user number"""
+        self.user_ids: dict[int, str] = IOBTree();  """user number => user_id"""
+        self.days: dict[int, LLBTree] = LOBTree();  """epoch day => packed amounts"""
+        self.months: dict[int, LLBTree] = LOBTree();  """epoch month => packed amounts"""
+
+    def intern(self, user_id: str) -> int:
+        """Get the user number, assigning the next one to a new user"""
+        number = self.user_numbers.get(user_id, None)
+        if number is None:
+            number = self.user_ids.maxKey() + 1 if self.user_ids else 0
+            self.user_numbers[user_id] = number
+            self.user_ids[number] = user_id
+        return number
+
+    def add(self, hour: int, user_id: str, am_down: int, am_up: int):
+        """Add traffic amounts of a user for the hour given in epoch hours"""
+        amounts = self.hours.get(hour, None)
+        if amounts is None:
+            amounts = self.hours[hour] = LLBTree()
+
+        key = self.intern(user_id) << 1
+        if am_down:
+            amounts[key] = amounts.get(key, 0) + am_down
+        if am_up:
+            amounts[key | 1] = amounts.get(key | 1, 0) + am_up
+
+    def add_many(self, hour: int, records: Iterable[tuple[str, int, int]]):
+        """
+        Add traffic amounts of many users for the hour given in epoch hours, the bucket of the hour is updated
+        in a single pass in key order.
+        @param records: iterable of (user_id, bytes downloaded, bytes uploaded).
+        """
+        updates = {}
+        for user_id, am_down, am_up in records:
+            key = self.intern(user_id) << 1
+            if am_down:
+                updates[key] = updates.get(key, 0) + am_down
+            if am_up:
+                updates[key | 1] = updates.get(key | 1, 0) + am_up
+        if not updates:
+            return
+
+        amounts = self.hours.get(hour, None)
+        if amounts is None:
+            amounts = self.hours[hour] = LLBTree()
+        amounts.update([(k, amounts.get(k, 0) + v) for k, v in sorted(updates.items())])
+
+    def get(self, hour: int, user_id: str) -> tuple[int, int]:
+        number = self.user_numbers.get(user_id, None)
+        amounts = self.hours.get(hour, None)
+        if number is None or amounts is None:
+            return 0, 0
+        return amounts.get(number << 1, 0), amounts.get(number << 1 | 1, 0)
+
+    def unpack(self, amounts: LLBTree) -> Iterator[tuple[str, int, int]]:
+        """@return: iterator of (user_id, bytes downloaded, bytes uploaded) of a bucket, ordered by user number"""
+        user_ids = self.user_ids
+        pending = None;  """(user number, bytes downloaded) waiting for bytes uploaded of the same user"""
+        for key, amount in amounts.items():
+            number = key >> 1
+            if pending and pending[0] != number:
+                yield user_ids[pending[0]], pending[1], 0
+                pending = None
+            if key & 1:
+                yield user_ids[number], pending[1] if pending else 0, amount
+                pending = None
+            else:
+                pending = number, amount
+        if pending:
+            yield user_ids[pending[0]], pending[1], 0
+
+    def items(self, hour_min: int = None, hour_max: int = None) -> Iterator[tuple[int, str, int, int]]:
+        """
+        Iterate over the hourly records within the given range of epoch hours, inclusive.
+        @return: iterator of (epoch hour, user_id, bytes downloaded, bytes uploaded), ordered by hour and user number.
+        """
+        # noinspection PyArgumentList
+        for hour, amounts in self.hours.items(min=hour_min, max=hour_max):
+            for user_id, am_down, am_up in self.unpack(amounts):
+                yield hour, user_id, am_down, am_up
+
+    def span(self, hour_min: int = None, hour_max: int = None) -> tuple[int | None, int | None]:
+        """
+        The range of epoch hours, inclusive, widened to the whole rolled up buckets it begins or ends within:
+        the amounts of a monthly or daily bucket can not be split by hour.
+        @return: (hour_min, hour_max) of the range the tiers can answer exactly.
+        """
+        if hour_min is not None:
+            month = epoch_month(epoch_hour_to_datetime(hour_min))
+            if self.months and month in self.months:
+                hour_min = month_to_hour(month)
+            elif self.days and hour_min // HOURS_PER_DAY in self.days:
+                hour_min = hour_min // HOURS_PER_DAY * HOURS_PER_DAY
+        if hour_max is not None:
+            month = epoch_month(epoch_hour_to_datetime(hour_max))
+            if self.months and month in self.months:
+                hour_max = month_to_hour(month + 1) - 1
+            elif self.days and hour_max // HOURS_PER_DAY in self.days:
+                hour_max = (hour_max // HOURS_PER_DAY + 1) * HOURS_PER_DAY - 1
+        return hour_min, hour_max
+
+    def buckets(self, hour_min: int = None, hour_max: int = None) -> Iterator[tuple[int, LLBTree]]:
+        """
+        Iterate over the buckets of all tiers within the given range of epoch hours, inclusive. The range is widened
+        to the whole monthly and daily buckets it begins or ends within, see span(); the hourly records within
+        the widened range are read along with them, so the edges are exact while the hourly tier exists.
+        @return: iterator of (epoch hour the bucket begins with, packed amounts), monthly ones first, then daily,
+            then hourly ones.
+        """
+        hour_min, hour_max = self.span(hour_min, hour_max)
+        if self.months:
+            month_min = epoch_month(epoch_hour_to_datetime(hour_min - 1)) + 1 if hour_min is not None else None
+            month_max = epoch_month(epoch_hour_to_datetime(hour_max + 1)) - 1 if hour_max is not None else None
+            # noinspection PyArgumentList
+            for month, amounts in self.months.items(min=month_min, max=month_max):
+                yield month_to_hour(month), amounts
+        if self.days:
+            day_min = -(-hour_min // HOURS_PER_DAY) if hour_min is not None else None
+            day_max = (hour_max + 1) // HOURS_PER_DAY - 1 if hour_max is not None else None
+            # noinspection PyArgumentList
+            for day, amounts in self.days.items(min=day_min, max=day_max):
+                yield day * HOURS_PER_DAY, amounts
+        # noinspection PyArgumentList
+        yield from self.hours.items(min=hour_min, max=hour_max)
+
+    def totals(self, hour_min: int = None, hour_max: int = None) -> dict[str, tuple[int, int]]:
+        """
+        Traffic amounts of the users over a range of epoch hours, inclusive, read from all tiers:
+        a long range mostly reads monthly and daily buckets, not hourly ones. The amounts cover the range
+        widened to whole rolled up buckets, see span().
+        @return: user_id => (bytes downloaded, bytes uploaded).
+        """
+        totals = {}
+        for _hour, amounts in self.buckets(hour_min, hour_max):
+            for user_id, am_down, am_up in self.unpack(amounts):
+                am_down_total, am_up_total = totals.get(user_id, (0, 0))
+                totals[user_id] = am_down_total + am_down, am_up_total + am_up
+        return totals
+
+    def roll_up_hours(self, hour_before: int, max_records: int) -> int:
+        """
+        Roll up the oldest hourly records into daily buckets, the days ending before the given epoch hour.
+        @param max_records: stop after at least this number of records, a batch for a single transaction.
+        @return: number of hourly records rolled up, 0 when there is nothing to roll up.
+        """
+        hour_max = hour_before // HOURS_PER_DAY * HOURS_PER_DAY - 1
+        return _roll_up(self.hours, self.days, hour_max, lambda x: x // HOURS_PER_DAY, max_records)
+
+    def roll_up_days(self, hour_before: int, max_records: int) -> int:
+        """
+        Roll up the oldest daily records into monthly buckets, the months ending before the given epoch hour.
+        @param max_records: stop after at least this number of records, a batch for a single transaction.
+        @return: number of daily records rolled up, 0 when there is nothing to roll up.
+        """
+        if not self.days:
+            return 0
+        month_hour_min = month_to_hour(epoch_month(epoch_hour_to_datetime(hour_before)))
+        return _roll_up(self.days, self.months, month_hour_min // HOURS_PER_DAY - 1, day_to_month, max_records)
+
+
+class TrafficLog(persistent.Persistent):
+    """Hourly traffic amounts of all VPN servers"""
+    def __init__(self):
+        self.hosts: dict[str, HostTrafficLog] = OOBTree();  """hostname => traffic log of the server"""
+
+    def host(self, hostname: str) -> HostTrafficLog:
+        """Get the traffic log of a server, creating it if it does not exist yet"""
+        host_tlog = self.hosts.get(hostname, None)
+        if host_tlog is None:
+            host_tlog = self.hosts[hostname] = HostTrafficLog()
+        return host_tlog
+
+    def add(self, hour: datetime, hostname: str, user_id: str, am_down: int, am_up: int):
+        self.host(hostname).add(epoch_hour(hour), user_id, am_down, am_up)
+
+    def get(self, hour: datetime, hostname: str, user_id: str) -> tuple[int, int]:
+        host_tlog = self.hosts.get(hostname, None)
+        return host_tlog.get(epoch_hour(hour), user_id) if host_tlog is not None else (0, 0)
+
+    def items(
+            self, hour_min: datetime = None, hour_max: datetime = None
+    ) -> Iterator[tuple[tuple[datetime, str, str], tuple[int, int]]]:
+        """
+        Iterate over the records within the given range of hours, inclusive.
+        @return: iterator of ((hour, hostname, user_id), (bytes downloaded, bytes uploaded)), ordered by hostname,
+            hour and user number.
+        """
+        h_min, h_max = _epoch_hours(hour_min, hour_max)
+        for hostname, host_tlog in self.hosts.items():
+            for hour, user_id, am_down, am_up in host_tlog.items(h_min, h_max):
+                yield (epoch_hour_to_datetime(hour), hostname, user_id), (am_down, am_up)
+
+    def span(self, hour_min: datetime = None, hour_max: datetime = None) -> tuple[datetime | None, datetime | None]:
+        """
+        The range of hours, inclusive, widened to the whole rolled up buckets of any server it begins or ends within,
+        see HostTrafficLog.span().
+        @return: (the first hour, the last hour) of the range the tiers can answer exactly.
+        """
+        h_min, h_max = self._span(*_epoch_hours(hour_min, hour_max))
+        return (
+            epoch_hour_to_datetime(h_min) if h_min is not None else None,
+            epoch_hour_to_datetime(h_max) if h_max is not None else None,
+        )
+
+    def _span(self, h_min: int | None, h_max: int | None) -> tuple[int | None, int | None]:
+        while True:
+            spans = [x.span(h_min, h_max) for x in self.hosts.values()]
+            span_min = min((x[0] for x in spans), default=h_min) if h_min is not None else None
+            span_max = max((x[1] for x in spans), default=h_max) if h_max is not None else None
+            if (span_min, span_max) == (h_min, h_max):
+                return h_min, h_max
+            h_min, h_max = span_min, span_max  # a widened edge may fall within a coarser bucket of another server
+
+    def totals(self, hour_min: datetime = None, hour_max: datetime = None) -> dict[str, tuple[int, int]]:
+        """
+        Traffic amounts of the users of all servers over a range of hours, inclusive, read from all tiers.
+        The amounts of every server cover the same range: the given one widened by span().
+        @return: user_id => (bytes downloaded, bytes uploaded).
+        """
+        h_min, h_max = self._span(*_epoch_hours(hour_min, hour_max))
+        totals = {}
+        for host_tlog in self.hosts.values():
+            for user_id, (am_down, am_up) in host_tlog.totals(h_min, h_max).items():
+                am_down_total, am_up_total = totals.get(user_id, (0, 0))
+                totals[user_id] = am_down_total + am_down, am_up_total + am_up
+        return totals
+
+
+def _epoch_hours(hour_min: datetime | None, hour_max: datetime | None) -> tuple[int | None, int | None]:
+    """Range of hours, inclusive, in epoch hours: the hours beginning at or after hour_min, up to hour_max's one"""
+    h_min = epoch_hour(hour_min) if hour_min else None
+    if hour_min and epoch_hour_to_datetime(h_min) < hour_min:
+        h_min += 1  # the hour_min is not the beginning of an hour
+    h_max = epoch_hour(hour_max) if hour_max else None
+    return h_min, h_max
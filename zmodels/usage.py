@@ -0,0 +1,97 @@
+"""
+Rolling window traffic usage aggregates, maintained incrementally as the traffic log is written.
+"""
+
+import persistent
+
+# noinspection PyUnresolvedReferences
+from BTrees.OOBTree import OOBTree
+# noinspection PyUnresolvedReferences
+from BTrees.OIBTree import OIBTree
+
+
+class UserUsage(persistent.Persistent):
+    """
+    Hourly traffic of a single user for the last num_hours hours, kept in a ring of hourly buckets.
+    The bucket of an hour is its number since the Unix Epoch modulo num_hours.
+    """
+    def __init__(self, num_hours: int):
+        self.num_hours = num_hours
+        self.buckets: list[int] = [0] * num_hours;  """Bytes transferred during the hours in the window"""
+        self.hour_last: int | None = None;  """The latest hour with traffic, epoch hours"""
+        self.total = 0;  """Sum of all buckets, i.e. the traffic during (hour_last - num_hours, hour_last]"""
+
+    def add(self, hour: int, amount: int):
+        """
+        Add traffic amount for the given hour, moving the window forward if the hour is later than the last one.
+        Amounts for hours that are already out of the window are ignored.
+        """
+        if self.hour_last is None or hour - self.hour_last >= self.num_hours:
+            # the window moves forward entirely
+            self.buckets = [0] * self.num_hours
+            self.total = 0
+            self.hour_last = hour
+
+        elif hour > self.hour_last:
+            # expire buckets of the hours leaving the window
+            for h in range(self.hour_last + 1, hour + 1):
+                idx = h % self.num_hours
+                self.total -= self.buckets[idx]
+                self.buckets[idx] = 0
+            self.hour_last = hour
+
+        elif hour <= self.hour_last - self.num_hours:
+            return  # out of the window
+
+        self.buckets[hour % self.num_hours] += amount
+        self.total += amount
+        self._p_changed = True
+
+    def total_at(self, hour_now: int) -> int:
+        """Traffic during the num_hours hours up to and including hour_now, hour_now is not earlier than hour_last"""
+        shift = hour_now - self.hour_last
+        if shift >= self.num_hours:
+            return 0
+
+        total = self.total
+        for h in range(self.hour_last - self.num_hours + 1, hour_now - self.num_hours + 1):
+            total -= self.buckets[h % self.num_hours]
+        return total
+
+
+class UsageWindows(persistent.Persistent):
+    """Traffic usage of all users for the last num_hours hours"""
+    def __init__(self, num_hours: int):
+        self.num_hours = num_hours
+        self.users: dict[str, UserUsage] = OOBTree();  """user_id => user usage"""
+        self.last_hours: dict[str, int] = OIBTree();  """user_id => the latest hour with traffic, epoch hours"""
+
+    def add(self, hour: int, user_id: str, amount: int):
+        usage = self.users.get(user_id, None)
+        if usage is None:
+            usage = self.users[user_id] = UserUsage(self.num_hours)
+        usage.add(hour, amount)
+        if self.last_hours.get(user_id, None) != usage.hour_last:
+            self.last_hours[user_id] = usage.hour_last
+
+    def totals(self, hour_now: int) -> dict[str, int]:
+        """
+        Traffic of the users active during the num_hours hours up to and including hour_now.
+        Only usage objects of active users are loaded from the database.
+        """
+        totals = {}
+        for user_id, hour_last in self.last_hours.items():
+            if hour_now - hour_last >= self.num_hours:
+                continue
+            total = self.users[user_id].total_at(hour_now)
+            if total:
+                totals[user_id] = total
+        return totals
+
+    def expire(self, hour_now: int) -> int:
+        """Remove users without traffic during the window ending at hour_now, return the number of removed users"""
+        expired = [k for k, v in self.last_hours.items() if hour_now - v >= self.num_hours]
+        for user_id in expired:
+            del self.users[user_id]
+            del self.last_hours[user_id]
+        return len(expired)